@@ -0,0 +1,99 @@
+"""
+Load test for the camera acquisition and saving pipeline, without camera hardware.
+
+Runs a PSEye with the synthetic or replay backend through a sequence of simulated trials (flushing off during trials, on between them), querying frames as the session would, then reports per-process CPU usage and how many frames made it to file.
+Should be run from within the main project directory, ex.:
+    python benchmarks/camera_load.py --backend synthetic --fps 60 --duration 60
+    python benchmarks/camera_load.py --backend replay --path data/1/20160705103903_cams.h5 --fast
+
+Per-process CPU usage requires psutil.
+
+Reference results, 2 synthetic QVGA cameras at 60 fps on a 1-core Linux VM, from:
+    python benchmarks/camera_load.py --duration 12
+    acquisition 6.7-8.2%, saver 3.3-4.6% mean CPU of one core over repeated runs; ~700 of ~725 frames saved per camera
+Movie codecs, same setup, from:
+    python benchmarks/camera_load.py --duration 20 [--compression gzip --level 1]
+    lzf (default): saver 5.9% mean CPU; flushes 0.17 s mean, 0.27 s max
+    gzip level 1: saver 16.6% mean CPU; flushes 0.6 s mean, 1.0 s max
+"""
+import os, sys, time, argparse, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import h5py
+from hardware.cameras import PSEye, _PSEye
+from util import now
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def cpu_times(procs):
+    """Total user+system CPU time (s) used so far by each named process
+    """
+    if psutil is None:
+        return {}
+    return {name:sum(psutil.Process(pid).cpu_times()[:2]) for name,pid in procs.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--backend', default='synthetic', choices=['synthetic','replay'])
+    parser.add_argument('--path', default=None, help='movie file to replay')
+    parser.add_argument('--fast', action='store_true', help='replay as fast as possible rather than in real time')
+    parser.add_argument('--n_cams', type=int, default=2)
+    parser.add_argument('--vga', action='store_true', help='use 640x480 frames rather than 320x240')
+    parser.add_argument('--fps', type=int, default=60)
+    parser.add_argument('--duration', type=float, default=30., help='seconds')
+    parser.add_argument('--trial_duration', type=float, default=8.)
+    parser.add_argument('--iti', type=float, default=2.)
+    parser.add_argument('--query_rate', type=float, default=15.)
+    parser.add_argument('--compression', default='lzf', help='codec, see hardware.cameras.movie_codec')
+    parser.add_argument('--level', type=int, default=1, help='compression level')
+    parser.add_argument('--out', default=None, help='destination movie file (default: temporary file)')
+    args = parser.parse_args()
+
+    out = args.out or os.path.join(tempfile.mkdtemp(), 'load_test_cams.h5')
+    rm = _PSEye.RES_LARGE if args.vga else _PSEye.RES_SMALL
+    n = args.n_cams
+    backend_params = dict(path=args.path, realtime=not args.fast) if args.backend=='replay' else {}
+
+    cam = PSEye(idx=tuple(range(n)), resolution_mode=(rm,)*n, frame_rate=(args.fps,)*n, color_mode=(_PSEye.GREYSCALE,)*n, cleye_params=({},)*n, query_rate=args.query_rate, save_name=out, backend=args.backend, backend_params=backend_params, compression=args.compression, compression_level=args.level)
+    procs = dict(main=os.getpid(), acquisition=cam.pseye.pid, saver=cam.saver.pid)
+    cam.begin_saving()
+    cam.set_flush(True)
+
+    # simulated trials, sampling CPU usage once per second
+    usage = []
+    n_queried = 0
+    t0 = now()
+    while now()-t0 < args.duration:
+        in_trial = (now()-t0) % (args.trial_duration+args.iti) < args.trial_duration
+        cam.set_flush(not in_trial)
+        t1,c1 = now(),cpu_times(procs)
+        while now()-t1 < 1.:
+            ts,fr = cam.get(new_only=True)
+            n_queried += fr is not None
+            time.sleep(0.5/args.query_rate)
+        t2,c2 = now(),cpu_times(procs)
+        usage.append({name:100.*(c2[name]-c1[name])/(t2-t1) for name in c1})
+    elapsed = now()-t0
+    cam.end()
+
+    # report
+    print('{} backend, {} camera(s) at {} fps, {:.1f} s, {} compression'.format(args.backend, n, args.fps, elapsed, args.compression))
+    if psutil is None:
+        print('CPU usage: (install psutil to measure)')
+    else:
+        for name in sorted(procs):
+            vals = [u[name] for u in usage]
+            print('CPU usage, {:<12}: mean {:6.1f}%, max {:6.1f}% of one core'.format(name, np.mean(vals), np.max(vals)))
+    print('Frames queried: {}'.format(n_queried))
+    stats = cam.stats()
+    with h5py.File(out, 'r') as f:
+        for i in range(n):
+            print('Camera {}: {} frames saved (~{} expected), {missed} missed by the camera, {late} late, {overflow} dropped at the frame buffer'.format(i, len(f['ts{}'.format(i)]), int(args.fps*elapsed), **stats[i]))
+            print('Camera {}: {flushes} flushes, mean {:.3f} s, max {flush_time_max:.3f} s; compression ratio {compression_ratio:.2f}; peak queue {queue_max} frames'.format(i, stats[i]['flush_time']/max(stats[i]['flushes'],1), **stats[i]))
+    print('Output: {}'.format(out))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Compression benchmark for movie data, comparing the codecs available to MovieSaver on a recorded movie.
+
+Writes the same frames with each codec/level/filter setting, the same way MovieSaver does, and reports write throughput, read throughput and compression ratio, to choose a setting that fits both disk bandwidth and CPU headroom.
+Should be run from within the main project directory, ex.:
+    python benchmarks/compression.py data/1/20160705103903_cams.h5
+    python benchmarks/compression.py data/1/20160705103903_cams.h5 --cam 1 --n_frames 3000 --workers 2
+
+Codecs other than gzip and lzf are skipped if hdf5plugin is not installed. The resulting setting is used via the compression, compression_level and compression_filter camera parameters.
+"""
+import os, sys, time, argparse, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import h5py
+from multiprocessing.pool import ThreadPool
+import multiprocessing as mp
+from hardware.cameras import movie_codec, _write_chunks, hdf5plugin
+
+# (codec, level, filter)
+SETTINGS = [
+    ('lzf', None, None),
+    ('gzip', 1, None),
+    ('gzip', 4, None),
+    ('blosc-lz4', 5, 'shuffle'),
+    ('blosc-lz4', 5, 'bitshuffle'),
+    ('blosc-lz4hc', 5, 'bitshuffle'),
+    ('blosc-zstd', 1, 'bitshuffle'),
+    ('blosc-zstd', 5, 'bitshuffle'),
+    ('zstd', 3, None),
+    ('lz4', None, None),
+    ('lz4', None, 'bitshuffle'),
+]
+
+def bench(frames, codec, level, filter, chunk_frames, pool, path):
+    """Write frames to a new file with one compression setting, then read them back
+
+    Returns
+    -------
+    write_mbps, read_mbps, ratio : floats
+    """
+    comp,encode = movie_codec(codec, level, filter)
+    n = len(frames)//chunk_frames*chunk_frames
+    with h5py.File(path, 'w') as f:
+        dset = f.create_dataset('mov', frames[:n].shape, dtype='uint8', chunks=(chunk_frames,)+frames.shape[1:], **comp)
+        t0 = time.time()
+        _write_chunks(dset, 0, frames[:n], encode, pool)
+        f.flush()
+        t_write = time.time()-t0
+        stored = dset.id.get_storage_size()
+    with h5py.File(path, 'r') as f:
+        t0 = time.time()
+        back = f['mov'][:]
+        t_read = time.time()-t0
+    assert np.array_equal(back, frames[:n]), 'Frames did not survive the round trip with {}.'.format(codec)
+    os.remove(path)
+    mb = frames[:n].nbytes/1e6
+    return mb/t_write, mb/t_read, frames[:n].nbytes/float(stored)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('path', help='recorded movie file (*_cams.h5)')
+    parser.add_argument('--cam', type=int, default=0, help='camera index within the file')
+    parser.add_argument('--n_frames', type=int, default=2000)
+    parser.add_argument('--chunk_frames', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(), help='compression threads')
+    args = parser.parse_args()
+
+    with h5py.File(args.path, 'r') as f:
+        frames = f['mov{}'.format(args.cam)][:args.n_frames]
+    print('{} frames of {}x{} from {}, {} compression thread(s)'.format(len(frames), frames.shape[2], frames.shape[1], args.path, args.workers))
+    if hdf5plugin is None:
+        print('hdf5plugin not installed: only gzip and lzf are available')
+
+    pool = ThreadPool(args.workers)
+    out = os.path.join(tempfile.mkdtemp(), 'codec_test.h5')
+    print('{:<12} {:>5} {:<10} {:>10} {:>10} {:>7}'.format('codec', 'level', 'filter', 'write MB/s', 'read MB/s', 'ratio'))
+    for codec,level,filter in SETTINGS:
+        if hdf5plugin is None and codec not in ['gzip','lzf']:
+            continue
+        w,r,ratio = bench(frames, codec, level, filter, args.chunk_frames, pool, out)
+        print('{:<12} {:>5} {:<10} {:>10.1f} {:>10.1f} {:>7.2f}'.format(codec, str(level), str(filter), w, r, ratio))
+    pool.close()
+
+if __name__ == '__main__':
+    main()
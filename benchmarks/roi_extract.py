@@ -0,0 +1,66 @@
+"""
+Micro-benchmark of ROI mean extraction: the full-frame dot product with a flattened int32 mask (as formerly in Session.extract and version_0), versus RoiExtractor.
+
+Uses polygonal masks of several sizes, as drawn by Session.acquire_mask, and reports the time per frame for single frames and for batches, for one ROI and for two (eye and wheel, as in version_0).
+Should be run from within the main project directory, ex.:
+    python benchmarks/roi_extract.py
+    python benchmarks/roi_extract.py --vga --batch 256
+"""
+import os, sys, timeit, argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import cv2
+from util import RoiExtractor
+
+def polygon_mask(shape, frac, offset=0.):
+    """Antialiased quadrilateral mask covering about frac of the frame, centred at offset (fraction of width) from the centre
+    """
+    y,x = shape
+    cx,cy = x*(.5+offset),y*.5
+    rx,ry = x*np.sqrt(frac)/2,y*np.sqrt(frac)/2
+    pts = np.array([[cx-rx,cy],[cx,cy-ry],[cx+rx,cy],[cx,cy+ry]], dtype=np.int32) # diamond, i.e. sparse in its bounding box
+    mask = np.zeros(shape, dtype=np.int32)
+    cv2.fillConvexPoly(mask, pts, (1,1,1), lineType=cv2.LINE_AA)
+    return mask
+
+def dot_extract(mask_flat, fr):
+    # former Session.extract
+    flat = fr.reshape((1,-1)).T
+    dp = (mask_flat.dot(flat)).T
+    return np.squeeze(dp/mask_flat.sum(axis=-1))
+
+def best(f, n):
+    return min(timeit.repeat(f, number=n, repeat=5))/n
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--vga', action='store_true', help='use 640x480 frames rather than 320x240')
+    parser.add_argument('--batch', type=int, default=64, help='frames per batch')
+    parser.add_argument('--n', type=int, default=200, help='repetitions per timing')
+    args = parser.parse_args()
+
+    shape = (480,640) if args.vga else (240,320)
+    rs = np.random.RandomState(0)
+    frames = rs.randint(0, 256, (args.batch,)+shape).astype(np.uint8)
+    fr = frames[0]
+
+    print('{}x{} frames, times in microseconds per frame'.format(shape[1], shape[0]))
+    print('{:<24}{:>12}{:>12}{:>12}{:>12}'.format('ROI', 'dot', 'extractor', 'dot batch', 'extr. batch'))
+    for frac in [0.01, 0.05, 0.2, 0.5]:
+        for n_rois in [1,2]:
+            masks = np.array([polygon_mask(shape, frac, offset) for offset in [-.2,.2][:n_rois]])
+            mask_flat = masks.reshape((n_rois,-1))
+            ex = RoiExtractor(masks[0] if n_rois==1 else masks)
+            # the former version divides integers, so under python 2 it truncates the mean
+            assert np.all(np.abs(ex(fr) - dot_extract(mask_flat, fr)) < 1)
+            assert np.all(np.abs(ex(frames) - np.array([dot_extract(mask_flat, f) for f in frames])) < 1)
+
+            t_dot = best(lambda: dot_extract(mask_flat, fr), args.n)
+            t_ex = best(lambda: ex(fr), args.n)
+            t_dot_b = best(lambda: [dot_extract(mask_flat, f) for f in frames], max(args.n//args.batch,1))/args.batch
+            t_ex_b = best(lambda: ex(frames), max(args.n//args.batch,1))/args.batch
+            label = '{:.0f}% of frame, {} ROI{}'.format(100*frac, n_rois, 's' if n_rois>1 else '')
+            print('{:<24}{:>12.1f}{:>12.1f}{:>12.1f}{:>12.1f}'.format(label, 1e6*t_dot, 1e6*t_ex, 1e6*t_dot_b, 1e6*t_ex_b))
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
 
 si_data_path = r'D:\\deverett\\eyeblink'
 scanimage_tcpip_address     = '128.112.217.150'
+
+simulate_hardware           = False # use the simulated NI845x, DAQ and cameras (see hardware/simulated.py), ex. for load tests without the hardware
@@ -133,7 +133,7 @@ class Controller:
         # plots
         try:
             aq = self.session.ar.get_accum()
-            self.view.set_live_data((None,aq), (None,self.session.eyelid_buffer))
+            self.view.set_live_data((None,aq), self.session.eyelid_buffer)
         except Queue.Empty:
             pass
 
@@ -151,7 +151,7 @@ class Controller:
         if self.session.past_flag != False:
             cs,us = self.session.past_flag
             self.session.past_flag = False
-            self.view.set_past_data(self.session.eyelid_buffer_ts,self.session.eyelid_buffer,cs,us)
+            self.view.set_past_data(self.session.eyelid_buffer,cs,us)
 
         # pauses
         if self.session.paused:
@@ -212,7 +212,9 @@ class Controller:
                     else:
                         cont = False
 
-            #self.view.setup_axlive()
+            self.view.set_sample_rates(self.session.ar.daq_sample_rate, self.session.cam_frame_rate)
+            self.view.setup_axlive()
+            self.view.update_thresh()
             self.view.SetTitle('Subject {}'.format(sub_name))
             
             _,im = self.session.cam.get()
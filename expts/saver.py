@@ -2,7 +2,7 @@ import sys, os, threading, h5py, json, warnings, tables, logging, Queue
 import multiprocessing as mp
 import numpy as np
 import pandas as pd
-from util import now,now2
+from util import now,now2,ClockSync
 import config
 from routines import add_to_saver_buffer
 
@@ -15,7 +15,7 @@ class Saver(mp.Process):
 
         # Sync
         self.sync_flag = sync_flag
-        self.sync_val = mp.Value('d', 0)
+        self.clock_sync = ClockSync(sync_flag)
 
         # Static instance properties
         self.subj = subj
@@ -39,8 +39,7 @@ class Saver(mp.Process):
         add_to_saver_buffer(self.buf, *args, **kwargs)
         
     def run(self):
-        while not self.sync_flag.value:
-            self.sync_val.value = now()
+        self.clock_sync.wait()
 
         # Externally inaccessible instance-specific structures
         self.f = pd.HDFStore(self.data_file, mode='a')
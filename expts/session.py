@@ -2,14 +2,18 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as pl
 import time, threading, os, logging, json, multiprocessing, cv2
-from hardware import AnalogReader, PSEye, NI845x
+from hardware import AnalogReader, PSEye, Stimulator, compile_timeline
 from saver import Saver
-from util import now, now2
+from util import now, now2, Waiter, RingBuffer, sync_clocks
 from settings.constants import *
 pjoin = os.path.join
 
 class Session(object):
 
+    # trial-initiation states, see run_trials()
+    STATE_ITI, STATE_READY, STATE_TRIAL = 0,1,2
+    POLL = 0.1 # maximum time (s) between checks of flags set by the GUI (pause, override, kill)
+
     def __init__(self, session_params, ax_interactive=None):
         # incorporate kwargs
         self.params = session_params
@@ -26,8 +30,8 @@ class Session(object):
         # hardware
         self.cam = PSEye(sync_flag=self.sync_flag, **self.cam_params)
         self.ar = AnalogReader(saver_obj_buffer=self.saver.buf, sync_flag=self.sync_flag, **self.ar_params)
-        # communication
-        self.ni = NI845x(i2c_on=self.imaging)
+        # communication: the NI845x is owned by the stimulator process, which plays stimulus timelines and forwards other writes
+        self.ni = Stimulator(i2c_on=self.imaging, sync_flag=self.sync_flag)
 
         # interactivity
         self.ax_interactive = ax_interactive
@@ -39,7 +43,10 @@ class Session(object):
         self.on = False
         self.session_complete = False
         self.session_kill = False
-        self.trial_flag = False
+        self.state = self.STATE_ITI
+        self.wake = threading.Event() # set by new eyelid samples
+        self.waiter = Waiter() # trial thread only
+        self.puff_waiter = Waiter() # GUI thread (dummy_puff); a Waiter's margin and overshoots are not thread-safe
         self.trial_on = 0
         self.trial_off = 0
         self.trial_idx = -1
@@ -47,17 +54,20 @@ class Session(object):
         self.paused = False
         self.deliver_override = False
         self.roi_pts = None
-        self.eyelid_buffer = np.zeros(self.eyelid_buffer_size)-1
-        self.eyelid_buffer_ts = np.zeros(self.eyelid_buffer_size)-1
+        self.cam_frame_rate = float(self.cam.frame_rate[self.cam.query_idx]) # of the eyelid trace
+        self.eyelid_buffer_size = int(round(self.eyelid_buffer_dur * self.cam_frame_rate))
+        self.eyelid_window_size = max(int(round(self.eyelid_window * self.cam_frame_rate)), 1)
+        self.eyelid_buffer = RingBuffer(self.eyelid_buffer_size, shape=(2,), fill=-1) # [ts (this process's now() clock), eyelid] per frame
         self.past_flag = False
         
-        # sync
-        self.sync_flag.value = True #trigger all processes to get time
-        self.sync_val = now() #get this process's time
-        procs = dict(saver=self.saver, cam=self.cam.pseye, ar=self.ar)
-        sync_vals = {o:procs[o].sync_val.value for o in procs} #collect all process times
+        # sync: once all processes are waiting on the flag, set it and collect their times
+        procs = dict(saver=self.saver, cam=self.cam.pseye, ar=self.ar, stim=self.ni)
+        self.sync_val,sync_vals = sync_clocks(self.sync_flag, procs)
         sync_vals['session'] = self.sync_val
         self.sync_to_save.put(sync_vals)
+        self.cam_clock_offset = sync_vals['cam'] - self.sync_val # converts this process's times to those of the camera timestamps
+        self.stim_clock_offset = sync_vals['stim'] - self.sync_val # likewise for the stimulator
+        self.ni.wait_ready() # raises here if the NI845x could not be opened
         
         # more runtime, anything that must occur after sync
         _,self.im = self.cam.get()
@@ -82,6 +92,8 @@ class Session(object):
         if self.name is None:
             self.name = pd.datetime.now()
         self.cam_params.update(dict(save_name=pjoin(self.subj.subj_dir, self.name_as_str()+'_cams.h5')))
+        # for preallocating the movie; one pass through the cycle is only a lower bound, as ITIs also wait on the eyelid and motion criteria
+        self.cam_params.update(dict(expected_duration=self.params.get('expected_duration', len(self.cycle)*(self.trial_duration+self.min_iti))))
 
     def pause(self, val):
         self.paused = val
@@ -104,10 +116,8 @@ class Session(object):
             self.ni.write_dio(LINE_SI_OFF, 0)
 
     def wait(self, dur, t0=None):
-        if t0 is None:
-            t0 = now()
-        while now()-t0 < dur:
-            pass
+        # sleeps, then spins only for the last fraction of a ms; see util.Waiter. For the trial thread only
+        return self.waiter.wait(dur, t0=t0)
 
     def next_stim_type(self, inc=True):
         st = self.cycle[self.stim_cycle_idx]
@@ -121,88 +131,79 @@ class Session(object):
     def current_stim_state(self):
         return STIM_TYPES[self.cycle[self.stim_cycle_idx]]
         
-    def deliver_trial(self):
-        while self.on:
-            if self.trial_flag:
+    def deliver_trial(self, trig_ts):
+        """Run one trial
 
-                # prepare trial
-                self.trial_idx += 1
-                self.trial_on = now()
-                self.cam.set_flush(False)
-                kind = self.next_stim_type()
-           
-                # deilver trial
-                self.wait(self.intro)
-                cs_time,us_time = self.send_stim(kind)
-                
-                # replay
-                self.wait(self.display_lag)
-                self.past_flag = [cs_time[1], us_time[1]]
-                
-                # finish trial
-                self.wait(self.trial_duration, t0=self.trial_on)
-                self.trial_off = now()
+        Parameters
+        ----------
+        trig_ts : float
+            time (now clock) of the camera frame that satisfied the trial criteria, or of the manual override
+        """
+        # prepare trial
+        self.trial_idx += 1
+        self.trial_on = now()
+        self.cam.set_flush(False)
+        kind = self.next_stim_type()
+   
+        # deilver trial (the stimulator waits out the intro)
+        cs_time,us_time = self.send_stim(kind, t0=self.trial_on+self.intro)
+        
+        # replay
+        self.wait(self.display_lag)
+        self.past_flag = [cs_time[0], us_time[0]]
+        
+        # finish trial
+        self.wait(self.trial_duration, t0=self.trial_on)
+        self.trial_off = now()
 
-                # save trial info
-                self.cam.set_flush(True)
-                
-                trial_dict = dict(\
-                start   = self.trial_on,\
-                end     = self.trial_off,\
-                cs_ts0  = cs_time[0],\
-                cs_ts1  = cs_time[1],\
-                us_ts0  = us_time[0],\
-                us_ts1  = us_time[1],\
-                kind    = kind,\
-                idx     = self.trial_idx,\
-                )
-                self.saver.write('trials',trial_dict)
-                
-                self.trial_flag = False
-                self.trial_on = False
+        # save trial info
+        self.cam.set_flush(True)
+        self.cam.mark_trial(self.trial_idx, self.trial_on+self.cam_clock_offset, self.trial_off+self.cam_clock_offset)
+        
+        first_stim = min(t[0] for t in [cs_time,us_time] if t[0] != -1)
+        overshoot = self.waiter.pop_overshoots()
+        trial_dict = dict(\
+        start   = self.trial_on,\
+        end     = self.trial_off,\
+        cs_ts0  = cs_time[0],\
+        cs_ts1  = cs_time[1],\
+        us_ts0  = us_time[0],\
+        us_ts1  = us_time[1],\
+        kind    = kind,\
+        idx     = self.trial_idx,\
+        trig_ts = trig_ts,\
+        decision_latency = self.trial_on-trig_ts,\
+        trig_latency = first_stim-trig_ts,\
+        stim_lateness_max = np.max(self.stim_lateness),\
+        wait_overshoot_mean = np.mean(overshoot),\
+        wait_overshoot_max = np.max(overshoot),\
+        )
+        self.saver.write('trials',trial_dict)
+        
+        self.trial_on = False
     
     def dummy_puff(self):
         self.ni.write_dio(LINE_US, 1)
-        self.wait(self.us_dur)
+        self.puff_waiter.wait(self.us_dur)
         self.ni.write_dio(LINE_US, 0)
+        self.puff_waiter.pop_overshoots() # not part of any trial's stats
     def dummy_light(self, state):
         self.ni.write_dio(LINE_CS, state)
-    def send_stim(self, kind):
-        if kind == CS:
-            t = (now(), now2())
-            self.ni.write_i2c('CS_ON')
-            self.ni.write_dio(LINE_CS, 1)
-            self.wait(self.cs_dur)
-            self.ni.write_i2c('CS_OFF')
-            self.ni.write_dio(LINE_CS, 0)
-            stim_time = [t,(-1,-1)]
-
-        elif kind == US:
-            self.wait(self.cs_dur) # for trial continuity
-            t = (now(), now2())
-            self.ni.write_i2c('US_ON')
-            self.ni.write_dio(LINE_US, 1)
-            self.wait(self.us_dur)
-            self.ni.write_i2c('US_OFF')
-            self.ni.write_dio(LINE_US, 0)
-            stim_time = [(-1,-1),t]
-
-        elif kind == CSUS:
-            t_cs = (now(), now2())
-            self.ni.write_i2c('CS_ON')
-            self.ni.write_dio(LINE_CS, 1)
-            self.wait(self.csus_gap)
-            t_us = (now(), now2())
-            self.ni.write_i2c('US_ON')
-            self.ni.write_dio(LINE_US, 1)
-            self.wait(self.us_dur) # assumes US ends before CS does
-            self.ni.write_i2c('US_OFF')
-            self.ni.write_dio(LINE_US, 0)
-            self.wait(self.cs_dur, t0=t_cs[0])
-            self.ni.write_i2c('CS_OFF')
-            self.ni.write_dio(LINE_CS, 0)
-            stim_time = [t_cs,t_us]
+    def send_stim(self, kind, t0=None):
+        # the schedule is compiled into a timeline and played by the stimulator process, starting at t0 (default: now)
+        if t0 is None:
+            t0 = now()
+        events = compile_timeline(kind, cs_dur=self.cs_dur, us_dur=self.us_dur, csus_gap=self.csus_gap)
+        times = self.ni.play(events, t0+self.stim_clock_offset)
+        times[:,0] -= self.stim_clock_offset
 
+        stim_time = [(-1,-1),(-1,-1)]
+        for (offset,i2c,line,val),t in zip(events, times):
+            if i2c == 'CS_ON':
+                stim_time[0] = tuple(t)
+            elif i2c == 'US_ON':
+                stim_time[1] = tuple(t)
+        self.stim_lateness = times[:,0] - (t0+np.array([e[0] for e in events])) # per event, relative to schedule
         return stim_time
 
     def acquire_mask(self):
@@ -215,7 +216,8 @@ class Session(object):
         mask_eye = np.zeros([y,x], dtype=np.int32)
         cv2.fillConvexPoly(mask_eye, pts_eye, (1,1,1), lineType=cv2.LINE_AA)
         self.mask = mask_eye
-        self.mask_flat = self.mask.reshape((1,-1))
+        self.cam.set_roi(self.mask)
+        self.cam.set_crop(self.mask)
         self.saver.write('mask{}'.format(self.mask_idx), self.mask)
         logging.info('New mask set.')
         
@@ -230,56 +232,78 @@ class Session(object):
             self.start_acq()
         
             # main loop
-            threading.Thread(target=self.deliver_trial).start()
             threading.Thread(target=self.update_eyelid).start()
-            while True:
-
-                if self.trial_on or self.paused:
-                    continue
-
-                if self.session_kill:
-                    break
-                
-                moving = self.determine_motion()
-                eyelid = self.determine_eyelid()
-                
-                if self.deliver_override or ((now()-self.trial_off>self.min_iti) and (not moving) and (eyelid)):
-                    self.trial_flag = True
-                    self.deliver_override = False
+            self.run_trials()
 
             self.end()
 
         except:
             logging.error('Session has encountered an error!')
             raise
+    def run_trials(self):
+        """Trial-initiation state machine, returning when the session is killed
+
+        STATE_ITI: sleeps until min_iti has elapsed since the last trial
+        STATE_READY: wakes on each new eyelid sample (and at least every POLL s), and starts a trial once the animal is not moving and the eyelid criterion is met
+        STATE_TRIAL: the trial runs in this thread, see deliver_trial
+
+        A manual override (deliver_override) starts a trial from either waiting state, and pausing holds off new trials.
+        Each trial records the time of the frame that triggered it, and the latencies from that frame to the start of the trial and to the first stimulus (which includes the intro period), in the trials table.
+        """
+        while not self.session_kill:
+            self.wake.clear()
+
+            if self.paused:
+                time.sleep(self.POLL)
+                continue
+            if self.deliver_override:
+                self.deliver_override = False
+                self.state = self.STATE_TRIAL
+                self.deliver_trial(trig_ts=now())
+                self.state = self.STATE_ITI
+                continue
+
+            if self.state == self.STATE_ITI:
+                iti_left = self.min_iti - (now()-self.trial_off)
+                if iti_left > 0:
+                    time.sleep(min(iti_left, self.POLL))
+                else:
+                    self.state = self.STATE_READY
+
+            elif self.state == self.STATE_READY:
+                moving = self.determine_motion()
+                eyelid,trig_ts = self.determine_eyelid()
+                if eyelid and not moving:
+                    self.state = self.STATE_TRIAL
+                    self.deliver_trial(trig_ts=trig_ts)
+                    self.state = self.STATE_ITI
+                else:
+                    self.wake.wait(self.POLL)
+
     def determine_eyelid(self):
-        return np.mean(self.eyelid_buffer[-self.eyelid_window:]) < self.eyelid_thresh
+        """Whether the eyelid criterion is met, and the time (now clock) of the most recent frame considered
+        """
+        window = self.eyelid_buffer.snapshot(self.eyelid_window_size)
+        return window[:,1].mean() < self.eyelid_thresh, window[-1,0]
     def update_eyelid(self):
+        # the eyelid trace is computed from every frame in the camera process; this collects it, and the latest frame for display
+        seq = 0
         while self.on:
-            imts,im = self.cam.get()
-            if im is None:
-                continue
-            self.im = im
-            roi_data = self.extract(self.im)
-            self.eyelid_buffer = np.roll(self.eyelid_buffer, -1)
-            self.eyelid_buffer_ts = np.roll(self.eyelid_buffer_ts, -1)
-            self.eyelid_buffer[-1] = roi_data
-            self.eyelid_buffer_ts[-1] = imts
-    def extract(self, fr):
-        if fr is None:
-            return 0
-        flat = fr.reshape((1,-1)).T
-        dp = (self.mask_flat.dot(flat)).T
-        return np.squeeze(dp/self.mask_flat.sum(axis=-1))
+            seq,samples = self.cam.get_roi_trace(since=seq, timeout=0.1)
+            if len(samples):
+                self.eyelid_buffer.extend(np.column_stack([samples[:,0]-self.cam_clock_offset, samples[:,2]])) # [ts, eyelid], the camera's high-resolution ts converted to this process's clock
+                self.wake.set()
+            imts,im = self.cam.get(new_only=True)
+            if im is not None:
+                self.im = im
     def determine_motion(self):
+        # movement over the AnalogReader's movement window, as of its latest block; read from shared memory, with no side effect
         return self.ar.moving
    
     def end(self):
         self.on = False
         self.stop_acq()
-        to_end = [self.ar, self.cam]
-        if self.imaging:
-            to_end.append(self.ni)
+        to_end = [self.ar, self.cam, self.ni]
         for te in to_end:
             te.end()
             time.sleep(0.100)
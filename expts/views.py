@@ -2,6 +2,7 @@ import numpy as np
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg
 import logging, wx
+from util import RingBuffer
 
 class RedirectText(object):
     def __init__(self, text_ctrl):
@@ -15,8 +16,9 @@ class View(wx.Frame):
         wx.Frame.__init__(self, parent, title="Eyeblink Experiment Control", size=size)
         self.Center()
         
-        self.n_live_show = [1200,90]
-        self.n_past_show = 40
+        self.live_show = [2.4, 6.] # s of analog trace and of eyelid trace, see set_sample_rates
+        self.past_show = 2.67 # s of eyelid trace
+        self.set_sample_rates(500., 60.)
         
         # Leftmost panel
         self.panel_left_sizer = wx.BoxSizer(wx.VERTICAL)
@@ -201,8 +203,14 @@ class View(wx.Frame):
         val = val or self.slider.GetValue()
         self.thresh_handle.set_ydata(val*np.ones(self.n_live_show[1]))
         self.ax_live2.figure.canvas.draw()
+    def set_sample_rates(self, ar_rate, cam_rate):
+        # converts the plotted durations into samples, for the analog reader's rate and the queried camera's frame rate; call setup_axlive after
+        self.n_live_show = [int(round(self.live_show[0]*ar_rate)), int(round(self.live_show[1]*cam_rate))]
+        self.n_past_show = int(round(self.past_show*cam_rate))
     def setup_axlive(self):
         self.ax_live.clear()
+        self.ax_live2.clear()
+        self.ax_past.clear()
         self.live_data_handles = [ax.plot(np.zeros(n))[0] for ax,n in zip([self.ax_live,self.ax_live2], self.n_live_show)]
         self.ax_live.set_ylim([-.9,10.1])
         self.ax_live.set_xlim([0,self.n_live_show[0]])
@@ -215,15 +223,19 @@ class View(wx.Frame):
         self.pastv1, = self.ax_past.plot([0,0], [0,255], 'k--')
         self.pastv2, = self.ax_past.plot([5,5], [0,255], 'm--')
     def set_live_data(self, *args):
+        # each arg is (x,y), with x None to plot against sample index, or a RingBuffer whose last column is plotted
         for i,data,line in zip(np.arange(len(args)),args,self.live_data_handles):
+            if isinstance(data, RingBuffer):
+                data = (None, data.snapshot(self.n_live_show[i])[...,-1])
             y = np.squeeze(data[1])
             line.set_ydata(y[-self.n_live_show[i]:])
             if data[0] is not None:
                 line.set_xdata(data[0][-self.n_live_show[i]:])
         self.fig_live.canvas.draw()
-    def set_past_data(self, datax, datay, vline1, vline2):
-        self.past_data.set_ydata(datay[-self.n_past_show:])
-        datax = datax[-self.n_past_show:]
+    def set_past_data(self, data, vline1, vline2):
+        # data : RingBuffer of [x,y] rows
+        datax,datay = data.snapshot(self.n_past_show).T
+        self.past_data.set_ydata(datay)
         self.past_data.set_xdata(datax)
         #self.ax_past.set_ylim([np.min(datay), np.max(datay)])
         self.pastv1.set_xdata([vline1,vline1])
@@ -1,6 +1,11 @@
 from analog_reader import AnalogReader
 from cameras import default_cam_params, PSEye
-from ni845x import NI845x
+import config
+if config.simulate_hardware:
+    from simulated import SimulatedNI845x as NI845x
+else:
+    from ni845x import NI845x
+from stimulator import Stimulator, compile_timeline
 from settings.constants import *
 
 def dummy_puff():
@@ -1,10 +1,137 @@
 import time, sys, threading, logging, copy, Queue, warnings
 import multiprocessing as mp
 import numpy as np
-import pylab as pl
-from daq import DAQIn
+import config
 from expts.routines import add_to_saver_buffer
-from util import now,now2
+from util import now,now2,ClockSync,SharedViews
+
+class MovementDetector(object):
+    """Streaming count of movement events in a sliding window of samples
+
+    An event is a difference of at least magnitude between consecutive samples. The events of the last window-1 differences (i.e. within the last window samples) are kept in a ring, so that each new block only adds its own events and subtracts those that leave the window: the cost per block depends on the block size, not the window.
+
+    Parameters
+    ----------
+    window : int
+        number of samples in the window
+    thresh : float
+        movement is detected when the window holds more than thresh events
+    magnitude : float
+        minimum absolute difference between consecutive samples that counts as an event
+    """
+    def __init__(self, window, thresh, magnitude):
+        self.thresh = thresh
+        self.magnitude = magnitude
+        self._events = np.zeros(max(window-1, 0), dtype=np.uint8) # one per difference in the window
+        self._i = 0 # position of the next write in _events
+        self.count = 0 # events in _events
+        self._last = None # last sample seen, for the first difference of the next block
+
+    def update(self, samples):
+        """Add a block of new samples, oldest first, and return whether movement is detected
+        """
+        samples = np.asarray(samples, dtype=float)
+        diffs = np.diff(samples if self._last is None else np.concatenate([[self._last], samples]))
+        self._last = samples[-1]
+        n = len(self._events)
+        if n == 0:
+            return self.count > self.thresh
+        new = (np.abs(diffs) >= self.magnitude).astype(np.uint8)[-n:]
+        idx = (self._i + np.arange(len(new))) % n
+        self.count += int(new.sum()) - int(self._events[idx].sum())
+        self._events[idx] = new
+        self._i = (self._i + len(new)) % n
+        return self.count > self.thresh
+
+class SharedAccumulator(SharedViews):
+    """A ring of the most recent samples of several channels, with their timestamps, in shared memory, written by one process and read by others without locking
+
+    Writes are guarded by a sequence lock: the writer increments seq before and after each write, so seq is odd during a write, and a reader whose seq is unchanged (and even) across its read knows it saw no write.
+    Each write only copies the new samples, at the write index.
+
+    Parameters
+    ----------
+    n_channels : int
+        number of channels
+    capacity : int
+        number of samples held per channel
+    """
+    _VIEWS = ['_data', '_ts']
+
+    def __init__(self, n_channels, capacity):
+        self.n_channels = n_channels
+        self.capacity = capacity
+        self.data_q = mp.RawArray('d', n_channels*capacity)
+        self.ts_q = mp.RawArray('d', capacity)
+        self.idx = mp.RawValue('L', 0) # total samples written
+        self.seq = mp.RawValue('L', 0) # odd while a write is in progress
+        self._make_views()
+
+    def _make_views(self):
+        self._data = np.frombuffer(self.data_q).reshape([self.n_channels, self.capacity])
+        self._ts = np.frombuffer(self.ts_q)
+
+    def write(self, data, ts):
+        """Append samples (writer process only)
+
+        Parameters
+        ----------
+        data : np.ndarray
+            (n_channels, n) new samples, oldest first
+        ts : float or np.ndarray
+            timestamp of all samples, or (n,) timestamps
+        """
+        n = data.shape[1]
+        c = self.capacity
+        ts = np.broadcast_to(ts, (n,))[-c:]
+        data = data[:,-c:]
+        m = data.shape[1]
+        i = (self.idx.value + n-m) % c # skipping samples that would be overwritten
+        k = min(m, c-i) # samples that fit before wrapping
+        self.seq.value += 1
+        self._data[:,i:i+k] = data[:,:k]
+        self._ts[i:i+k] = ts[:k]
+        self._data[:,:m-k] = data[:,k:]
+        self._ts[:m-k] = ts[k:]
+        self.idx.value += n
+        self.seq.value += 1
+
+    def views(self):
+        """Zero-copy access to the ring
+        
+        Returns
+        -------
+        seq : int
+            pass to changed() after using the views, to check that they were not written to meanwhile
+        (older, newer) : views of the samples, (n_channels, *), which concatenated along axis 1 give all samples oldest first
+        (ts_older, ts_newer) : the matching views of the timestamps
+        """
+        while True:
+            seq = self.seq.value
+            if not seq % 2:
+                break
+        i = self.idx.value % self.capacity
+        return seq, (self._data[:,i:], self._data[:,:i]), (self._ts[i:], self._ts[:i])
+
+    def changed(self, seq):
+        """Whether the ring was (or is being) written to since views() returned seq
+        """
+        return self.seq.value != seq
+
+    def snapshot(self):
+        """A consistent copy of all samples, oldest first
+
+        Returns
+        -------
+        data : (n_channels, capacity) np.ndarray
+        ts : (capacity,) np.ndarray
+        """
+        while True:
+            seq,(d0,d1),(t0,t1) = self.views()
+            data = np.concatenate([d0,d1], axis=1)
+            ts = np.concatenate([t0,t1])
+            if not self.changed(seq):
+                return data, ts
 
 class AnalogReader(mp.Process):
     """
@@ -13,7 +140,7 @@ class AnalogReader(mp.Process):
     """
 
     READ_BUF_SIZE = 10
-    ACCUM_SIZE = 2000 # Must be multiple of READ_BUF_SIZE
+    ACCUM_SIZE = 2000
 
     def __init__(self, ports=['ai0'], portnames=['hall'], runtime_ports=[0], movement_port=0, movement_window=1.0, movement_thresh=3., movement_magnitude=.5, daq_sample_rate=500., save_buffer_size=8000, saver_obj_buffer=None, sync_flag=None, **daq_kwargs):
         super(AnalogReader, self).__init__()
@@ -21,7 +148,7 @@ class AnalogReader(mp.Process):
         
         # Sync
         self.sync_flag = sync_flag
-        self.sync_val = mp.Value('d', 0)
+        self.clock_sync = ClockSync(sync_flag)
 
         # Data acquisition parameters
         self.ports = ports
@@ -36,21 +163,15 @@ class AnalogReader(mp.Process):
         self.movement_magnitude = movement_magnitude
 
         # data containers
-        self.accum = np.zeros((len(self.ports),self.ACCUM_SIZE))
-        self.accum_ts = []
-        self.accum_q = mp.Array('d', len(self.runtime_ports)*self.ACCUM_SIZE)
+        self.accum = SharedAccumulator(len(self.runtime_ports), self.ACCUM_SIZE) # recent samples of the runtime ports, see get_accum
 
         # processing containers
-        self.moving_ = mp.Value('b', False)
-        
-        # threading structures
-        self.logic_lock = mp.Lock()
+        self.movement_q = mp.RawArray('d', 3) # [moving, ts of the block it was determined from, ts of the last block in which it was detected], see movement
 
         # saving
         self._saving = mp.Value('b', False)
         self.save_buffer_size = save_buffer_size
-        self.n_added_to_save_buffer = 0
-        self.save_buffer = np.zeros([len(self.ports),self.save_buffer_size])
+        self.save_buffer = np.zeros([len(self.ports),self.save_buffer_size]) # filled from the start while saving, and handed to the saver whenever full
         self.save_buffer_ts = np.zeros([2,self.save_buffer_size])
         self.saver_obj_buffer = saver_obj_buffer
 
@@ -58,18 +179,33 @@ class AnalogReader(mp.Process):
         self._kill_flag = mp.Value('b', False)
         self.start()
 
+    @property
+    def movement(self):
+        """(moving, ts, last_moving_ts): whether movement is currently detected, as of the block at ts, and the ts of the last block in which it was detected (0 if never)
+
+        Read without locking: the writer updates last_moving_ts, then ts, then moving, so a reader never sees movement without its last_moving_ts.
+        """
+        moving,ts,last_moving_ts = self.movement_q[:]
+        return bool(moving), ts, last_moving_ts
+
     @property
     def moving(self):
-        with self.logic_lock:
-            temp = self.moving_.value
-            self.moving_.value = False
-        return temp
+        return self.movement[0]
 
     def run(self):
-        while not self.sync_flag.value:
-            self.sync_val.value = now()
+        self.clock_sync.wait()
 
+        # the DAQ driver is only imported here, so that this module (and the hardware package) can be imported where it is not installed
+        if config.simulate_hardware:
+            from simulated import SimulatedDAQIn as DAQIn
+        else:
+            from daq import DAQIn
         self.daq = DAQIn(ports=self.ports, read_buffer_size=self.READ_BUF_SIZE, sample_rate=self.daq_sample_rate, **self.daq_kwargs)
+
+        # all buffers are rings or chunks with write indices, so the cost per block does not depend on their size
+        self.movement_detector = MovementDetector(self.movement_window, self.movement_thresh, self.movement_magnitude)
+        n_save = 0 # samples in the current save chunk
+        was_saving = False
         
         while self._on.value:
             
@@ -82,8 +218,8 @@ class AnalogReader(mp.Process):
             
                 if self._kill_flag.value:
                    # final dump:
-                    if self.n_added_to_save_buffer:
-                        add_to_saver_buffer(self.saver_obj_buffer, 'analogreader', self.save_buffer[:,-self.n_added_to_save_buffer:].T.copy(), ts=self.save_buffer_ts[0,-self.n_added_to_save_buffer:].copy(), ts2=self.save_buffer_ts[1,-self.n_added_to_save_buffer:].copy(), columns=self.portnames)
+                    if n_save:
+                        add_to_saver_buffer(self.saver_obj_buffer, 'analogreader', self.save_buffer[:,:n_save].T.copy(), ts=self.save_buffer_ts[0,:n_save].copy(), ts2=self.save_buffer_ts[1,:n_save].copy(), columns=self.portnames)
                     self._on.value = False
                     
                 continue
@@ -93,41 +229,48 @@ class AnalogReader(mp.Process):
 
             dat = dat.reshape((len(self.ports),self.READ_BUF_SIZE))
             
-            # update save buffer with new data
-            self.save_buffer = np.roll(self.save_buffer, -self.READ_BUF_SIZE, axis=1)
-            self.save_buffer_ts = np.roll(self.save_buffer_ts, -self.READ_BUF_SIZE, axis=1)
-            self.save_buffer[:,-self.READ_BUF_SIZE:] = dat[:,:]
-            self.save_buffer_ts[:,-self.READ_BUF_SIZE:] = np.array([ts,ts2])[:,None]
-            if self._saving.value:
-                self.n_added_to_save_buffer += self.READ_BUF_SIZE
-                dump = self.n_added_to_save_buffer >= self.save_buffer_size
-            else:
-                dump = False
-
-            # update accumulator (runtime analysis buffer)
-            self.accum = np.roll(self.accum, -self.READ_BUF_SIZE, axis=1)
-            self.accum[:,-self.READ_BUF_SIZE:] = dat[:,:]
-            self.accum_ts += [ts]*self.READ_BUF_SIZE
-            self.accum_q[:] = (self.accum.copy()[self.runtime_ports]).ravel()
+            # update save chunk with new data, handing it to the saver whenever full; a new chunk is begun when saving is turned on
+            saving = self._saving.value
+            if saving and not was_saving:
+                n_save = 0
+            was_saving = saving
+            i = 0
+            while saving and i < self.READ_BUF_SIZE:
+                k = min(self.READ_BUF_SIZE-i, self.save_buffer_size-n_save)
+                self.save_buffer[:,n_save:n_save+k] = dat[:,i:i+k]
+                self.save_buffer_ts[:,n_save:n_save+k] = np.array([ts,ts2])[:,None]
+                n_save += k
+                i += k
+                if n_save == self.save_buffer_size:
+                    add_to_saver_buffer(self.saver_obj_buffer, 'analogreader', self.save_buffer.T.copy(), ts=self.save_buffer_ts[0,:].copy(), ts2=self.save_buffer_ts[1,:].copy(), columns=self.portnames)
+                    n_save = 0
+
+            # update accumulator (runtime analysis buffer, shared)
+            self.accum.write(dat[self.runtime_ports], ts)
             
             # update experimental logic
-            with self.logic_lock:
-                
-                _tmp_moving = self.accum[self.runtime_ports[self.movement_port], -self.movement_window:]
-                nevents = np.sum(np.abs(np.diff(_tmp_moving)) >= self.movement_magnitude) 
-                self.moving_.value = nevents > self.movement_thresh
-
-            if dump and self._saving.value:
-                if self.n_added_to_save_buffer > self.save_buffer_size:
-                    warnings.warn('DAQ save buffer size larger than expected: some samples were missed. Size={}, Expected={}'.format(self.n_added_to_save_buffer,self.save_buffer_size))
-                add_to_saver_buffer(self.saver_obj_buffer, 'analogreader', self.save_buffer.T.copy(), ts=self.save_buffer_ts[0,:].copy(), ts2=self.save_buffer_ts[1,:].copy(), columns=self.portnames)
-                self.n_added_to_save_buffer = 0
+            moving = self.movement_detector.update(dat[self.runtime_ports[self.movement_port]])
+            if moving:
+                self.movement_q[2] = ts
+            self.movement_q[1] = ts
+            self.movement_q[0] = moving
     
-    def get_accum(self):
-        return np.frombuffer(self.accum_q.get_obj()).reshape([len(self.runtime_ports), self.ACCUM_SIZE])
+    def get_accum(self, with_ts=False):
+        """Recent samples of the runtime ports, (n_runtime_ports, ACCUM_SIZE), oldest first, consistent with respect to the reader's writes
+
+        If with_ts, also returns their timestamps, (ACCUM_SIZE,)
+        """
+        data,ts = self.accum.snapshot()
+        if with_ts:
+            return data,ts
+        return data
+
+    def get_accum_views(self):
+        """Zero-copy variant of get_accum, see SharedAccumulator.views; check self.accum.changed(seq) after use
+        """
+        return self.accum.views()
     
     def begin_saving(self):
-        self.n_added_to_save_buffer = 0
         self._saving.value = True
 
     def end(self):
@@ -136,13 +279,15 @@ class AnalogReader(mp.Process):
             pass
 
 if __name__ == '__main__':
+    import pylab as pl
     pl.figure()
     lr = AnalogReader()
     lr.start()
-    show_lines = pl.plot(lr.accum.T)
+    show_lines = pl.plot(lr.get_accum().T)
     pl.ylim([-.1,10.1])
     while True:
+        accum = lr.get_accum()
         for idx,sl in enumerate(show_lines):
-            sl.set_ydata(lr.accum[idx])
+            sl.set_ydata(accum[idx])
         pl.draw()
         pl.pause(0.001)
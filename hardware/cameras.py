@@ -1,10 +1,22 @@
 # imports
 from ctypes import c_int, c_void_p, c_char_p, c_float, c_uint16, c_uint32, c_uint8
 from ctypes import Structure, byref
-import os, time, json, sys, warnings, ctypes, logging, threading, h5py, Queue
+import os, time, json, sys, warnings, ctypes, logging, threading, h5py, Queue, mmap, zlib
 import numpy as np
 import multiprocessing as mp
-from util import now,now2
+from multiprocessing.pool import ThreadPool
+from util import now,now2,RoiExtractor,ClockSync,SharedViews
+from raw_movie import RawMovieWriter, trials_name, stats_name, convert as convert_raw_movie
+
+# Optional compression libraries for movie data: hdf5plugin registers the blosc/zstd/lz4/bitshuffle filters with h5py (and is then also needed to read such files), and python-blosc lets blosc chunks be compressed outside of hdf5
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+try:
+    import blosc
+except ImportError:
+    blosc = None
 
 # CLEye driver constants
 CLEYE_CODES = dict(
@@ -54,13 +66,680 @@ def CLEyeCameraGetFrameDimensions(dll, cam):
     dll.CLEyeCameraGetFrameDimensions(cam, byref(width), byref(height))
     return width.value, height.value
 
-def mp2np(a):
-    return np.frombuffer(a.get_obj(), dtype=np.uint8)
+class FrameRing(SharedViews):
+    """A preallocated ring of frame slots in shared memory, used to pass frames between the acquisition and saving processes
+
+    Each slot holds one frame, its [ts, ts2] timestamps, its [seq, missed] counts (the camera's frame sequence number, and the number of frames the camera is estimated to have missed just before it), and the saving flag at the time it was acquired.
+    The ring supports exactly one producer and one consumer: the producer only advances write_seq, the consumer only advances read_seq, so no locking or pickling is needed.
+
+    Slots are page-aligned, so that a driver can write a frame directly into the next free slot: see claim() and commit().
+    """
+    _VIEWS = ['frames', 'ts', 'seq', 'saving']
+    PAGE_SIZE = mmap.PAGESIZE
+
+    def __init__(self, shape, n_slots=512, dtype=np.uint8, ready=None):
+        """
+        Parameters
+        ----------
+        shape : tuple of ints
+            shape of a single frame, ex. (y,x) or (y,x,4)
+        n_slots : int
+            number of frames the ring can hold before the producer must drop frames
+        dtype : numpy dtype
+            data type of frames
+        ready : multiprocessing Event
+            if supplied, set whenever a frame is committed, so that the consumer can block instead of polling (may be shared by several rings)
+        """
+        self.ready = ready
+        self.shape = tuple(shape)
+        self.n_slots = n_slots
+        self.dtype = np.dtype(dtype)
+        self.frame_nbytes = int(np.product(self.shape)) * self.dtype.itemsize
+        self.slot_stride = -(-self.frame_nbytes // self.PAGE_SIZE) * self.PAGE_SIZE # frame size rounded up to a whole page
+
+        # shared structures
+        self._frames = mp.RawArray(ctypes.c_uint8, self.n_slots*self.slot_stride + self.PAGE_SIZE)
+        self._frames_offset = -ctypes.addressof(self._frames) % self.PAGE_SIZE # same in every process, since shared blocks are mapped page-aligned
+        self._ts = mp.RawArray(ctypes.c_double, self.n_slots*2)
+        self._seq = mp.RawArray(ctypes.c_int64, self.n_slots*2)
+        self._saving = mp.RawArray(ctypes.c_uint8, self.n_slots)
+        self.write_seq = mp.RawValue('L', 0) # total frames ever committed
+        self.read_seq = mp.RawValue('L', 0) # total frames ever released
+        self.n_overflow = mp.RawValue('L', 0) # frames dropped because the ring was full
+
+        self._make_views()
+
+    def _make_views(self):
+        frame_strides = tuple(int(np.product(self.shape[i+1:]))*self.dtype.itemsize for i in range(len(self.shape)))
+        self.frames = np.ndarray((self.n_slots,)+self.shape, dtype=self.dtype, buffer=self._frames, offset=self._frames_offset, strides=(self.slot_stride,)+frame_strides)
+        self.ts = np.frombuffer(self._ts, dtype=np.float64).reshape((self.n_slots,2))
+        self.seq = np.frombuffer(self._seq, dtype=np.int64).reshape((self.n_slots,2))
+        self.saving = np.frombuffer(self._saving, dtype=np.uint8)
+
+    def __len__(self):
+        return self.write_seq.value - self.read_seq.value
+
+    def claim(self):
+        """Index of the next free slot (producer side), or None if the consumer is a full ring behind
+
+        The slot may be written in place through self.frames[i], and is then published with commit()
+        """
+        seq = self.write_seq.value
+        if seq - self.read_seq.value >= self.n_slots:
+            return None
+        return seq % self.n_slots
+
+    def commit(self, ts, saving, seq=(0,0)):
+        """Publish the slot returned by the last claim() (producer side)
+        """
+        wseq = self.write_seq.value
+        i = wseq % self.n_slots
+        self.ts[i] = ts
+        self.seq[i] = seq
+        self.saving[i] = saving
+        self.write_seq.value = wseq + 1
+        if self.ready is not None:
+            self.ready.set()
+
+    def put(self, frame, ts, saving, seq=(0,0)):
+        """Copy a frame into the next free slot (producer side)
+
+        Returns False, and counts an overflow, if the consumer is a full ring behind
+        """
+        i = self.claim()
+        if i is None:
+            self.n_overflow.value += 1
+            return False
+        self.frames[i].flat[:] = frame
+        self.commit(ts, saving, seq)
+        return True
+
+    def oldest(self):
+        """Index of the oldest unreleased slot (consumer side), or None if the ring is empty
+
+        The slot's contents remain valid until release() is called
+        """
+        seq = self.read_seq.value
+        if seq == self.write_seq.value:
+            return None
+        return seq % self.n_slots
+
+    def release(self):
+        """Hand the oldest slot back to the producer (consumer side)
+        """
+        self.read_seq.value += 1
+
+class LatestFrame(SharedViews):
+    """A two-slot shared-memory buffer holding the most recent frame of one camera, for live queries
+
+    The single writer fills the slot that is not currently published, then increments seq to publish it.
+    Readers copy the published slot and retry if seq moved in the meantime, so neither side ever locks or waits on the other.
+    """
+    _VIEWS = ['frames', 'ts']
+
+    def __init__(self, shape, dtype=np.uint8):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._frames = mp.RawArray(ctypes.c_uint8, 2*int(np.product(self.shape))*self.dtype.itemsize)
+        self._ts = mp.RawArray(ctypes.c_double, 2*2)
+        self.seq = mp.RawValue('L', 0) # number of frames published; 0 means none yet
+        self._make_views()
+
+    def _make_views(self):
+        self.frames = np.frombuffer(self._frames, dtype=self.dtype).reshape((2,)+self.shape)
+        self.ts = np.frombuffer(self._ts, dtype=np.float64).reshape((2,2))
+
+    def write(self, frame, ts):
+        """Publish a new frame (writer side)
+        """
+        seq = self.seq.value
+        i = (seq+1) % 2
+        self.frames[i].flat[:] = frame
+        self.ts[i] = ts
+        self.seq.value = seq + 1
+
+    def read(self):
+        """Return (seq, [ts,ts2], frame) for the most recently published frame, as copies
+
+        seq is 0 if nothing has been published yet
+        """
+        while True:
+            seq = self.seq.value
+            i = seq % 2
+            fr = self.frames[i].copy()
+            ts = self.ts[i].copy()
+            if self.seq.value == seq: # the writer only touches this slot after publishing another frame
+                return seq,ts,fr
+
+class RoiTrace(SharedViews):
+    """The mean intensity of a region of interest in every frame of one camera, computed in the acquisition process and published through a shared-memory ring
+
+    The mask is set from any process with set_mask(), and is picked up by the writer at its next frame. Each sample is [ts, ts2, value].
+    There is a single writer, and readers copy samples without locking, retrying if the writer has lapped the samples copied in the meantime.
+    """
+    _VIEWS = ['mask', 'samples']
+
+    def __init__(self, shape, n_slots=4096):
+        """
+        Parameters
+        ----------
+        shape : tuple of ints
+            shape of a frame, (y,x) or (y,x,channels); the mask is (y,x), and channels are averaged
+        n_slots : int
+            number of samples held
+        """
+        self.shape = tuple(shape[:2])
+        self.channel_axis = -1 if len(shape) == 3 else None
+        self.n_slots = n_slots
+        self._mask = mp.Array(ctypes.c_float, int(np.product(self.shape)))
+        self.mask_version = mp.RawValue('L', 0) # 0 means no mask set yet
+        self._samples = mp.RawArray(ctypes.c_double, self.n_slots*3)
+        self.write_seq = mp.RawValue('L', 0) # total samples ever written
+        self.ready = mp.Event() # set whenever a sample is written
+        self._version = 0 # version of the mask in use by the writer
+        self._make_views()
+
+    def _make_views(self):
+        self.mask = np.frombuffer(self._mask.get_obj(), dtype=np.float32).reshape(self.shape)
+        self.samples = np.frombuffer(self._samples, dtype=np.float64).reshape((self.n_slots,3))
+
+    def set_mask(self, mask):
+        """Set the region of interest: a (y,x) array, nonzero inside the region, whose values weight the mean
+        """
+        with self._mask.get_lock():
+            self.mask[...] = mask
+            self.mask_version.value += 1
+
+    def _load_mask(self):
+        with self._mask.get_lock():
+            self._version = self.mask_version.value
+            self._extract = RoiExtractor(self.mask.copy(), channel_axis=self.channel_axis)
+
+    def update(self, frame, ts):
+        """Compute and publish the ROI mean of a frame (writer side); does nothing until a mask has been set
+
+        Parameters
+        ----------
+        frame : np.ndarray
+            frame of self.shape, plus channels if any
+        ts : array-like
+            [ts, ts2] of the frame
+        """
+        if self.mask_version.value != self._version:
+            self._load_mask()
+        if self._version == 0:
+            return
+        value = self._extract(frame)
+        if self.channel_axis is not None:
+            value = value.mean() # colour: mean over channels
+        seq = self.write_seq.value
+        self.samples[seq % self.n_slots] = ts[0], ts[1], value
+        self.write_seq.value = seq + 1
+        self.ready.set()
+
+    def read(self, since=0):
+        """Samples written after the first `since`, oldest first, as a copy
+
+        Returns
+        -------
+        seq : int
+            total number of samples written, to pass as `since` in the next call
+        samples : np.ndarray
+            (n,3) array of [ts, ts2, value], holding at most the n_slots-1 most recent samples (the slot of the oldest one being the next to be written)
+        """
+        while True:
+            seq = self.write_seq.value
+            first = max(since, seq-self.n_slots+1, 0)
+            samples = self.samples[np.arange(first, seq) % self.n_slots]
+            if self.write_seq.value - first < self.n_slots: # none of the copied slots was (or is being) overwritten
+                return seq,samples
+
+class CameraStats(SharedViews):
+    """Counters and timings of acquisition and saving, per camera, in shared memory
+
+    Each field is written by only one process (the acquisition process or the saver) and may be read from any, without locking.
+
+    Fields
+    ------
+    captured : frames read from the camera
+    missed : frames the camera is estimated to have missed, from intervals between frames longer than the frame period
+    late : frames that arrived more than 25% late, without a frame being missed
+    saved : frames written to file
+    buffered : frames held in the saver's memory buffer, awaiting a flush
+    queue_max : largest number of frames seen waiting in the frame buffer between acquisition and saving
+    flushes : number of flushes to file
+    flush_time : total time (s) spent flushing
+    flush_time_max : longest flush (s)
+    bytes_raw : uncompressed size of the frames written
+    bytes_stored : compressed size of the frames written
+    resizes : number of dataset resizes
+    resize_time : total time (s) spent resizing datasets
+    resize_time_max : longest resize (s)
+    """
+    FIELDS = ['captured', 'missed', 'late', 'saved', 'buffered', 'queue_max', 'flushes', 'flush_time', 'flush_time_max', 'bytes_raw', 'bytes_stored', 'resizes', 'resize_time', 'resize_time_max']
+    FLUSH_BINS = [0.01, 0.03, 0.1, 0.3, 1., 3.] # upper edges (s) of the flush duration histogram bins; a final bin holds longer flushes
+    _VIEWS = ['values', 'flush_hist']
+
+    def __init__(self, n_cams):
+        self.n_cams = n_cams
+        self.idx = {f:i for i,f in enumerate(self.FIELDS)}
+        self._values = mp.RawArray(ctypes.c_double, n_cams*len(self.FIELDS))
+        self._flush_hist = mp.RawArray(ctypes.c_double, n_cams*(len(self.FLUSH_BINS)+1))
+        self._make_views()
+
+    def _make_views(self):
+        self.values = np.frombuffer(self._values, dtype=np.float64).reshape((self.n_cams,len(self.FIELDS)))
+        self.flush_hist = np.frombuffer(self._flush_hist, dtype=np.float64).reshape((self.n_cams,len(self.FLUSH_BINS)+1))
+
+    def add(self, cam, field, x=1):
+        self.values[cam, self.idx[field]] += x
+    def set(self, cam, field, x):
+        self.values[cam, self.idx[field]] = x
+    def set_max(self, cam, field, x):
+        i = self.idx[field]
+        if x > self.values[cam, i]:
+            self.values[cam, i] = x
+    def add_timing(self, cam, name, dur):
+        """Count an event named name (flush or resize) of duration dur (s)
+        """
+        self.add(cam, name+'es' if name=='flush' else name+'s')
+        self.add(cam, name+'_time', dur)
+        self.set_max(cam, name+'_time_max', dur)
+        if name == 'flush':
+            self.flush_hist[cam, np.searchsorted(self.FLUSH_BINS, dur)] += 1
+
+    def snapshot(self):
+        """Current values, as a list of dicts, one per camera, with an added compression_ratio and flush_hist (counts per bin of FLUSH_BINS)
+        """
+        snap = []
+        for cam in range(self.n_cams):
+            d = {f:float(v) for f,v in zip(self.FIELDS, self.values[cam])}
+            for f in ['captured', 'missed', 'late', 'saved', 'buffered', 'queue_max', 'flushes', 'bytes_raw', 'bytes_stored', 'resizes']:
+                d[f] = int(d[f])
+            d['compression_ratio'] = float(d['bytes_raw'])/d['bytes_stored'] if d['bytes_stored'] else None
+            d['flush_hist'] = [int(c) for c in self.flush_hist[cam]]
+            snap.append(d)
+        return snap
+
+# Output formats for colour cameras, see ColourConverter
+COLOUR_FORMATS = ['grey', 'red', 'green', 'blue', 'rgb']
+
+class ColourConverter(object):
+    """Converts the BGRA frames delivered by cameras in colour mode to the format that is buffered and saved
+
+    Formats
+    -------
+    grey : luma with ITU-R BT.601 weights in 8-bit fixed point, (y,x)
+    red, green, blue : a single channel, (y,x)
+    rgb : packed RGB without the alpha byte, (y,x,3)
+
+    Parameters
+    ----------
+    resolution : tuple of ints
+        (x,y) dimensions of frame
+    fmt : str
+        one of COLOUR_FORMATS
+    """
+    CHANNELS = dict(blue=0, green=1, red=2) # BGRA byte order
+    LUMA = (29, 150, 77) # B,G,R weights, /256
+
+    def __init__(self, resolution, fmt='grey'):
+        if fmt not in COLOUR_FORMATS:
+            raise Exception('Colour format {} not recognized, options are: {}'.format(fmt, COLOUR_FORMATS))
+        x,y = resolution
+        self.fmt = fmt
+        self.shape = (y,x,3) if fmt=='rgb' else (y,x)
+        if fmt == 'grey':
+            # preallocated 16-bit accumulators, so conversion allocates nothing per frame
+            self._acc = np.empty((y,x), dtype=np.uint16)
+            self._tmp = np.empty((y,x), dtype=np.uint16)
+
+    def __call__(self, bgra, out):
+        """Convert bgra, a (y,x,4) frame, into out, an array of self.shape
+        """
+        if self.fmt == 'grey':
+            acc,tmp = self._acc,self._tmp
+            np.multiply(bgra[...,0], self.LUMA[0], out=acc, dtype=np.uint16)
+            np.multiply(bgra[...,1], self.LUMA[1], out=tmp, dtype=np.uint16)
+            acc += tmp
+            np.multiply(bgra[...,2], self.LUMA[2], out=tmp, dtype=np.uint16)
+            acc += tmp
+            acc += 128 # round; at most 255*256+128, so no overflow
+            np.right_shift(acc, 8, out=out, casting='unsafe')
+        elif self.fmt == 'rgb':
+            out[...] = bgra[...,2::-1]
+        else:
+            out[...] = bgra[...,self.CHANNELS[self.fmt]]
+
+class CameraBackend(object):
+    """Source of frames for the acquisition process
+
+    A backend is constructed and started inside the _PSEye process, and is read by one thread per camera.
+    Subclasses implement start, read and stop; all camera parameters are given as tuples with one entry per camera.
+    """
+    def __init__(self, idx, resolution_mode, frame_rate, color_mode, cleye_params):
+        self.idx = idx
+        self.resolution_mode = resolution_mode
+        self.frame_rate = frame_rate
+        self.color_mode = color_mode
+        self.cleye_params = cleye_params
+        self.n_cams = len(self.idx)
+        self.resolution = [_PSEye.DIMENSIONS[rm] for rm in self.resolution_mode]
+
+    def start(self):
+        """Open and start all cameras
+        """
+        raise NotImplementedError()
+
+    def read(self, cam, out, timeout):
+        """Write the next frame of camera number cam (0,1,...) into the numpy array out
+
+        Parameters
+        ----------
+        cam : int
+            position of the camera in this backend's parameter tuples
+        out : np.ndarray
+            destination for the frame, of shape (y,x) or (y,x,bytes_per_pixel), usually a slot of a FrameRing
+        timeout : int
+            maximum time (ms) to wait for a frame
+
+        Returns
+        -------
+            True if a frame was written
+        """
+        raise NotImplementedError()
+
+    def stop(self):
+        """Stop and release all cameras
+        """
+        raise NotImplementedError()
+
+class CLEyeBackend(CameraBackend):
+    """PSEye cameras, through the CLEye driver
+    """
+    lib = "CLEyeMulticam.dll"
+
+    def start(self):
+        
+        # Load dynamic library
+        self.dll = ctypes.cdll.LoadLibrary(self.lib)
+        self.dll.CLEyeGetCameraUUID.restype = GUID
+        self.dll.CLEyeCameraGetFrame.argtypes = [c_void_p, c_void_p, c_int]
+        self.dll.CLEyeCreateCamera.argtypes = [GUID, c_int, c_int, c_float]
+    
+        n_cams_available = self.dll.CLEyeGetCameraCount()
+        if n_cams_available < self.n_cams:
+            warnings.warn('Fewer cameras available than requested.\n(Requested {}, {} available)'.format(self.n_cams, n_cams_available))
+   
+        self._cams = []
+        for idx,cm,rm,fr in zip(self.idx,self.color_mode,self.resolution_mode,self.frame_rate):
+            _cam = self.dll.CLEyeCreateCamera(self.dll.CLEyeGetCameraUUID(idx), cm, rm, fr)
+            if not _cam:
+                raise Exception('Camera {} failed to initialize.'.format(idx))
+            self._cams.append(_cam)
+        
+        # Confirmation of proper init
+        for c,res in zip(self._cams, self.resolution):
+            x,y = CLEyeCameraGetFrameDimensions(self.dll, c)
+            assert (x,y)==res, 'Initialized camera\'s resolution does not match requested resolution.\nRequested: {}, Discovered: {}'.format(str(res), str((x,y)))
+
+        for cleps,cam in zip(self.cleye_params, self._cams): # each camera
+            for param in cleps: # each param
+                self.dll.CLEyeSetCameraParameter(cam, CLEYE_CODES[param], cleps[param])
+
+        for c in self._cams:
+            self.dll.CLEyeCameraStart(c)
+
+        time.sleep(0.01)
+
+    def read(self, cam, out, timeout):
+        # the driver writes straight into out
+        return self.dll.CLEyeCameraGetFrame(self._cams[cam], out.ctypes.data, timeout)
+
+    def stop(self):
+        try:
+            for c in self._cams:
+                self.dll.CLEyeCameraStop(c)
+                self.dll.CLEyeDestroyCamera(c)
+        except:
+            pass
+
+class SyntheticBackend(CameraBackend):
+    """Generated frames at the requested resolution and frame rate, for running the acquisition and saving pipeline without cameras
+
+    Frames show a bright ellipse ("eye") that is periodically covered by a darker band ("eyelid"), plus noise, cycled from a precomputed bank so that generating them costs no more than a copy.
+    """
+    def __init__(self, idx, resolution_mode, frame_rate, color_mode, cleye_params, blink_period=2.0, noise=8, seed=0):
+        """
+        Parameters
+        ----------
+        blink_period : float
+            duration (s) of one eyelid closure cycle
+        noise : int
+            amplitude of uniform pixel noise
+        seed : int
+            seed for the random noise
+        """
+        super(SyntheticBackend, self).__init__(idx, resolution_mode, frame_rate, color_mode, cleye_params)
+        self.blink_period = blink_period
+        self.noise = noise
+        self.seed = seed
+
+    def _make_bank(self, cam):
+        x,y = self.resolution[cam]
+        n = max(1, int(round(self.blink_period * self.frame_rate[cam])))
+        rs = np.random.RandomState(self.seed + cam)
+        yy,xx = np.mgrid[0:y,0:x]
+        eye = ((xx-x/2.)/(x/4.))**2 + ((yy-y/2.)/(y/5.))**2 < 1
+        bank = np.empty((n,y,x), dtype=np.uint8)
+        for k in range(n):
+            lid = y/2. - y/5. + (2*y/5.) * (0.5-0.5*np.cos(2*np.pi*k/n))
+            fr = np.full((y,x), 40, dtype=np.int16)
+            fr[eye & (yy>lid)] = 200
+            fr += rs.randint(0, self.noise+1, size=(y,x)).astype(np.int16)
+            bank[k] = np.clip(fr, 0, 255)
+        if self.color_mode[cam] == _PSEye.COLOUR:
+            bank = np.repeat(bank[...,None], _PSEye.BYTES_PER_PIXEL[_PSEye.COLOUR], axis=-1)
+        return bank
+
+    def start(self):
+        self._banks = [self._make_bank(i) for i in range(self.n_cams)]
+        self._count = [0]*self.n_cams
+        self._next = [now()]*self.n_cams
+
+    def read(self, cam, out, timeout):
+        # pace to the frame rate, skipping ahead rather than bursting if the reader fell behind
+        period = 1./self.frame_rate[cam]
+        wait = self._next[cam] - now()
+        if wait > timeout/1000.:
+            time.sleep(timeout/1000.)
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        self._next[cam] = max(self._next[cam]+period, now())
+
+        bank = self._banks[cam]
+        out[...] = bank[self._count[cam] % len(bank)]
+        self._count[cam] += 1
+        return True
+
+    def stop(self):
+        pass
+
+class ReplayBackend(CameraBackend):
+    """Frames streamed from a movie file previously saved by MovieSaver (ex. *_cams.h5)
+
+    Camera number i replays datasets mov{i} and ts{i}. Frames are paced by the recorded timestamps, or delivered as fast as possible.
+    """
+    def __init__(self, idx, resolution_mode, frame_rate, color_mode, cleye_params, path=None, realtime=True, loop=True, block_size=256):
+        """
+        Parameters
+        ----------
+        path : str
+            movie file to replay
+        realtime : bool
+            if True, deliver frames with the intervals of their recorded timestamps; otherwise as fast as they can be read
+        loop : bool
+            if True, restart from the beginning when the recording runs out; otherwise stop delivering frames
+        block_size : int
+            number of frames read from file at a time
+        """
+        super(ReplayBackend, self).__init__(idx, resolution_mode, frame_rate, color_mode, cleye_params)
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.block_size = block_size
+
+    def start(self):
+        self._f = h5py.File(self.path, 'r')
+        self._mov = [self._f['mov{}'.format(i)] for i in range(self.n_cams)]
+        self._ts = [np.asarray(self._f['ts{}'.format(i)][:,0]) for i in range(self.n_cams)]
+        for i,(mov,(x,y)) in enumerate(zip(self._mov, self.resolution)):
+            if mov.shape[1:3] != (y,x) or self.color_mode[i] != _PSEye.GREYSCALE:
+                raise Exception('Replay source {} has frames of shape {}, which cannot be replayed as camera {}.'.format(mov.name, mov.shape[1:], i))
+        self._pos = [0]*self.n_cams
+        self._block = [None]*self.n_cams
+        self._block_start = [0]*self.n_cams
+        self._t0 = [now()]*self.n_cams
+
+    def read(self, cam, out, timeout):
+        mov,ts,pos = self._mov[cam],self._ts[cam],self._pos[cam]
+        if pos >= len(ts):
+            if not self.loop or len(ts) == 0:
+                time.sleep(timeout/1000.)
+                return False
+            pos = 0
+            self._t0[cam] = now()
+            self._block[cam] = None
+
+        if self.realtime:
+            wait = self._t0[cam] + (ts[pos]-ts[0]) - now()
+            if wait > timeout/1000.:
+                time.sleep(timeout/1000.)
+                return False
+            if wait > 0:
+                time.sleep(wait)
+
+        block,b0 = self._block[cam],self._block_start[cam]
+        if block is None or pos >= b0+len(block):
+            b0 = pos
+            block = mov[b0:b0+self.block_size]
+            self._block[cam],self._block_start[cam] = block,b0
+        out[...] = block[pos-b0]
+        self._pos[cam] = pos+1
+        return True
+
+    def stop(self):
+        try:
+            self._f.close()
+        except:
+            pass
+
+# Movie compression
+MOVIE_CODECS = ['gzip', 'lzf', 'blosc-lz4', 'blosc-lz4hc', 'blosc-zstd', 'blosc-zlib', 'zstd', 'lz4']
+MOVIE_FILTERS = [None, 'shuffle', 'bitshuffle']
+
+def movie_codec(codec='lzf', level=1, filter=None):
+    """Translate a compression setting into hdf5 dataset options, and where possible an encoder for writing chunks directly
+
+    Parameters
+    ----------
+    codec : str
+        one of MOVIE_CODECS; gzip and lzf are built into every hdf5 library, the others require hdf5plugin to write and to read
+    level : int
+        compression level; gzip 1-9, blosc 0-9, zstd 1-22, ignored by lzf and lz4
+        lzf is the default as the fastest codec available everywhere; see PSEye for flush times against the inter-trial interval
+    filter : str
+        one of MOVIE_FILTERS, applied before compression; bitshuffle requires a blosc codec or lz4
+
+    Returns
+    -------
+    kwargs : dict
+        compression keyword arguments for h5py's create_dataset
+    encode : callable
+        function that compresses a contiguous chunk of frames into the bytes stored by the dataset's filter pipeline, for use with direct chunk writes; None if the data must go through h5py's normal write path
+    """
+    if codec not in MOVIE_CODECS:
+        raise Exception('Codec {} not recognized, options are: {}'.format(codec, MOVIE_CODECS))
+    if filter not in MOVIE_FILTERS:
+        raise Exception('Filter {} not recognized, options are: {}'.format(filter, MOVIE_FILTERS))
+    if codec not in ['gzip','lzf'] and hdf5plugin is None:
+        raise Exception('Codec {} requires the hdf5plugin package.'.format(codec))
+
+    if codec in ['gzip','lzf']:
+        if filter == 'bitshuffle':
+            raise Exception('Bitshuffle is only available with blosc or lz4 codecs.')
+        kwargs = dict(compression=codec, shuffle=filter=='shuffle')
+        encode = None
+        if codec == 'gzip':
+            kwargs['compression_opts'] = level
+            # the hdf5 shuffle filter is a no-op on 1-byte frames, so plain deflate output is valid either way
+            def encode(chunk):
+                c = zlib.compressobj(level)
+                return c.compress(chunk) + c.flush()
+
+    elif codec.startswith('blosc'):
+        cname = codec.split('-')[1]
+        shuffle = [None,'shuffle','bitshuffle'].index(filter) # blosc's NOSHUFFLE, SHUFFLE, BITSHUFFLE
+        kwargs = dict(hdf5plugin.Blosc(cname=cname, clevel=level, shuffle=shuffle))
+        encode = None
+        if blosc is not None:
+            # the hdf5 blosc filter stores each chunk as a single blosc buffer
+            def encode(chunk):
+                return blosc.compress_ptr(chunk.__array_interface__['data'][0], chunk.size, typesize=chunk.itemsize, clevel=level, shuffle=shuffle, cname=cname)
+
+    elif codec == 'zstd':
+        if filter == 'bitshuffle':
+            raise Exception('Bitshuffle with zstd is available as blosc-zstd.')
+        kwargs = dict(hdf5plugin.Zstd(clevel=level), shuffle=filter=='shuffle')
+        encode = None
+
+    elif codec == 'lz4':
+        if filter == 'bitshuffle':
+            kwargs = dict(hdf5plugin.Bitshuffle(lz4=True))
+        else:
+            kwargs = dict(hdf5plugin.LZ4(), shuffle=filter=='shuffle')
+        encode = None
+
+    return kwargs, encode
+
+def _write_chunks(dset, i0, frames, encode, pool):
+    """Write frames into dset starting at index i0, one chunk at a time
+
+    Parameters
+    ----------
+    dset : h5py Dataset
+        destination, chunked along its first axis
+    i0 : int
+        first index to write, a multiple of the chunk length
+    frames : np.ndarray
+        frames to write, a whole number of chunks
+    encode : callable
+        chunk encoder from movie_codec; chunks are compressed in parallel by the pool and committed with direct chunk writes. If None, frames are written through h5py's normal path
+    pool : multiprocessing ThreadPool
+        compression workers
+
+    Returns
+    -------
+    n_bytes : int
+        compressed size of the data written
+    """
+    c = dset.chunks[0]
+    if encode is None:
+        before = dset.id.get_storage_size()
+        dset[i0:i0+len(frames)] = frames
+        return dset.id.get_storage_size()-before
+    chunks = [frames[i:i+c] for i in range(0, len(frames), c)]
+    n_bytes = 0
+    for ci,data in enumerate(pool.imap(encode, chunks)):
+        dset.id.write_direct_chunk((i0+ci*c,)+(0,)*(frames.ndim-1), data)
+        n_bytes += len(data)
+    return n_bytes
 
 class MovieSaver(mp.Process):
     """A separate python process used to save frames to a file
     """
-    def __init__(self, name, kill_flag, frame_buffer, flushing, query_idx=0, buffer_size=6000, hdf_resize=30000, min_flush=200, n_cams=1, resolution=None):
+    def __init__(self, name, kill_flag, frame_buffer, flushing, buffer_size=6000, hdf_prealloc=30000, hdf_growth=2., min_flush=200, n_cams=1, resolution=None, chunk_frames=16, compression='lzf', compression_level=1, compression_filter=None, n_workers=None, crop_box=None, crop_version=None, crop_idx=0, trial_queue=None, stats=None):
         """
         Initialize a MovieSaver. Most commonly performed by the PSEye class, and thus should not be handled directly.
 
@@ -68,24 +747,44 @@ class MovieSaver(mp.Process):
         ----------
         name : str
             destination filename for saved movie data
-        kill_flag : multiprocessing Value
+        kill_flag : multiprocessing Event
             passed down from controller object, used as a simple flag for terminating process
-        frame_buffer : list of multiprocessing Queues
-            passed down from controller object, used to collect frames between acquisition and saving
+        frame_buffer : list of FrameRings
+            passed down from controller object, one per camera, used to collect frames between acquisition and saving; the rings should share a ready Event, which the saver blocks on when they are empty
         flushing : multiprocessing Value
             passed down from controller object, used as a simple flag for controlling flush behaviour
-        query_idx : int
-            index of the camera from which to sample frames when camera is queried
         buffer_size : int
             number of frames in memory buffer
-        hdf_resize : int
-            increment by which to increase the hdf dataset when it becomes full
+        hdf_prealloc : int, or list thereof
+            number of frames to allocate in each camera's hdf datasets up front, ideally the expected length of the session
+        hdf_growth : float
+            factor by which to enlarge a dataset when it becomes full
         min_flush : int
             minimum number of frames in buffer before flushing
         n_cams : int
             number of cameras
         resolution : tuple of ints, or list thereof
             (x,y) dimensions of frame for each camera
+        chunk_frames : int
+            number of frames per hdf5 chunk; frames are compressed and written a whole chunk at a time
+        compression : str
+            codec for frames and timestamps, one of MOVIE_CODECS (see movie_codec)
+        compression_level : int
+            compression level for the codec
+        compression_filter : str
+            filter applied before compression, one of MOVIE_FILTERS
+        n_workers : int
+            number of compression threads (default: number of cpus)
+        crop_box : multiprocessing Array
+            passed down from controller object, [x0,y0,x1,y1] of the region of camera crop_idx to save; if None, full frames are saved for all cameras
+        crop_version : multiprocessing RawValue
+            passed down from controller object, incremented whenever crop_box changes (0: no crop set yet, save full frames)
+        crop_idx : int
+            index of the camera to which cropping applies
+        trial_queue : multiprocessing Queue
+            passed down from controller object, receives (trial_idx, start, end) for each completed trial, in the acquisition clock, to be indexed in the trials{i} datasets
+        stats : CameraStats
+            passed down from controller object, updated with saving statistics; a snapshot is stored in the file's stats attribute at the end
         """
         super(MovieSaver, self).__init__()
         self.daemon = True
@@ -95,114 +794,370 @@ class MovieSaver(mp.Process):
             name += '.h5'
         self.name = name
         self.buffer_size = buffer_size # should be overkill, since flushing will do the real job of saving it out
-        self.hdf_resize = hdf_resize
+        self.hdf_prealloc = hdf_prealloc if isinstance(hdf_prealloc, (list,tuple)) else [hdf_prealloc]*n_cams
+        self.hdf_growth = hdf_growth
         self.min_flush = min_flush
+        self.chunk_frames = chunk_frames
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_filter = compression_filter
+        movie_codec(self.compression, self.compression_level, self.compression_filter) # validate here, so that errors are raised in the calling process
+        self.n_workers = n_workers or mp.cpu_count()
 
         # Cam params
         self.n_cams = n_cams
         self.resolution = resolution
+        self.crop_box = crop_box
+        self.crop_version = crop_version
+        self.crop_idx = crop_idx if crop_box is not None else None
 
         # Flags and containers
-        self.saving_complete = mp.Value('b', False)
+        self.saving_complete = mp.Event()
         self.kill_flag = kill_flag
         self.flushing = flushing
         self.frame_buffer = frame_buffer
-        
-        # Queries
-        self.query_idx = query_idx #which cam gets queried
-        self.query_flag = mp.Value('b',False)
-        self.query_queue = mp.Array(ctypes.c_uint8, np.product([self.resolution[self.query_idx][0], self.resolution[self.query_idx][1]]))
-        self.query_queue_ts = mp.Value('d',0.)
+        self.trial_queue = trial_queue
+        self.stats = stats if stats is not None else CameraStats(n_cams)
         
         self.start()
+    def _flush(self, di, final=False):
+        """Compress and write out the whole chunks in the in-memory buffer of camera di, carrying any remainder over to the next flush
+
+        Where the codec allows, chunks are compressed in parallel by the worker pool and committed with direct chunk writes, in the same format the dataset's filters produce, so the file reads back normally.
+        On the final flush the remainder is zero-padded to a whole chunk and written too; the dataset is truncated to the true length afterwards.
+
+        Parameters
+        ----------
+        di : int
+            camera index
+        final : bool
+            write out the partial chunk at the end of the buffer as well
+        """
+        c = self.chunk_frames
+        n = self._buf_idx[di]
+        n_write = n if final else n//c*c
+        if n_write == 0:
+            return
+        t0 = now()
+        n_pad = -(-n_write//c)*c
+        buf,tsbuf,seqbuf = self._saving_buf[di],self._saving_ts_buf[di],self._saving_seq_buf[di]
+        buf[n_write:n_pad] = 0
+        i0 = self._sav_idx[di]
+        j0 = i0-self._seg_start[di] # index within current frame dataset
+        self._reserve(di, self.vw[di], j0+n_pad)
+        self._reserve(di, self.vwts[di], i0+n_write)
+        self._reserve(di, self.vwseq[di], i0+n_write)
+        n_bytes = _write_chunks(self.vw[di], j0, buf[:n_pad], self._encode, self.pool)
+        self.vwts[di][i0:i0+n_write] = tsbuf[:n_write]
+        self.vwseq[di][i0:i0+n_write] = seqbuf[:n_write]
+        self._sav_idx[di] += n_write
+
+        # carry over the partial chunk
+        rem = n - n_write
+        buf[:rem] = buf[n_write:n]
+        tsbuf[:rem] = tsbuf[n_write:n]
+        seqbuf[:rem] = seqbuf[n_write:n]
+        self._buf_idx[di] = rem
+
+        self.stats.add(di, 'saved', n_write)
+        self.stats.set(di, 'buffered', rem)
+        self.stats.add(di, 'bytes_raw', buf[0].nbytes*n_write)
+        self.stats.add(di, 'bytes_stored', n_bytes)
+        self.stats.add_timing(di, 'flush', now()-t0)
+    def _reserve(self, di, ds, n):
+        """Make sure dataset ds of camera di can hold n frames, growing it geometrically if not
+        """
+        if ds.shape[0] >= n:
+            return
+        size = max(n, int(ds.shape[0]*self.hdf_growth))
+        t0 = now()
+        ds.resize(size, axis=0)
+        dur = now()-t0
+        self.stats.add_timing(di, 'resize', dur)
+        logging.info('Resized {} to {} frames in {:.3f} s'.format(ds.name, size, dur))
+    def _new_movie(self, di):
+        """Create the frame dataset for camera di, sized to its current crop
+
+        The cropped camera gets one dataset per crop segment, mov{di}_{k}, and a row [first_frame,x0,y0,x1,y1] in crop{di}, where first_frame indexes ts{di}
+        """
+        x0,y0,x1,y1 = self._crop[di]
+        shape = (y1-y0,x1-x0) + self.frame_buffer[di].shape[2:] # cropped frame, plus colour channels if any
+        if di == self.crop_idx:
+            k = len(self.vwcrop)
+            name = 'mov{}_{}'.format(di, k)
+            self.vwcrop.resize(k+1, axis=0)
+            self.vwcrop[k] = [self._sav_idx[di],x0,y0,x1,y1]
+        else:
+            name = 'mov{}'.format(di)
+        # chunks of whole frames, so that _flush can compress and write them directly
+        n = max(self.hdf_prealloc[di]-self._sav_idx[di], self._n_buf) # the rest of the expected session
+        self.vw[di] = self.vw_f.create_dataset(name, (n,)+shape, maxshape=(None,)+shape, dtype='uint8', chunks=(self.chunk_frames,)+shape, **self._comp)
+        self._seg_start[di] = self._sav_idx[di]
+        self._saving_buf[di] = self._raw_buf[di][:self._n_buf*int(np.product(shape))].reshape((self._n_buf,)+shape)
+    def _end_movie(self, di):
+        """Write out everything buffered for camera di, and cut off the unused space of its current frame dataset
+        """
+        self._flush(di, final=True)
+        vw = self.vw[di]
+        vw.resize(self._sav_idx[di]-self._seg_start[di], axis=0)
+    def _update_crop(self, di):
+        """Adopt a newly set crop box: close the current segment, and start a new one with the next saved frame
+        """
+        with self.crop_box.get_lock():
+            self._crop_version = self.crop_version.value
+            box = tuple(self.crop_box[:])
+        if box == self._crop[di]:
+            return
+        if self.vw[di] is not None:
+            self._end_movie(di)
+            self.vw[di] = None
+        self._crop[di] = box
+        logging.info('Camera {}: saving crop set to {}'.format(di, box))
+    def _index_trials(self, final=False):
+        """Collect new trial marks, and add each to the trials{i} datasets once its frames have been saved
+
+        A trial is indexed for a camera as soon as a frame with a timestamp past the trial's end has arrived (or at the final call), as [trial_idx, first_frame, last_frame], inclusive indices into ts{i}; -1,-1 if no frames fell within the trial.
+
+        Parameters
+        ----------
+        final : bool
+            index all pending trials with whatever frames have been saved
+        """
+        if self.trial_queue is None:
+            return
+        while True:
+            try:
+                mark = self.trial_queue.get_nowait()
+            except Queue.Empty:
+                break
+            for pending in self._pending_trials:
+                pending.append(mark)
+        for di in range(self.n_cams):
+            n = self._sav_idx[di]+self._buf_idx[di]
+            ts = self._ts_log[di][:n]
+            pending = self._pending_trials[di]
+            while pending and (final or (n and ts[-1] > pending[0][2])):
+                tidx,start,end = pending.pop(0)
+                first,last = np.searchsorted(ts, start, side='left'), np.searchsorted(ts, end, side='right')-1
+                if first > last:
+                    first,last = -1,-1
+                k = len(self.vwtrials[di])
+                self.vwtrials[di].resize(k+1, axis=0)
+                self.vwtrials[di][k] = [tidx,first,last]
     def run(self):
         """Main method of the process, to be used with standard Process protocols ( i.e. .start() )
         """
 
         # Setup hdf5 file and datasets
         self.vw_f = h5py.File(self.name,'w')
-        self.vw,self.vwts = [],[]
-        for i in range(self.n_cams):
-            x,y = self.resolution[i]
-            vw = self.vw_f.create_dataset('mov{}'.format(i), (self.hdf_resize, y, x), maxshape=(None, y, x), dtype='uint8', compression='lzf') 
-            vwts = self.vw_f.create_dataset('ts{}'.format(i), (self.hdf_resize,2), maxshape=(None,2), dtype=np.float64, compression='lzf')
-            self.vw.append(vw)
-            self.vwts.append(vwts)
+        self._comp,self._encode = movie_codec(self.compression, self.compression_level, self.compression_filter)
+        self.pool = ThreadPool(self.n_workers) # zlib and blosc release the GIL, so threads compress in parallel
            
         # Counters and buffers
-        _sav_idx = [0]*self.n_cams # index within hdf5 dataset
-        _buf_idx = [0]*self.n_cams # index of in-memory buffer that is periodicially dumped to hdf5 dataset
-        _saving_buf,_saving_ts_buf = [],[]
+        self._sav_idx = [0]*self.n_cams # index within hdf5 timestamp dataset
+        self._seg_start = [0]*self.n_cams # index within timestamp dataset of the first frame in the current frame dataset
+        self._buf_idx = [0]*self.n_cams # index of in-memory buffer that is periodicially dumped to hdf5 dataset
+        self._n_buf = -(-self.buffer_size//self.chunk_frames)*self.chunk_frames # whole number of chunks
+        self._raw_buf,self._saving_buf,self._saving_ts_buf,self._saving_seq_buf = [],[],[],[]
+        self._crop = [(0,0)+tuple(res) for res in self.resolution] # [x0,y0,x1,y1] of frames in the current dataset
+        self._crop_version = 0
         for i in range(self.n_cams):
-            x,y = self.resolution[i]
-            sb = np.empty((self.buffer_size,y,x), dtype=np.uint8)
-            stb = np.empty((self.buffer_size,2), dtype=np.float64)
-            _saving_buf.append(sb)
-            _saving_ts_buf.append(stb)
+            self._raw_buf.append(np.empty(self._n_buf*int(np.product(self.frame_buffer[i].shape)), dtype=np.uint8)) # frame buffer storage, viewed at the current crop size
+            self._saving_buf.append(None)
+            self._saving_ts_buf.append(np.empty((self._n_buf,2), dtype=np.float64))
+            self._saving_seq_buf.append(np.empty((self._n_buf,2), dtype=np.int64))
+        self._ts_log = [np.empty(max(n,self._n_buf)) for n in self.hdf_prealloc] # all saved timestamps, for indexing trials
+        self._pending_trials = [[] for i in range(self.n_cams)]
+
+        # Datasets: the cropped camera's frame dataset is created with its first saved frame, once any crop is known
+        self.vw,self.vwts,self.vwseq = [None]*self.n_cams,[],[]
+        if self.crop_idx is not None:
+            self.vwcrop = self.vw_f.create_dataset('crop{}'.format(self.crop_idx), (0,5), maxshape=(None,5), dtype=np.int64)
+            self.vwcrop.attrs['columns'] = 'first_frame,x0,y0,x1,y1'
+        for i in range(self.n_cams):
+            if i != self.crop_idx:
+                self._new_movie(i)
+            vwts = self.vw_f.create_dataset('ts{}'.format(i), (self.hdf_prealloc[i],2), maxshape=(None,2), dtype=np.float64, **self._comp)
+            self.vwts.append(vwts)
+            vwseq = self.vw_f.create_dataset('seq{}'.format(i), (self.hdf_prealloc[i],2), maxshape=(None,2), dtype=np.int64, **self._comp)
+            vwseq.attrs['columns'] = 'seq,missed'
+            self.vwseq.append(vwseq)
+        self.vwtrials = []
+        if self.trial_queue is not None:
+            for i in range(self.n_cams):
+                vwtrials = self.vw_f.create_dataset('trials{}'.format(i), (0,3), maxshape=(None,3), dtype=np.int64)
+                vwtrials.attrs['columns'] = 'trial_idx,first_frame,last_frame'
+                self.vwtrials.append(vwtrials)
 
         cams_running = [True for i in range(self.n_cams)]
         # Main loop
         while any(cams_running):
-            # For all datasets: if there's not enough room to dump another buffer's worth into dataset, extend it
-            # Then read new frames, and save/query as desired
+            # Sleep until new frames arrive (the event is cleared before the rings are drained, so no wakeup is lost)
+            frames_ready = self.frame_buffer[0].ready
+            if frames_ready is not None and not self.kill_flag.is_set() and not any(len(fb) for fb in self.frame_buffer):
+                frames_ready.wait(0.1)
+                frames_ready.clear()
+            self._index_trials()
+
+            # For all datasets: read new frames, and save as desired
             for di in range(self.n_cams):
                 if not cams_running[di]:
                     continue
-                
-                if self.vw[di].shape[0]-_sav_idx[di] <= self.buffer_size:
-                    assert self.vw[di].shape[0] == self.vwts[di].shape[0], 'Frame and timestamp dataset lengths are mismatched.'
-                    self.vw[di].resize((self.vw[di].shape[0]+self.hdf_resize, self.vw[di].shape[1], self.vw[di].shape[2]))
-                    self.vwts[di].resize((self.vwts[di].shape[0]+self.hdf_resize,self.vwts[di].shape[1]))
            
                 # Get new frames from buffer, breaking out if empty and kill flag has been raised
-                ts=temp=bsave=None
-                try:
-                    ts,temp,bsave = self.frame_buffer[di].get(block=False)
-                except Queue.Empty:
-                    if self.kill_flag.value:
+                ring = self.frame_buffer[di]
+                slot = ring.oldest()
+                if slot is None:
+                    if self.kill_flag.is_set():
                         cams_running[di] = False
                     continue
+                ts,seq,temp,bsave = ring.ts[slot],ring.seq[slot],ring.frames[slot],ring.saving[slot]
+                self.stats.set_max(di, 'queue_max', len(ring))
 
-                if self.kill_flag.value==True:
-                    logging.info('Final flush for camera {}: {} frames remain.'.format(di, self.frame_buffer[di].qsize()))
+                if self.kill_flag.is_set():
+                    logging.info('Final flush for camera {}: {} frames remain.'.format(di, len(ring)))
                              
-                if di==self.query_idx and self.query_flag.value:
-                    self.query_queue[:] = temp.copy()
-                    self.query_queue_ts.value = ts[1]
-                    self.query_flag.value = False
-                
                 if bsave: # flag that this frame was added to queue during a saving period
 
+                    # start a new segment if the crop has changed
+                    if di == self.crop_idx and self.crop_version.value != self._crop_version:
+                        self._update_crop(di)
+                    if self.vw[di] is None:
+                        self._new_movie(di)
+
                     # add new data to in-memory buffer
-                    x,y = self.resolution[di]
-                    _saving_buf[di][_buf_idx[di]] = temp.reshape([y,x])
-                    _saving_ts_buf[di][_buf_idx[di]] = ts
-                    _buf_idx[di] += 1
+                    x0,y0,x1,y1 = self._crop[di]
+                    self._saving_buf[di][self._buf_idx[di]] = temp[y0:y1,x0:x1]
+                    self._saving_ts_buf[di][self._buf_idx[di]] = ts
+                    self._saving_seq_buf[di][self._buf_idx[di]] = seq
+                    n = self._sav_idx[di]+self._buf_idx[di]
+                    if n == len(self._ts_log[di]):
+                        self._ts_log[di] = np.append(self._ts_log[di], np.empty(len(self._ts_log[di])))
+                    self._ts_log[di][n] = ts[0]
+                    self._buf_idx[di] += 1
+                    self.stats.set(di, 'buffered', self._buf_idx[di])
                     # if necessary, flush out buffer to hdf dataset
-                    if (self.flushing.value and _buf_idx[di]>=self.min_flush) or _buf_idx[di] >= self.buffer_size:
-                        if _buf_idx[di] >= self.buffer_size:
-                            logging.warning('Dumping camera b/c reached max buffer (buffer={}, current idx={})'.format(self.buffer_size, _buf_idx[di]))
-                        self.vw[di][_sav_idx[di]:_sav_idx[di]+_buf_idx[di],:,:] = _saving_buf[di][:_buf_idx[di]]
-                        self.vwts[di][_sav_idx[di]:_sav_idx[di]+_buf_idx[di],:] = _saving_ts_buf[di][:_buf_idx[di]]
-                        _sav_idx[di] += _buf_idx[di]
-                        _buf_idx[di] = 0
+                    if (self.flushing.value and self._buf_idx[di]>=self.min_flush) or self._buf_idx[di] >= self.buffer_size:
+                        if self._buf_idx[di] >= self.buffer_size:
+                            logging.warning('Dumping camera b/c reached max buffer (buffer={}, current idx={})'.format(self.buffer_size, self._buf_idx[di]))
+                        self._flush(di)
+
+                ring.release()
 
         # final flush:
         for di in range(self.n_cams):
-            self.vw[di][_sav_idx[di]:_sav_idx[di]+_buf_idx[di],:,:] = _saving_buf[di][:_buf_idx[di]]
-            self.vwts[di][_sav_idx[di]:_sav_idx[di]+_buf_idx[di]] = _saving_ts_buf[di][:_buf_idx[di]]
-            _sav_idx[di] += _buf_idx[di]
             # cut off all unused allocated space 
-            self.vw[di].resize([_sav_idx[di],self.vw[di].shape[1],self.vw[di].shape[2]])
-            self.vwts[di].resize([_sav_idx[di],2])
+            if self.vw[di] is not None:
+                self._end_movie(di)
+            self.vwts[di].resize([self._sav_idx[di],2])
+            self.vwseq[di].resize([self._sav_idx[di],2])
+        self._index_trials(final=True)
+        snap = self.stats.snapshot()
+        self.vw_f.attrs['stats'] = json.dumps(snap)
+        for di,st in enumerate(snap):
+            logging.info('Camera {}: {saved} frames saved in {flushes} flushes ({flush_time:.2f} s, max {flush_time_max:.3f} s); datasets resized {resizes} times ({resize_time:.3f} s)'.format(di, **st))
 
+        self.pool.close()
+        self.pool.join()
         self.vw_f.close()
-        self.saving_complete.value = True
+        self.saving_complete.set()
+
+class RawMovieSaver(mp.Process):
+    """A separate python process used to save frames to raw, memory-mapped files (see raw_movie.py), as a lighter-weight alternative to MovieSaver
+    """
+    def __init__(self, name, kill_flag, frame_buffer, n_cams=1, segment_frames=18000, trial_queue=None, stats=None):
+        """
+        Initialize a RawMovieSaver. Most commonly performed by the PSEye class, and thus should not be handled directly.
+
+        Parameters
+        ----------
+        name : str
+            destination filename for the converted movie; raw files are named after it, without the .h5 extension
+        kill_flag : multiprocessing Event
+            passed down from controller object, used as a simple flag for terminating process
+        frame_buffer : list of FrameRings
+            passed down from controller object, one per camera, as in MovieSaver
+        n_cams : int
+            number of cameras
+        segment_frames : int
+            number of frames per raw segment file
+        trial_queue : multiprocessing Queue
+            passed down from controller object, receives (trial_idx, start, end) for each completed trial, appended to the trials file
+        stats : CameraStats
+            passed down from controller object, updated with saving statistics; a snapshot is written to the capture's stats file at the end, and copied to the movie file's stats attribute on conversion
+        """
+        super(RawMovieSaver, self).__init__()
+        self.daemon = True
+
+        if name.endswith('.h5'):
+            name = name[:-3]
+        self.base = name
+        self.segment_frames = segment_frames
+        self.n_cams = n_cams
+
+        self.saving_complete = mp.Event()
+        self.kill_flag = kill_flag
+        self.frame_buffer = frame_buffer
+        self.trial_queue = trial_queue
+        self.stats = stats if stats is not None else CameraStats(n_cams)
+
+        self.start()
+    def _write_trials(self, trials_file):
+        """Append any new trial marks to the trials file, flushing immediately so that they survive a crash
+        """
+        while self.trial_queue is not None:
+            try:
+                trials_file.write('{} {!r} {!r}\n'.format(*self.trial_queue.get_nowait()))
+                trials_file.flush()
+            except Queue.Empty:
+                break
+    def run(self):
+        """Main method of the process, to be used with standard Process protocols ( i.e. .start() )
+        """
+        writers = [RawMovieWriter(self.base, i, fb.shape, segment_frames=self.segment_frames) for i,fb in enumerate(self.frame_buffer)]
+        trials_file = open(trials_name(self.base), 'a')
+
+        cams_running = [True for i in range(self.n_cams)]
+        while any(cams_running):
+            frames_ready = self.frame_buffer[0].ready
+            if frames_ready is not None and not self.kill_flag.is_set() and not any(len(fb) for fb in self.frame_buffer):
+                frames_ready.wait(0.1)
+                frames_ready.clear()
+
+            self._write_trials(trials_file)
+
+            # drain every ring, since each frame costs only a copy
+            for di in range(self.n_cams):
+                ring = self.frame_buffer[di]
+                slot = ring.oldest()
+                if slot is None and self.kill_flag.is_set():
+                    cams_running[di] = False
+                self.stats.set_max(di, 'queue_max', len(ring))
+                while slot is not None:
+                    if ring.saving[slot]:
+                        writers[di].write(ring.frames[slot], ring.ts[slot], ring.seq[slot])
+                        self.stats.add(di, 'saved')
+                        self.stats.add(di, 'bytes_raw', ring.frames[slot].nbytes)
+                        self.stats.add(di, 'bytes_stored', ring.frames[slot].nbytes)
+                    ring.release()
+                    slot = ring.oldest()
+
+        for w in writers:
+            w.close()
+        self._write_trials(trials_file)
+        trials_file.close()
+        snap = self.stats.snapshot()
+        with open(stats_name(self.base), 'w') as f:
+            json.dump(snap, f)
+        for di,st in enumerate(snap):
+            logging.info('Camera {}: {saved} frames saved'.format(di, **st))
+        self.saving_complete.set()
 
 class _PSEye(mp.Process):
     """
     An object that runs as its own process, serving the role of containing and calling the PSEye driver API
-    Constantly checks for the presence of new frames and dumps them into multiprocessing queue
+    One thread per camera blocks on the camera backend for each new frame and has it written directly into the next free slot of that camera's FrameRing (shared memory, read by the MovieSaver process); frames arriving while the ring is full are dropped and counted
+    The queried camera's frames also go to the LatestFrame and RoiTrace buffers, for live queries from the main process
 
     This class should not be used directly, but rather will be handled by the PSEye user-friendly class, documented below.
     """
@@ -215,12 +1170,13 @@ class _PSEye(mp.Process):
     GREYSCALE = CLEYE_CODES['greyscale']
     BYTES_PER_PIXEL = {COLOUR:4, GREYSCALE:1}
 
-    def __init__(self, idx, resolution_mode, frame_rate, color_mode, sync_flag=None, frame_buffer=None, kill_flag=None, saving_flag=None, cleye_params={}, query_idx=0):
+    def __init__(self, idx, resolution_mode, frame_rate, color_mode, sync_flag=None, frame_buffer=None, kill_flag=None, saving_flag=None, cleye_params={}, query_idx=0, latest_frame=None, roi_trace=None, backend='cleye', backend_params=None, stats=None, colour_format='grey'):
 
         # Process init
         super(_PSEye, self).__init__()
         self.daemon = True
-        self.lib = "CLEyeMulticam.dll"
+        self.backend_name = backend
+        self.backend_params = backend_params or {}
 
         # Camera Parameters : all are either legnth-1 or 2 tuples, corresponding to params for each camera
         self.idx = idx
@@ -232,153 +1188,162 @@ class _PSEye(mp.Process):
         self.n_cams = len(self.idx)
         self.resolution = [self.DIMENSIONS[rm] for rm in self.resolution_mode]
         self.bytes_per_pixel = [self.BYTES_PER_PIXEL[cm] for cm in self.color_mode]
-        self.read_dims = [r[::-1] for r in self.resolution]
-        for i,cm in enumerate(self.color_mode):
-            if cm == self.COLOUR:
-                self.read_dims[i].append(4)
+        self.read_dims = [r[::-1]+(4,) if cm==self.COLOUR else r[::-1] for r,cm in zip(self.resolution,self.color_mode)] # as delivered by the camera
+        self.colour_format = colour_format
         
         # Cross-process structures inherited from parent
         self.frame_buffer = frame_buffer
         self.kill_flag = kill_flag
         self.saving_flag = saving_flag
+        self.stats = stats if stats is not None else CameraStats(len(idx))
 
         # Runtime flags
-        self.thread_complete = mp.Value('b',False)
-        self.reset_cams_flag = mp.Value('b', False)
+        self.thread_complete = mp.Event()
+        self.reset_cams_flag = mp.Event()
         
-        # Queries (note that I had also implemented this for the saver. these are independent things in each class, parent will use one or the other)
+        # Queries: every frame from the queried camera is published to latest_frame, and its ROI mean to roi_trace
         self.query_idx = query_idx #which cam gets queried
-        self.query_flag = mp.Value('b',False)
-        manager = mp.Manager()
-        self.query_queue = manager.list()
-        self.query_queue.append(0) # dummy entry
-        self.query_queue_ts = mp.Value('d',0.)
+        self.latest_frame = latest_frame
+        self.roi_trace = roi_trace
 
         # Sync
         self.sync_flag = sync_flag
-        self.sync_val = mp.Value('d', 0)
+        self.clock_sync = ClockSync(sync_flag)
 
         self.start()
     
     def cam_callback(self, idx, timeout=2000):
         while not self.kill_callbacks:
-            if self.callbacks_paused[idx]:
+            if not self.callbacks_resume[idx].is_set():
+                # paused: report that the camera is no longer being read, then sleep until resumed
+                self.callbacks_idle[idx].set()
+                self.callbacks_resume[idx].wait(0.1)
                 continue
-            got = self.dll.CLEyeCameraGetFrame(self._cams[idx], self._bufs[idx], timeout)
+
+            # the backend writes straight into the next free slot of the frame buffer, or into a scratch frame if the buffer is full
+            ring = self.frame_buffer[idx]
+            slot = ring.claim()
+            fr = self._scratch[idx] if slot is None else ring.frames[slot]
+
+            convert = self._convert[idx]
+            got = self.backend.read(idx, fr if convert is None else self._bgra[idx], timeout)
             if got: # this is actually useless, since API apparently returns strange values even in failed cases
                 ts,ts2 = now(),now2()
+                if convert is not None:
+                    convert(self._bgra[idx], fr)
+
+                # sequence number, and frames missed by the camera, judged from the interval since the previous frame
+                seq,missed = self._seq[idx],0
+                self._seq[idx] += 1
+                self.stats.add(idx, 'captured')
+                if self._last_ts[idx] is not None:
+                    dt = ts-self._last_ts[idx]
+                    missed = max(int(round(dt*self.frame_rate[idx]))-1, 0)
+                    if missed:
+                        self.stats.add(idx, 'missed', missed)
+                    elif dt > 1.25/self.frame_rate[idx]:
+                        self.stats.add(idx, 'late')
+                self._last_ts[idx] = ts
                 
-                fr = np.frombuffer(self._bufs[idx], dtype=np.uint8).copy()
-                self.frame_buffer[idx].put([[ts,ts2],fr,self.saving_flag.value])
-
-                # queries: tested, does not modify frame rate when 2 cams are running at 60hz
-                if self.query_flag.value == True and idx==self.query_idx:
-                    self.query_queue_ts.value = ts2
-                    self.query_queue[0] = fr
-                    self.query_flag.value = False
-                
-        self.callbacks_running[idx] = False
+                if slot is None:
+                    ring.n_overflow.value += 1
+                else:
+                    ring.commit([ts,ts2], self.saving_flag.value, (seq,missed))
+                if slot is None and not self.buffer_full[idx]:
+                    logging.warning('Frame buffer for camera {} is full; dropping frames until the saver catches up.'.format(idx))
+                self.buffer_full[idx] = slot is None
+
+                # queries
+                if idx==self.query_idx and self.latest_frame is not None:
+                    self.latest_frame.write(fr, [ts,ts2])
+                if idx==self.query_idx and self.roi_trace is not None:
+                    self.roi_trace.update(fr, [ts,ts2])
     
     def run(self):
 
         # Sync with parent process, if applicable
         # Waits for flag to be set, then reports current clock value
-        while (not self.sync_flag is None) and (not self.sync_flag.value):
-            self.sync_val.value = now()
+        self.clock_sync.wait()
 
         # Initialize camera
         self._init_cam()
         
-        # setup buffers
-        self._bufs = [ ctypes.create_string_buffer(np.product(res) * bpp) for res,bpp in zip(self.resolution,self.bytes_per_pixel) ]
+        # setup buffers (frames are normally written directly into the frame buffer; these only receive frames that must be dropped)
+        self._scratch = [np.empty(fb.shape, dtype=fb.dtype) for fb in self.frame_buffer]
+        # colour cameras are read into a BGRA frame, and converted into the frame buffer
+        self._convert = [ColourConverter(res, self.colour_format) if cm==self.COLOUR else None for res,cm in zip(self.resolution,self.color_mode)]
+        self._bgra = [np.empty(rd, dtype=np.uint8) if cm==self.COLOUR else None for rd,cm in zip(self.read_dims,self.color_mode)]
        
         # setup callback-related variables
         self.kill_callbacks = False
-        self.callbacks_running = [True for i in range(self.n_cams)]
-        self.callbacks_paused = [False for i in range(self.n_cams)]
+        self.callbacks_resume = [threading.Event() for i in range(self.n_cams)]
+        self.callbacks_idle = [threading.Event() for i in range(self.n_cams)]
+        self.buffer_full = [False for i in range(self.n_cams)]
+        self._last_ts = [None for i in range(self.n_cams)]
+        self._seq = [0 for i in range(self.n_cams)]
+        for ev in self.callbacks_resume:
+            ev.set()
        
         # begin reading threads
-        for i in range(self.n_cams):
-            threading.Thread(target=self.cam_callback, args=(i,)).start()
+        threads = [threading.Thread(target=self.cam_callback, args=(i,)) for i in range(self.n_cams)]
+        for th in threads:
+            th.start()
        
-        # Main loop
-        while any(self.callbacks_running):
-            if self.kill_flag.value:
-                self.kill_callbacks = True
-            if self.reset_cams_flag.value:
+        # Main loop: sleeps until killed, waking periodically to service camera resets
+        while not self.kill_flag.wait(0.05):
+            if self.reset_cams_flag.is_set():
                 self._reset_cams()
+
+        self.kill_callbacks = True
+        for th in threads:
+            th.join()
                     
-        try:
-            for c in self._cams:
-                self.dll.CLEyeCameraStop(c)
-                self.dll.CLEyeDestroyCamera(c)
-        except:
-            pass
+        self.backend.stop()
 
-        self.thread_complete.value = 1
+        self.thread_complete.set()
 
     def reset_cams(self):
         # for calls made from other processes
-        self.reset_cams_flag.value = True
+        self.reset_cams_flag.set()
         logging.info('Resetting cameras...')
-    def _reset_cams(self):
+    def _reset_cams(self, timeout=3.0):
         # for the process itself
         
-        for i in range(len(self.callbacks_paused)):
-            self.callbacks_paused[i] = True
+        # pause the reading threads, and wait for any read in progress to return before destroying the cameras
+        for i in range(self.n_cams):
+            self.callbacks_idle[i].clear()
+            self.callbacks_resume[i].clear()
+        for i in range(self.n_cams):
+            if not self.callbacks_idle[i].wait(timeout):
+                logging.warning('Camera {} did not pause before reset.'.format(i))
             
-        try:
-            for c in self._cams:
-                self.dll.CLEyeCameraStop(c)
-                self.dll.CLEyeDestroyCamera(c)
-        except:
-            pass
-        
+        self.backend.stop()
         self._init_cam()
+        self._last_ts = [None for i in range(self.n_cams)] # the gap across a reset is not counted as missed frames
 
-        for i in range(len(self.callbacks_paused)):
-            self.callbacks_paused[i] = False
+        for i in range(self.n_cams):
+            self.callbacks_resume[i].set()
         
-        self.reset_cams_flag.value = False
+        self.reset_cams_flag.clear()
         logging.info('Cameras reset.')
     def _init_cam(self):
-        
-        # Load dynamic library
-        self.dll = ctypes.cdll.LoadLibrary(self.lib)
-        self.dll.CLEyeGetCameraUUID.restype = GUID
-        self.dll.CLEyeCameraGetFrame.argtypes = [c_void_p, c_char_p, c_int]
-        self.dll.CLEyeCreateCamera.argtypes = [GUID, c_int, c_int, c_float]
-    
-        n_cams_available = self.dll.CLEyeGetCameraCount()
-        if n_cams_available < self.n_cams:
-            warnings.warn('Fewer cameras available than requested.\n(Requested {}, {} available)'.format(self.n_cams, n_cams_available))
-   
-        self._cams = []
-        for idx,cm,rm,fr in zip(self.idx,self.color_mode,self.resolution_mode,self.frame_rate):
-            _cam = self.dll.CLEyeCreateCamera(self.dll.CLEyeGetCameraUUID(idx), cm, rm, fr)
-            if not _cam:
-                raise Exception('Camera {} failed to initialize.'.format(idx))
-            self._cams.append(_cam)
-        
-        # Confirmation of proper init
-        for c,res in zip(self._cams, self.resolution):
-            x,y = CLEyeCameraGetFrameDimensions(self.dll, c)
-            assert (x,y)==res, 'Initialized camera\'s resolution does not match requested resolution.\nRequested: {}, Discovered: {}'.format(str(res), str((x,y)))
-
-        for cleps,cam in zip(self.cleye_params, self._cams): # each camera
-            for param in cleps: # each param
-                self.dll.CLEyeSetCameraParameter(cam, CLEYE_CODES[param], cleps[param])
+        self.backend = CAMERA_BACKENDS[self.backend_name](self.idx, self.resolution_mode, self.frame_rate, self.color_mode, self.cleye_params, **self.backend_params)
+        self.backend.start()
 
-        for c in self._cams:
-            self.dll.CLEyeCameraStart(c)
-
-        time.sleep(0.01)
+# Registry of backends available to _PSEye, by name
+CAMERA_BACKENDS = dict(
+                        cleye       = CLEyeBackend,
+                        synthetic   = SyntheticBackend,
+                        replay      = ReplayBackend,
+                    )
 
 class PSEye():
     """Camera class for movie acquisition and saving
     Handles two distinct objects: the PSEye acqusition object, and the PSEye saving object, which run in separate processes
     """
-    def __init__(self, idx, resolution_mode, frame_rate, color_mode, query_rate=1, query_idx=0, save_name='noname', cleye_params=None, sync_flag=None):
+    POLL = 0.1 # interval (s) at which .end() checks that the processes are alive while waiting on them
+
+    def __init__(self, idx, resolution_mode, frame_rate, color_mode, query_rate=1, query_idx=0, save_name='noname', cleye_params=None, sync_flag=None, ring_size=512, backend='cleye', backend_params=None, compression='lzf', compression_level=1, compression_filter=None, crop=False, crop_margin=10, save_format='h5', raw_convert=True, expected_duration=600., colour_format='grey'):
         """Initialize a PSEye object
 
         Parameters
@@ -403,13 +1368,42 @@ class PSEye():
             parameters for the camera/s to acquire; see CLEYE_CODES for options
         sync_flag : multiprocessing Vaule
             used to synchronize multiple processes; ignored if None
+        ring_size : int
+            number of frames per camera that the shared-memory buffer between acquisition and saving can hold
+        backend : str
+            source of frames, one of the keys of CAMERA_BACKENDS: 'cleye' for PSEye cameras, 'synthetic' for generated frames, or 'replay' to stream a previously saved movie file
+        backend_params : dict
+            additional keyword arguments for the backend, ex. dict(path='x_cams.h5', realtime=False) for 'replay' (see the backend classes)
+        compression : str
+            codec for the saved movie, one of MOVIE_CODECS (see movie_codec; codecs other than gzip and lzf need hdf5plugin, also for reading the file)
+            Frames queued during a trial are flushed in the following inter-trial interval, so a flush should take well under the ITI (min_iti, 1 s by default). With 2 QVGA cameras at 60 fps on one core (benchmarks/camera_load.py, 8 s trials), lzf flushes took 0.17 s on average and 0.27 s at most; gzip level 1 took 0.6 s and 1.0 s, gzip level 4 1.1 s and 1.8 s, for a ~1.4x smaller file. gzip is therefore opt-in, for machines with several cores for the compression workers; 'blosc-lz4' (with hdf5plugin) is the other fast option, measure it with the same benchmark before relying on it.
+        compression_level : int
+            compression level for the codec
+        compression_filter : str
+            filter applied before compression, one of MOVIE_FILTERS (None, 'shuffle', 'bitshuffle')
+        crop : bool
+            if True, save only the region of the queried camera set by .set_crop() (typically the bounding box of the eyelid mask) rather than full frames
+        crop_margin : int
+            number of pixels around the mask to include in the crop
+        save_format : str
+            'h5' to compress and write frames to the HDF-5 file during acquisition, or 'raw' to append them uncompressed to memory-mapped files (see raw_movie.py), which is far cheaper under load; crop is not supported with 'raw'
+        raw_convert : bool
+            with save_format 'raw', convert the capture to the HDF-5 file (with the compression settings above) in a background process when .end() is called; otherwise use raw_movie.convert later
+        expected_duration : float
+            expected duration (s) of saving, used to preallocate the movie datasets; they are grown geometrically if it is exceeded
+        colour_format : str
+            for cameras in colour mode, the format to which frames are converted in the acquisition process, before buffering, querying and saving: one of COLOUR_FORMATS, i.e. 'grey', a single channel ('red', 'green', 'blue'), or 'rgb' (frames of shape (y,x,3))
 
         For example usage of this class, see the example in the main function of this module (bottom of file).
 
-        Note that the querying function is used by calling .get() on an instance of this class. Importantly, there is no guarantee that the frame is being delivered in real time. It is a mechanism for transferring frames with low priority between the acqusition and main processes, but not optimized for consistent real-time usage (though in practice it often does quite well).
+        Note that the querying function is used by calling .get() on an instance of this class. Every frame of the queried camera is published to a shared-memory double buffer as it is acquired, so .get() returns the newest frame immediately, without a handshake with the acquisition process. query_rate can therefore be as high as the camera's frame rate.
+        For signals needed from every frame, the acquisition process also computes the mean of a region of interest (set with .set_roi()) in every frame of the queried camera, retrieved with .get_roi_trace().
 
         The data are saved to an HDF-5 file, which can be read by any HDF-5 library (in C++, python, MATLAB, etc.)
         For each camera, there exists a dataset of frames, and a dataset of timestamps. The timestamps are Nx2, for system time and clock.
+        Each camera also has a dataset seq{i}, Nx2, holding for each frame its sequence number (counting every frame read from the camera, so gaps mark frames dropped before saving) and the number of frames the camera is estimated to have missed just before it.
+        In crop mode, the queried camera's frames are instead split into one dataset per crop, mov{i}_0, mov{i}_1, ..., and the dataset crop{i} holds a row [first_frame,x0,y0,x1,y1] for each, where first_frame is the index into ts{i} of the segment's first frame. Frames saved before any crop is set are full-size.
+        Trials marked with .mark_trial() are indexed in the dataset trials{i}, with a row [trial_idx,first_frame,last_frame] per trial (inclusive indices into ts{i}), so that a trial's frames can be sliced without searching the timestamps.
         """
 
         # CLEye Params; all should be tuples to allow for multiple cameras
@@ -422,6 +1416,18 @@ class PSEye():
         self.query_rate         = query_rate
         self.query_idx          = query_idx
         self.save_name          = save_name
+        self.ring_size          = ring_size
+        self.backend            = backend
+        self.backend_params     = backend_params
+        self.compression        = compression
+        self.compression_level  = compression_level
+        self.compression_filter = compression_filter
+        self.crop               = crop
+        self.crop_margin        = crop_margin
+        self.save_format        = save_format
+        self.raw_convert        = raw_convert
+        self.expected_duration  = expected_duration
+        self.colour_format      = colour_format
 
         # Special case for scenario where user uses shortcut for single camera, supplying straight params instead of n-length tuples
         if isinstance(self.idx, int):
@@ -437,42 +1443,94 @@ class PSEye():
 
         # Inferred params
         self.resolution = [_PSEye.DIMENSIONS[rm] for rm in self.resolution_mode]
+        self.frame_shape = [(y,x) if cm==_PSEye.GREYSCALE else ColourConverter((x,y), self.colour_format).shape for (x,y),cm in zip(self.resolution,self.color_mode)]
 
         # Shared variables for acqusition and saving processes
-        self.frame_buffer = [mp.Queue() for _ in range(self.n_cams)]
-        self.kill_flag = mp.Value('b',False)
+        self.frames_ready = mp.Event()
+        self.frame_buffer = [FrameRing(fs, n_slots=self.ring_size, ready=self.frames_ready) for fs in self.frame_shape]
+        self.latest_frame = LatestFrame(self.frame_shape[self.query_idx])
+        self.roi_trace = RoiTrace(self.frame_shape[self.query_idx])
+        self.kill_flag = mp.Event()
         self.saving = mp.Value('b', False)
         self.flushing = mp.Value('b', False)
+        self.crop_box = mp.Array('i', 4) if self.crop else None
+        self.crop_version = mp.RawValue('L', 0) if self.crop else None
+        self.trial_queue = mp.Queue()
+        self._stats = CameraStats(self.n_cams)
 
-        self.saver = MovieSaver(name=self.save_name, resolution=self.resolution, kill_flag=self.kill_flag, frame_buffer=self.frame_buffer, flushing=self.flushing, n_cams=self.n_cams, query_idx=self.query_idx)
-        self.pseye = _PSEye(idx=self.idx, resolution_mode=self.resolution_mode, frame_rate=self.frame_rate, color_mode=self.color_mode, frame_buffer=self.frame_buffer, kill_flag=self.kill_flag, saving_flag=self.saving, sync_flag=sync_flag, query_idx=self.query_idx, cleye_params=self.cleye_params)
+        if self.save_format == 'raw':
+            if self.crop:
+                warnings.warn('Cropping is not supported when saving raw movies; full frames will be saved.')
+                self.crop = False
+            self.saver = RawMovieSaver(name=self.save_name, kill_flag=self.kill_flag, frame_buffer=self.frame_buffer, n_cams=self.n_cams, trial_queue=self.trial_queue, stats=self._stats)
+        elif self.save_format == 'h5':
+            self.saver = MovieSaver(name=self.save_name, resolution=self.resolution, kill_flag=self.kill_flag, frame_buffer=self.frame_buffer, flushing=self.flushing, n_cams=self.n_cams, hdf_prealloc=[int(fr*self.expected_duration) for fr in self.frame_rate], compression=self.compression, compression_level=self.compression_level, compression_filter=self.compression_filter, crop_box=self.crop_box, crop_version=self.crop_version, crop_idx=self.query_idx, trial_queue=self.trial_queue, stats=self._stats)
+        else:
+            raise Exception('Save format {} not recognized.'.format(self.save_format))
+        self.pseye = _PSEye(idx=self.idx, resolution_mode=self.resolution_mode, frame_rate=self.frame_rate, color_mode=self.color_mode, frame_buffer=self.frame_buffer, kill_flag=self.kill_flag, saving_flag=self.saving, sync_flag=sync_flag, query_idx=self.query_idx, latest_frame=self.latest_frame, roi_trace=self.roi_trace, cleye_params=self.cleye_params, backend=self.backend, backend_params=self.backend_params, stats=self._stats, colour_format=self.colour_format)
 
         self.last_query = now()            
+        self.last_query_seq = 0
 
-    def get(self):
-        """Query a frame from the camera
+    def get(self, new_only=False, timeout=2.0):
+        """Query the most recent frame from the camera
 
-        Not guaranteed to work in real time, but if useful for online monitoring of feed
-        Returns at a maximum rate specified in initialization of the object
+        Returns immediately with the newest frame and its timestamp, at a maximum rate specified in initialization of the object (otherwise returns (None,None))
+
+        Parameters
+        ----------
+        new_only : bool
+            if True, return (None,None) when no frame has arrived since the previous call
+        timeout : float
+            maximum time (s) to wait if the camera has not yet delivered its first frame; if exceeded, returns (None,None)
         """
         if now()-self.last_query < 1./self.query_rate:
             return None,None
         self.last_query = now()
 
-        # query from saver (an old strategy that may be desired at points): 
-        #self.saver.query_flag.value = True
-        #fr = mp2np(self.saver.query_queue)
-        #frts = self.saver.query_queue_ts.value
-        
-        # query from _PSEye (a newer strategy that is preferable for most uses):
-        self.pseye.query_flag.value = True
-        while self.pseye.query_flag.value == True:
-            pass
-        fr = self.pseye.query_queue[0]
-        frts = self.pseye.query_queue_ts.value
+        seq,frts,fr = self.latest_frame.read()
+        t0 = now()
+        while seq == 0 and now()-t0 < timeout:
+            time.sleep(0.005)
+            seq,frts,fr = self.latest_frame.read()
+        if seq == 0 or (new_only and seq == self.last_query_seq):
+            return None,None
+        self.last_query_seq = seq
 
-        x,y = self.resolution[self.query_idx]
-        return frts,fr.reshape([y,x])
+        return frts[1],fr
+
+    def get_roi_trace(self, since=0, timeout=None):
+        """Retrieve the ROI means computed from the queried camera's frames, see RoiTrace
+
+        Parameters
+        ----------
+        since : int
+            number of samples already retrieved, i.e. the seq returned by the previous call; only newer samples are returned
+        timeout : float
+            if supplied, maximum time (s) to wait for a new sample
+
+        Returns
+        -------
+        seq : int
+            total number of samples computed so far
+        samples : np.ndarray
+            (n,3) array of [ts, ts2, value] per frame, oldest first (only the most recent RoiTrace.n_slots-1 are kept)
+        """
+        if timeout is not None and self.roi_trace.write_seq.value <= since:
+            self.roi_trace.ready.clear()
+            if self.roi_trace.write_seq.value <= since:
+                self.roi_trace.ready.wait(timeout)
+        return self.roi_trace.read(since)
+
+    def set_roi(self, mask):
+        """Set the region of interest whose mean is computed from every frame of the queried camera, see get_roi_trace
+
+        Parameters
+        ----------
+        mask : np.ndarray
+            (y,x) array, nonzero inside the region of interest, at the resolution of the queried camera; values weight the mean
+        """
+        self.roi_trace.set_mask(mask)
 
     def set_flush(self, val):
         """Set flushing to file on or off
@@ -483,7 +1541,60 @@ class PSEye():
             set flushing on (True) or off (False)
         """
         self.flushing.value = val
-    
+
+    def stats(self):
+        """Live acquisition and saving statistics for each camera, to check whether the pipeline keeps up
+
+        Returns
+        -------
+        list of dicts, one per camera, with the fields of CameraStats (frames captured, missed, late and saved, flush and resize timings, bytes written, compression ratio, flush duration histogram), and:
+            queued : frames currently waiting in the frame buffer between acquisition and saving
+            overflow : frames dropped because the frame buffer was full
+        """
+        snap = self._stats.snapshot()
+        for d,ring in zip(snap, self.frame_buffer):
+            d.update(queued=len(ring), overflow=int(ring.n_overflow.value))
+        return snap
+
+    def mark_trial(self, idx, start, end):
+        """Index the frames of a completed trial in the movie file
+
+        Parameters
+        ----------
+        idx : int
+            trial index
+        start : float
+            trial start time
+        end : float
+            trial end time
+
+        Times are in the clock of the acquisition process, i.e. the first column of the saved timestamps (the sync values can be used to convert from another process's clock)
+        """
+        self.trial_queue.put((idx, start, end))
+
+    def set_crop(self, mask):
+        """Restrict the saved movie of the queried camera to the bounding box of a mask, plus crop_margin pixels on each side
+
+        Has no effect unless the object was initialized with crop=True. Frames already acquired may still be saved with the previous crop; the crop{i} dataset records exactly which frames were saved with which crop.
+
+        Parameters
+        ----------
+        mask : np.ndarray
+            (y,x) array, nonzero inside the region of interest, at the resolution of the queried camera
+        """
+        if not self.crop:
+            return
+        ys,xs = np.nonzero(mask)
+        if len(xs) == 0:
+            logging.warning('Empty mask supplied, saving crop unchanged.')
+            return
+        x,y = self.resolution[self.query_idx]
+        m = self.crop_margin
+        box = [max(xs.min()-m,0), max(ys.min()-m,0), min(xs.max()+1+m,x), min(ys.max()+1+m,y)]
+        with self.crop_box.get_lock():
+            self.crop_box[:] = box
+            self.crop_version.value += 1
+
     def reset_cams(self):
         """Convenience method for resetting the camera feeds while class in instantiated and running
 
@@ -491,14 +1602,31 @@ class PSEye():
         """
         self.pseye.reset_cams()
 
-    def end(self):
+    def end(self, timeout=120.):
         """End acquisition and saving.
 
-        May take a few seconds.
+        May take a few seconds, while the saver flushes its remaining frames.
+
+        Parameters
+        ----------
+        timeout : float
+            time (s) to wait for each process to finish before logging an error and terminating it; a process that exits without finishing is reported at once
         """
-        self.kill_flag.value = True
-        while (not self.pseye.thread_complete.value) or (not self.saver.saving_complete.value):
-            pass
+        self.kill_flag.set()
+        for proc,complete,name in [(self.pseye, self.pseye.thread_complete, 'Camera acquisition'), (self.saver, self.saver.saving_complete, 'Movie saver')]:
+            t0 = now()
+            while not complete.wait(self.POLL):
+                if not proc.is_alive():
+                    logging.error('{} process ended unexpectedly.'.format(name))
+                    break
+                if now()-t0 > timeout:
+                    logging.error('{} process did not finish within {} s; terminating it.'.format(name, timeout))
+                    proc.terminate()
+                    break
+
+        if self.save_format == 'raw' and self.raw_convert:
+            self.converter = mp.Process(target=convert_raw_movie, args=(self.saver.base,), kwargs=dict(dest=self.saver.base+'.h5', compression=self.compression, compression_level=self.compression_level, compression_filter=self.compression_filter, remove=True))
+            self.converter.start()
 
     def begin_saving(self):
         """Call this method to begin saving to file.
@@ -517,6 +1645,13 @@ default_cam_params = dict(  idx=(0,1),
                             query_rate = 15,
                             frame_rate=(60,60), 
                             color_mode=(_PSEye.GREYSCALE,_PSEye.GREYSCALE),
+                            colour_format='grey', # conversion for cameras in colour mode
+                            compression='lzf', # see benchmarks/compression.py to compare options, and the PSEye docstring for flush times
+                            compression_level=1,
+                            compression_filter=None,
+                            crop=False,
+                            crop_margin=10,
+                            save_format='h5',
                             cleye_params = ( dict(
                                                     auto_gain = True,
                                                     auto_exposure = True,
@@ -4,7 +4,18 @@ import numpy as np
 MAX_SIZE = 1024
 DEV_SIZE = 256
 
-ni845x_dll = ctypes.windll.LoadLibrary('Ni845x.dll')
+class _LazyDLL(object):
+    """Loads the DLL on first use, so that this module can be imported where it is not available (ex. to use hardware/simulated.py)
+    """
+    def __init__(self, name):
+        self._name = name
+        self._dll = None
+    def __getattr__(self, attr):
+        if self._dll is None:
+            self._dll = ctypes.windll.LoadLibrary(self._name)
+        return getattr(self._dll, attr)
+
+ni845x_dll = _LazyDLL('Ni845x.dll')
 
 class Ni845xError(Exception):
     def __init__(self, status_code):
@@ -43,11 +54,16 @@ class NI845x():
         self._name = NextDevice
         
         self.i2c_on = i2c_on
+        self._i2c_msgs = {} # encoded I2C messages, see encode_i2c
+        self._ports = {} # cached ctypes port numbers
+        self._port_state = {} # shadow of the value of each port, read from the device at first use and then kept as written
+        self._port_val = ctypes.c_uint8(0)
         self._open()
         if self.i2c_on:
             self.config_i2c()
         self.set_io_voltage_level(self.VOLTS33)
         self.set_port_line_direction_map(self.OUTPUT*np.ones(8))
+        self._port_state[0] = self.read_port(0) # seeds the shadow without driving the lines (left as they were), and ahead of the first write, which may be a stimulus
         
     def _open(self):
         self.dev_handle = ctypes.c_int32()
@@ -73,11 +89,61 @@ class NI845x():
         if self.i2c_on:
             errChk(ni845x_dll.ni845xI2cConfigurationClose(self.i2c_handle))
 
+    def _port(self, port):
+        if port not in self._ports:
+            self._ports[port] = ctypes.c_uint8(port)
+        return self._ports[port]
+
+    def read_port(self, port=0):
+        """
+        Read the state of all 8 lines of a port (for output lines, the values being driven).
+
+        Parameters
+        ----------
+            port : Port number.
+
+        Returns
+        -------
+            Port value, bit i giving the state of line i.
+        """
+        val = ctypes.c_uint8(0)
+        errChk(ni845x_dll.ni845xDioReadPort(self.dev_handle, self._port(port), ctypes.byref(val)))
+        return val.value
+
+    def write_port(self, val, port=0):
+        """
+        Set all 8 lines of a port in one transaction.
+
+        Parameters
+        ----------
+            val : Port value, bit i giving the state of line i.
+            port : Port number.
+        """
+        self._port_val.value = val
+        errChk(ni845x_dll.ni845xDioWritePort(self.dev_handle, self._port(port), self._port_val))
+        self._port_state[port] = val
+
+    def write_lines(self, lines, port=0):
+        """
+        Set several lines of a port in one transaction, leaving the others unchanged.
+
+        Parameters
+        ----------
+            lines : Dict of line:value, or list of (line,value) pairs.
+            port : Port number.
+        """
+        if port not in self._port_state:
+            self._port_state[port] = self.read_port(port)
+        val = self._port_state[port]
+        for line,v in (lines.items() if isinstance(lines, dict) else lines):
+            if v:
+                val |= 1 << line
+            else:
+                val &= ~(1 << line)
+        self.write_port(val, port)
+
     def write_dio(self, line, val, port=0):
-        line = ctypes.c_uint8(line)
-        port = ctypes.c_uint8(port)
-        val = ctypes.c_int32(val)
-        errChk(ni845x_dll.ni845xDioWriteLine( self.dev_handle, port, line, val ))
+        self.write_lines([(line,val)], port)
         
     def config_i2c(self, size=None, address=0, clock_rate=100, timeout=2000):
         """
@@ -129,8 +195,19 @@ class NI845x():
         """
         if not self.i2c_on:
             return
-        data = ctypes.create_string_buffer(data)
-        nbytes = ctypes.c_int32(len(data))
+        buf,nbytes = self.encode_i2c(data)
+        errChk(ni845x_dll.ni845xI2cWrite(self.dev_handle, self.i2c_handle, nbytes, ctypes.byref(buf)))
+
+    def encode_i2c(self, data):
+        """
+        Encode a message for write_i2c, once; later writes of the same message reuse the encoded arguments.
 
-        errChk(ni845x_dll.ni845xI2cWrite(self.dev_handle, self.i2c_handle, nbytes, ctypes.byref(data)))
+        Returns
+        -------
+            (buffer, nbytes) ctypes arguments
+        """
+        if data not in self._i2c_msgs:
+            buf = ctypes.create_string_buffer(data)
+            self._i2c_msgs[data] = buf, ctypes.c_int32(len(buf))
+        return self._i2c_msgs[data]
         
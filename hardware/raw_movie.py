@@ -0,0 +1,333 @@
+"""
+Raw movie capture format: an append-only alternative to writing HDF-5 during acquisition
+
+Each camera's frames go to a sequence of memory-mapped segment files, {base}.cam{i}.{k:03d}.raw, each laid out as:
+    header (one page): magic string (including format version), frame shape, capacity (frames), number of frames written
+    frame info: capacity x 4 float64 ([ts, ts2, seq, missed] per frame, as in the ts{i} and seq{i} datasets)
+    frames: capacity x frame shape, uint8, starting on a page boundary
+Saving a frame is then a single copy into the mapping, followed by its info and the header count, with no compression or dataset resizing.
+The frames region is not allocated at once: extending a file on NTFS zero-fills the new space synchronously, which for a whole segment (ex. 1.4 GB at QVGA) would stall the saver for longer than the frame ring can absorb. Instead each file grows by extents of frames, each extended and mapped in a background thread while the previous one is written, see RawMovieWriter.
+Trial marks are appended as text lines "trial_idx start end" to {base}.trials.txt, and the saving statistics (see cameras.CameraStats) are written as JSON to {base}.stats.json when the capture is closed.
+
+convert() turns a capture into the usual *_cams.h5 layout (mov{i}, ts{i}, seq{i}, trials{i}, and the stats attribute), and RawMovieReader reads captures directly, including those of sessions that crashed mid-write.
+"""
+import os, glob, mmap, logging, threading, json, h5py
+import numpy as np
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+
+MAGIC = b'EYERAW01'
+HEADER_SIZE = mmap.PAGESIZE
+HEADER_DTYPE = np.dtype([('magic','S8'), ('ndim','<u8'), ('shape','<u8',(4,)), ('capacity','<u8'), ('n_frames','<u8')])
+
+def segment_name(base, cam, k):
+    return '{}.cam{}.{:03d}.raw'.format(base, cam, k)
+def trials_name(base):
+    return '{}.trials.txt'.format(base)
+def stats_name(base):
+    return '{}.stats.json'.format(base)
+
+def _layout(shape, capacity):
+    """Offsets (bytes) of the frame info and frame regions, and total file size, of a segment
+    """
+    info_offset = HEADER_SIZE
+    frames_offset = -(-(info_offset + capacity*4*8) // mmap.PAGESIZE) * mmap.PAGESIZE
+    return info_offset, frames_offset, frames_offset + capacity*int(np.product(shape))
+
+def _create_segment(path, shape, capacity):
+    """Create a segment file holding its header and frame info only; space for frames is added by _map_extent
+
+    Returns
+    -------
+    header, info : np.memmap views
+    """
+    info_offset,frames_offset,size = _layout(shape, capacity)
+    mm = np.memmap(path, dtype=np.uint8, mode='w+', shape=(frames_offset,))
+    header = mm[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0:1]
+    header['magic'] = MAGIC
+    header['ndim'] = len(shape)
+    header['shape'][0,:len(shape)] = shape
+    header['capacity'] = capacity
+    info = mm[info_offset:info_offset+capacity*4*8].view(np.float64).reshape((capacity,4))
+    return header, info
+
+def _map_extent(path, shape, capacity, first, n):
+    """Memory-map frames first to first+n of a segment file, extending the file to hold them
+    """
+    frames_offset = _layout(shape, capacity)[1]
+    return np.memmap(path, dtype=np.uint8, mode='r+', offset=frames_offset+first*int(np.product(shape)), shape=(n,)+tuple(shape))
+
+def _map_segment(path, mode='r'):
+    """Memory-map an existing segment file
+
+    Returns
+    -------
+    header, info, frames : np.memmap views
+    """
+    mm = np.memmap(path, dtype=np.uint8, mode=mode)
+    header = mm[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0:1]
+    if header['magic'][0] != MAGIC:
+        raise Exception('{} is not a raw movie segment.'.format(path))
+    shape = tuple(int(i) for i in header['shape'][0,:int(header['ndim'][0])])
+    capacity = int(header['capacity'][0])
+    info_offset,frames_offset,size = _layout(shape, capacity)
+    info = mm[info_offset:info_offset+capacity*4*8].view(np.float64).reshape((capacity,4))
+    n_avail = max(0, len(mm)-frames_offset) // int(np.product(shape)) # segments grow by extents, and are truncated to their contents when closed
+    frames = mm[frames_offset:frames_offset+n_avail*int(np.product(shape))].reshape((n_avail,)+tuple(shape))
+    return header, info, frames
+
+class RawMovieWriter(object):
+    """Appends the frames of one camera to raw segment files
+
+    Space for frames is added to the files extent_frames at a time. The next extent (in the next segment file, if the current one is full) is always being prepared in a background thread while the current one is written, so that the time taken by the filesystem to extend the file is not spent in write().
+
+    Parameters
+    ----------
+    base : str
+        path and name of the capture, without extension
+    cam : int
+        camera index
+    shape : tuple of ints
+        shape of a frame
+    segment_frames : int
+        frames per segment file; a new segment is started whenever one fills
+    extent_frames : int
+        frames by which segment files grow
+    """
+    def __init__(self, base, cam, shape, segment_frames=18000, extent_frames=128):
+        self.base = base
+        self.cam = cam
+        self.shape = tuple(shape)
+        self.segment_frames = segment_frames
+        self.extent_frames = min(extent_frames, segment_frames)
+        self.n_segments = 0
+        self.n_frames = 0 # in current segment
+        self.header = self.info = self.extent = None
+        self.extent_start = 0 # index in the current segment of the first frame of the current extent
+        self._prefetch(0, 0)
+        self._next_extent()
+
+    def _prepare(self, seg, ext):
+        # creates segment seg if ext is 0, and maps its extent ext
+        path = segment_name(self.base, self.cam, seg)
+        header_info = _create_segment(path, self.shape, self.segment_frames) if ext == 0 else None
+        first = ext*self.extent_frames
+        return path, header_info, _map_extent(path, self.shape, self.segment_frames, first, min(self.extent_frames, self.segment_frames-first))
+
+    def _prefetch(self, seg, ext):
+        """Start preparing extent ext of segment seg in a background thread
+        """
+        result = {}
+        def prepare():
+            try:
+                result['value'] = self._prepare(seg, ext)
+            except Exception as e:
+                result['error'] = e
+        thread = threading.Thread(target=prepare)
+        thread.daemon = True
+        thread.start()
+        self._pending = ((seg, ext), thread, result)
+
+    def _next_extent(self):
+        """Move on to the prepared extent (waiting for it if need be), closing the current segment if the extent begins a new one, and start preparing the one after it
+        """
+        (seg,ext),thread,result = self._pending
+        thread.join()
+        self._pending = None
+        if 'error' in result:
+            raise result['error']
+        path,header_info,extent = result['value']
+        if ext == 0:
+            if self.header is not None:
+                self._close_segment()
+            self.path = path
+            self.header,self.info = header_info
+            self.n_segments += 1
+            self.n_frames = 0
+        self.extent = extent
+        self.extent_start = ext*self.extent_frames
+        if self.extent_start+len(extent) < self.segment_frames:
+            self._prefetch(seg, ext+1)
+        else:
+            self._prefetch(seg+1, 0)
+
+    def _close_segment(self):
+        """Flush the current segment, and cut the unused frame space off the end of its file
+        """
+        self.extent.flush()
+        self.header.flush()
+        size = _layout(self.shape, self.segment_frames)[1] + self.n_frames*int(np.product(self.shape))
+        self.header = self.info = self.extent = None # releases the mappings
+        with open(self.path, 'r+b') as f:
+            f.truncate(size)
+
+    def write(self, frame, ts, seq=(0,0)):
+        """Append a frame
+
+        The frame is copied first and its timestamps last, followed by the header count, so that a nonzero timestamp always marks a complete frame
+
+        Parameters
+        ----------
+        frame : np.ndarray
+            frame of self.shape
+        ts : array-like
+            [ts, ts2] of the frame
+        seq : array-like
+            [seq, missed] of the frame
+        """
+        if self.n_frames == self.extent_start+len(self.extent):
+            self._next_extent()
+        i = self.n_frames
+        self.extent[i-self.extent_start] = frame
+        self.info[i,2:] = seq
+        self.info[i,:2] = ts
+        self.n_frames += 1
+        self.header['n_frames'] = self.n_frames
+
+    def close(self):
+        # the extent prepared ahead is discarded (with its file, if it would have begun a new segment), so that the current segment can be truncated
+        (seg,ext),thread,result = self._pending
+        thread.join()
+        self._pending = None
+        result.clear()
+        if ext == 0 and os.path.exists(segment_name(self.base, self.cam, seg)):
+            os.remove(segment_name(self.base, self.cam, seg))
+        self._close_segment()
+
+class RawMovieReader(object):
+    """Reads the frames of one camera from a raw capture
+
+    The frame count of a segment is taken from its header, or, if the writer did not close it (ex. the session crashed), from the last frame with nonzero timestamps, whichever is larger.
+
+    Parameters
+    ----------
+    base : str
+        path and name of the capture, without extension
+    cam : int
+        camera index
+
+    Frames are accessed by indexing, ex. reader[100:200], timestamps by reader.ts, and sequence numbers by reader.seq
+    """
+    def __init__(self, base, cam):
+        paths = sorted(glob.glob('{}.cam{}.*.raw'.format(base, cam)))
+        if len(paths) == 0:
+            raise Exception('No raw movie found for camera {} of {}.'.format(cam, base))
+        self.segments = []
+        for path in paths:
+            header,info,frames = _map_segment(path, 'r')
+            n = int(header['n_frames'][0])
+            written = np.nonzero(info[:len(frames),0])[0]
+            if len(written) and written[-1]+1 > n:
+                logging.warning('{}: header reports {} frames but {} were written, the capture was not closed properly.'.format(path, n, written[-1]+1))
+                n = written[-1]+1
+            self.segments.append((info[:n],frames[:n]))
+        self.shape = self.segments[0][1].shape[1:]
+        self.starts = np.cumsum([0]+[len(info) for info,_ in self.segments])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    @property
+    def ts(self):
+        return np.concatenate([info[:,:2] for info,_ in self.segments])
+    @property
+    def seq(self):
+        return np.concatenate([info[:,2:] for info,_ in self.segments]).astype(np.int64)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            i0,i1,step = idx.indices(len(self))
+            if step != 1:
+                return self[i0:i1][::step]
+            out = np.empty((max(i1-i0,0),)+self.shape, dtype=np.uint8)
+            for (info,frames),s0 in zip(self.segments, self.starts):
+                a,b = max(i0,s0),min(i1,s0+len(frames))
+                if a < b:
+                    out[a-i0:b-i0] = frames[a-s0:b-s0]
+            return out
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        k = np.searchsorted(self.starts, idx, side='right')-1
+        return np.array(self.segments[k][1][idx-self.starts[k]])
+
+def read_trials(base):
+    """Trial marks of a raw capture, as an (n,3) array of [trial_idx, start, end]
+    """
+    path = trials_name(base)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros((0,3))
+    return np.loadtxt(path, ndmin=2)
+
+def convert(base, dest=None, compression='lzf', compression_level=1, compression_filter=None, chunk_frames=16, block_frames=1024, n_workers=None, remove=False):
+    """Convert a raw capture to the *_cams.h5 layout written by MovieSaver: datasets mov{i}, ts{i}, seq{i}, trials{i} if trials were marked, and the stats attribute if the capture was closed
+
+    Parameters
+    ----------
+    base : str
+        path and name of the capture, without extension
+    dest : str
+        destination file (default: base+'.h5')
+    compression, compression_level, compression_filter :
+        codec settings, see cameras.movie_codec
+    chunk_frames : int
+        number of frames per hdf5 chunk
+    block_frames : int
+        number of frames read and compressed at a time
+    n_workers : int
+        number of compression threads (default: number of cpus)
+    remove : bool
+        delete the raw files once converted
+    """
+    from cameras import movie_codec, _write_chunks # here, since cameras imports this module
+
+    dest = dest or base+'.h5'
+    comp,encode = movie_codec(compression, compression_level, compression_filter)
+    pool = ThreadPool(n_workers or mp.cpu_count())
+    n_cams = len(set(p.split('.cam')[-1].split('.')[0] for p in glob.glob('{}.cam*.raw'.format(base))))
+    marks = read_trials(base)
+    block_frames = -(-block_frames//chunk_frames)*chunk_frames
+
+    with h5py.File(dest, 'w') as f:
+        if os.path.exists(stats_name(base)):
+            with open(stats_name(base)) as sf:
+                f.attrs['stats'] = sf.read()
+        for i in range(n_cams):
+            reader = RawMovieReader(base, i)
+            n = len(reader)
+            n_alloc = -(-n//chunk_frames)*chunk_frames
+            vw = f.create_dataset('mov{}'.format(i), (n_alloc,)+reader.shape, maxshape=(None,)+reader.shape, dtype='uint8', chunks=(chunk_frames,)+reader.shape, **comp)
+            for i0 in range(0, n, block_frames):
+                block = reader[i0:i0+block_frames]
+                if len(block) % chunk_frames:
+                    block = np.concatenate([block, np.zeros((chunk_frames-len(block)%chunk_frames,)+reader.shape, dtype=np.uint8)])
+                _write_chunks(vw, i0, block, encode, pool)
+            vw.resize(n, axis=0)
+            ts = reader.ts
+            f.create_dataset('ts{}'.format(i), data=ts, maxshape=(None,2), dtype=np.float64, **comp)
+            vwseq = f.create_dataset('seq{}'.format(i), data=reader.seq, maxshape=(None,2), dtype=np.int64, **comp)
+            vwseq.attrs['columns'] = 'seq,missed'
+
+            if len(marks):
+                first = np.searchsorted(ts[:,0], marks[:,1], side='left')
+                last = np.searchsorted(ts[:,0], marks[:,2], side='right')-1
+                empty = first > last
+                first[empty],last[empty] = -1,-1
+                vwtrials = f.create_dataset('trials{}'.format(i), data=np.array([marks[:,0],first,last]).T.astype(np.int64), maxshape=(None,3))
+                vwtrials.attrs['columns'] = 'trial_idx,first_frame,last_frame'
+    pool.close()
+    logging.info('Converted raw capture {} to {}'.format(base, dest))
+
+    if remove:
+        for path in glob.glob('{}.cam*.raw'.format(base)) + glob.glob(trials_name(base)) + glob.glob(stats_name(base)):
+            os.remove(path)
+
+if __name__ == '__main__':
+    """
+    Convert raw captures from the command line, ex.:
+        python raw_movie.py data/1/20160705103903_cams
+    """
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    for base in sys.argv[1:]:
+        convert(base)
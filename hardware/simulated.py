@@ -0,0 +1,149 @@
+"""
+Software stand-ins for the NI845x and DAQmx devices, for running and profiling sessions without the hardware (ex. on linux)
+
+They are used in place of the real devices when config.simulate_hardware is True.
+"""
+import threading, logging, collections
+import multiprocessing as mp
+import numpy as np
+from ni845x import NI845x
+from util import now, now2, Waiter
+
+class SimulatedNI845x(NI845x):
+    """Stand-in for NI845x, which logs DIO and I2C writes with their timestamps instead of performing them
+
+    The port shadow (and so write_lines) behaves as with the device. The most recent writes are kept in .writes as (ts, ts2, kind, value) tuples, and all are logged at debug level.
+
+    Parameters
+    ----------
+    i2c_on : bool
+        as for NI845x
+    max_writes : int
+        number of writes kept in .writes
+    """
+    def __init__(self, i2c_on=True, max_writes=10000):
+        self.i2c_on = i2c_on
+        self._i2c_msgs = {}
+        self._ports = {}
+        self._port_state = {}
+        self.writes = collections.deque(maxlen=max_writes)
+        self._port_state[0] = self.read_port(0)
+
+    def _log(self, kind, value):
+        ts,ts2 = now(),now2()
+        self.writes.append((ts, ts2, kind, value))
+        logging.debug('Simulated NI845x: {} {} at {:.6f}'.format(kind, value, ts))
+
+    def config_i2c(self, *args, **kwargs):
+        pass
+    def set_io_voltage_level(self, lev):
+        pass
+    def set_port_line_direction_map(self, mapp, port=0):
+        pass
+
+    def read_port(self, port=0):
+        # the simulated lines are low until written
+        return self._port_state.get(port, 0)
+
+    def write_port(self, val, port=0):
+        self._port_state[port] = val
+        self._log('dio', (port, val))
+
+    def write_i2c(self, data):
+        if not self.i2c_on:
+            return
+        self.encode_i2c(data)
+        self._log('i2c', data)
+
+    def end(self):
+        self._log('end', None)
+
+class SimulatedDAQIn(object):
+    """Stand-in for DAQIn, generating signals at sample_rate and delivering them through the same EveryNCallback contract: every read_buffer_size samples, [ts, ts2, data] is put on data_q, data being (n_ports*read_buffer_size,) grouped by channel
+
+    Signals, per port:
+        'wheel' : a rotary encoder, alternating between 0 and 5 V at wheel_rate Hz during running bouts, and flat otherwise; bouts and pauses have exponentially distributed durations
+        'beam' : a beam-break sensor, at 5 V except for brief breaks of 0 V
+    All signals carry gaussian noise.
+
+    Parameters
+    ----------
+    ports, read_buffer_size, sample_rate :
+        as for DAQIn (other DAQIn arguments are accepted and ignored)
+    signals : list of str
+        signal per port (default: 'wheel' for the first port, 'beam' for others)
+    run_mean, still_mean : float
+        mean durations (s) of running bouts and of pauses
+    wheel_rate : float
+        encoder transitions per second while running
+    noise : float
+        standard deviation (V) of the noise
+    seed : int
+        random seed
+    """
+    def __init__(self, device='Dev1', ports=['ai0'], read_buffer_size=10, sample_rate=400., signals=None, run_mean=2., still_mean=6., wheel_rate=40., noise=0.02, seed=0, **kwargs):
+        self.port_names = ports
+        self.read_buffer_size = read_buffer_size
+        self.sample_rate = sample_rate
+        self.signals = signals or ['wheel']+['beam']*(len(ports)-1)
+        self.run_mean = run_mean
+        self.still_mean = still_mean
+        self.wheel_rate = wheel_rate
+        self.noise = noise
+        self.rs = np.random.RandomState(seed)
+
+        self.effective_buffer_size = self.read_buffer_size * len(self.port_names)
+        self.read_data = np.zeros(self.effective_buffer_size)
+        self.last_ts = None
+        self.data_q = mp.Queue()
+
+        # generator state
+        self._running = False
+        self._phase = 0.
+        self._level = 0.
+        self._t = np.arange(self.read_buffer_size) / self.sample_rate
+
+        self._on = True
+        self._thread = threading.Thread(target=self._clock)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _clock(self):
+        # stands in for the DAQmx sample clock: one callback per read_buffer_size samples, on an absolute schedule
+        waiter = Waiter()
+        period = self.read_buffer_size / float(self.sample_rate)
+        t0 = now()
+        k = 0
+        while self._on:
+            k += 1
+            waiter.until(t0 + k*period)
+            waiter.pop_overshoots() # not used, and would grow for the life of the device
+            self.EveryNCallback()
+
+    def _generate(self, out):
+        dur = self.read_buffer_size / float(self.sample_rate)
+        if self.rs.rand() < dur/(self.run_mean if self._running else self.still_mean):
+            self._running = not self._running
+        for i,sig in enumerate(self.signals):
+            chan = out[i*self.read_buffer_size:(i+1)*self.read_buffer_size]
+            if sig == 'wheel':
+                if self._running:
+                    chan[:] = 5. * (np.floor(self._phase + self._t*self.wheel_rate) % 2)
+                    self._level = chan[-1]
+                else:
+                    chan[:] = self._level # holds its last level when still
+            elif sig == 'beam':
+                chan[:] = 0. if self.rs.rand() < 0.01 else 5.
+            chan += self.noise * self.rs.randn(len(chan))
+        if self._running:
+            self._phase += dur*self.wheel_rate
+
+    def EveryNCallback(self):
+        self.last_ts = now()
+        self.last_ts2 = now2()
+        self._generate(self.read_data)
+        self.data_q.put([self.last_ts, self.last_ts2, self.read_data.copy()])
+        return 0
+
+    def release(self):
+        self._on = False
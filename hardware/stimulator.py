@@ -0,0 +1,194 @@
+import os, sys, logging, Queue, ctypes, traceback
+import multiprocessing as mp
+import numpy as np
+import config
+if config.simulate_hardware:
+    from simulated import SimulatedNI845x as NI845x
+else:
+    from ni845x import NI845x
+from util import now, now2, Waiter, ClockSync
+from settings.constants import *
+
+def compile_timeline(kind, cs_dur, us_dur, csus_gap):
+    """Compile the stimulus schedule of a trial into a timeline of events
+
+    Parameters
+    ----------
+    kind : int
+        CS, US, or CSUS (see settings.constants)
+    cs_dur, us_dur, csus_gap : float
+        durations (s), as in the session parameters
+
+    Returns
+    -------
+    list of (offset, i2c, line, val) tuples, sorted by offset: at offset (s) from the start of the stimulus, write i2c (str, or None) to the I2C bus, then val to DIO line (or nothing if line is None)
+    For US trials, the US starts cs_dur after the start, for continuity with the other trial types.
+    """
+    if kind == CS:
+        events = [  (0.,                'CS_ON',    LINE_CS,    1),
+                    (cs_dur,            'CS_OFF',   LINE_CS,    0)]
+    elif kind == US:
+        events = [  (cs_dur,            'US_ON',    LINE_US,    1),
+                    (cs_dur+us_dur,     'US_OFF',   LINE_US,    0)]
+    elif kind == CSUS:
+        events = [  (0.,                'CS_ON',    LINE_CS,    1),
+                    (csus_gap,          'US_ON',    LINE_US,    1),
+                    (csus_gap+us_dur,   'US_OFF',   LINE_US,    0),
+                    (cs_dur,            'CS_OFF',   LINE_CS,    0)]
+    else:
+        raise Exception('Stimulus kind {} not recognized.'.format(kind))
+    return sorted(events, key=lambda e: e[0]) # stable, so simultaneous events keep their order
+
+def _raise_priority():
+    """Raise the priority of the calling process, if permitted
+    """
+    try:
+        if sys.platform.startswith('win'):
+            k32 = ctypes.windll.kernel32
+            k32.SetPriorityClass(k32.GetCurrentProcess(), 0x80) # HIGH_PRIORITY_CLASS
+        else:
+            os.nice(-10)
+    except (OSError, AttributeError):
+        logging.warning('Could not raise the priority of the stimulator process.')
+
+class Stimulator(mp.Process):
+    """A high-priority process that owns the NI845x device, and plays stimulus timelines (see compile_timeline) at precise times
+
+    Timelines are played with a Waiter, away from the GIL contention of the session's threads, so the interval between events (in particular the CS-US interval) does not depend on the load of the main process.
+    write_dio and write_i2c are forwarded to the device in order, so the object can stand in for an NI845x in the main process.
+    Errors in the process are sent back and raised in the main process: those in opening the device by wait_ready(), those while playing by play(), and those of other writes by the next play(). If the process dies, these raise instead of blocking.
+
+    Parameters
+    ----------
+    i2c_on : bool
+        passed to NI845x
+    sync_flag : multiprocessing Value
+        used to synchronize multiple processes; ignored if None
+    """
+    POLL = 0.1 # interval (s) at which the main process checks that the stimulator process is alive while waiting on it
+
+    def __init__(self, i2c_on=True, sync_flag=None):
+        super(Stimulator, self).__init__()
+        self.daemon = True
+        self.i2c_on = i2c_on
+
+        # Sync
+        self.sync_flag = sync_flag
+        self.clock_sync = ClockSync(sync_flag)
+
+        self.cmd_q = mp.Queue()
+        self.result_q = mp.Queue()
+        self.complete = mp.Event()
+
+        self.start()
+
+    def run(self):
+        self.clock_sync.wait()
+
+        _raise_priority()
+        try:
+            self.ni = NI845x(i2c_on=self.i2c_on)
+        except Exception:
+            self.result_q.put(('error', traceback.format_exc()))
+            self.complete.set()
+            return
+        self.waiter = Waiter()
+        self.result_q.put(('ready', None))
+
+        error = None # of a write, reported in reply to the next play, as writes have no reply
+        while True:
+            cmd = self.cmd_q.get()
+            if cmd[0] == 'end':
+                break
+            try:
+                if cmd[0] == 'play':
+                    if error is not None:
+                        self.result_q.put(('error', error))
+                        error = None
+                    else:
+                        self.result_q.put(('times', self._play(*cmd[1:])))
+                elif cmd[0] == 'dio':
+                    self.ni.write_dio(*cmd[1:])
+                elif cmd[0] == 'i2c':
+                    self.ni.write_i2c(*cmd[1:])
+            except Exception:
+                logging.error('Stimulator error in command {}.'.format(cmd[0]))
+                if cmd[0] == 'play':
+                    self.result_q.put(('error', traceback.format_exc()))
+                else:
+                    error = traceback.format_exc()
+
+        self.ni.end()
+        self.complete.set()
+
+    def _result(self):
+        # next message from the stimulator process, raising its errors, and raising rather than blocking if it has died
+        while True:
+            try:
+                kind,val = self.result_q.get(timeout=self.POLL)
+            except Queue.Empty:
+                if not self.is_alive():
+                    raise Exception('Stimulator process ended unexpectedly.')
+                continue
+            if kind == 'error':
+                raise Exception('Error in stimulator process:\n{}'.format(val))
+            return val
+
+    def wait_ready(self):
+        """Return once the process has opened the device (after the clock sync, see util.ClockSync), raising any error it encountered in doing so
+        """
+        self._result()
+
+    def _play(self, events, t0):
+        # batch simultaneous events, so that their lines change in a single port write, right after their I2C messages
+        batches = []
+        for i,(offset,i2c,line,val) in enumerate(events):
+            if not batches or batches[-1][0] != offset:
+                batches.append((offset, [], [], []))
+            batches[-1][1].append(i)
+            if i2c is not None:
+                batches[-1][2].append(i2c)
+                self.ni.encode_i2c(i2c) # ahead of time
+            if line is not None:
+                batches[-1][3].append((line,val))
+
+        times = np.empty((len(events),2))
+        for offset,idxs,i2cs,lines in batches:
+            self.waiter.until(t0+offset)
+            times[idxs] = now(), now2()
+            for i2c in i2cs:
+                self.ni.write_i2c(i2c)
+            if lines:
+                self.ni.write_lines(lines)
+        self.waiter.pop_overshoots() # lateness is measured from the returned times instead
+        return times
+
+    def play(self, events, t0):
+        """Play a timeline, returning once it is complete
+
+        Parameters
+        ----------
+        events : list
+            timeline, see compile_timeline
+        t0 : float
+            start of the timeline, in the clock (now()) of the stimulator process (the sync values can be used to convert from another process's clock)
+
+        Returns
+        -------
+        (n,2) array of the (now, now2) times at which each event was written, now in the stimulator's clock
+        """
+        self.cmd_q.put(('play', events, t0))
+        return self._result()
+
+    def write_dio(self, line, val, port=0):
+        self.cmd_q.put(('dio', line, val, port))
+
+    def write_i2c(self, data):
+        self.cmd_q.put(('i2c', data))
+
+    def end(self):
+        self.cmd_q.put(('end',))
+        while not self.complete.wait(self.POLL):
+            if not self.is_alive():
+                logging.error('Stimulator process ended unexpectedly.')
+                break
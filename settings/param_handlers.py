@@ -1,6 +1,6 @@
 import numpy as np
 from hardware.cameras import default_cam_params
-import logging
+import logging, config
 from settings.constants import *
 
 class ParamHandler(object):
@@ -27,16 +27,17 @@ class ParamHandler(object):
         display_lag                 = 1., #second
         
         # cam parameters
-        cam_params                  = default_cam_params,
+        cam_params                  = dict(default_cam_params, backend='synthetic') if config.simulate_hardware else default_cam_params,
         
-        # eyelid parameters
-        eyelid_buffer_size          = 130,
-        eyelid_window               = 10,
+        # eyelid parameters (durations converted into samples of the eyelid trace, one per frame of the queried camera, by the session)
+        eyelid_buffer_dur           = 8.7, #second
+        eyelid_window               = 0.67, #second
         eyelid_thresh               = -1,
 
         # Experiment parameters
         subj                        = None,
         imaging                     = False,
+        expected_duration           = 2400., # s, typical session length, for preallocating the movie (longer sessions grow it)
       )
 
 
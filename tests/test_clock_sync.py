@@ -0,0 +1,62 @@
+"""
+Tests of the clock synchronization handshake between the session's processes (util.ClockSync, util.sync_clocks)
+
+Run from within the main project directory, ex.:
+    python -m unittest discover tests
+"""
+import os, sys, time, shutil, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import multiprocessing as mp
+from util import now, ClockSync, sync_clocks
+from hardware.cameras import PSEye, _PSEye
+
+class _SlowStart(mp.Process):
+    # a process that takes delay s to reach its clock sync, as when importing modules, or exits without reaching it
+    def __init__(self, flag, delay, reach=True):
+        super(_SlowStart, self).__init__()
+        self.delay = delay
+        self.reach = reach
+        self.clock_sync = ClockSync(flag)
+        self.start()
+    def run(self):
+        time.sleep(self.delay)
+        if self.reach:
+            self.clock_sync.wait()
+
+class TestClockSync(unittest.TestCase):
+
+    def test_slow_start(self):
+        # the flag is only set once the process is waiting on it, so its clock value is taken just after the parent's
+        flag = mp.Value('b', False)
+        proc = _SlowStart(flag, delay=0.5)
+        t,vals = sync_clocks(flag, dict(slow=proc))
+        proc.join()
+        self.assertTrue(flag.value)
+        if not sys.platform.startswith('win'): # where now() has a per-process zero
+            self.assertGreaterEqual(vals['slow'], t-0.001)
+            self.assertLess(vals['slow'], t+0.1)
+
+    def test_process_ends(self):
+        flag = mp.Value('b', False)
+        proc = _SlowStart(flag, delay=0., reach=False)
+        with self.assertRaises(Exception):
+            sync_clocks(flag, dict(dead=proc), timeout=5.)
+        self.assertFalse(flag.value)
+
+    def test_pseye_immediate(self):
+        # the camera's acquisition process is synced as soon as the PSEye is constructed, as by Session
+        tmp = tempfile.mkdtemp()
+        flag = mp.Value('b', False)
+        cam = PSEye(idx=(0,), resolution_mode=(_PSEye.RES_SMALL,), frame_rate=(60,), color_mode=(_PSEye.GREYSCALE,), cleye_params=({},), sync_flag=flag, save_name=os.path.join(tmp, 'sync_test_cams.h5'), backend='synthetic')
+        try:
+            t,vals = sync_clocks(flag, dict(cam=cam.pseye))
+            self.assertNotEqual(vals['cam'], 0)
+            if not sys.platform.startswith('win'):
+                self.assertGreaterEqual(vals['cam'], t-0.001)
+                self.assertLess(vals['cam'], t+0.1)
+        finally:
+            cam.end()
+            shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == '__main__':
+    unittest.main()
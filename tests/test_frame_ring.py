@@ -0,0 +1,90 @@
+"""
+Tests of the shared-memory frame ring between the acquisition and saving processes (hardware.cameras.FrameRing)
+
+Run from within the main project directory, ex.:
+    python -m unittest discover tests
+"""
+import os, sys, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import multiprocessing as mp
+import numpy as np
+from hardware.cameras import FrameRing
+
+def _produce(ring, n):
+    # producer in a child process: writes frame i filled with i%256, as a driver would, through claim and commit
+    i = 0
+    while i < n:
+        slot = ring.claim()
+        if slot is None:
+            continue
+        ring.frames[slot][...] = i % 256
+        ring.commit([i, i+0.5], i%2, (i, 0))
+        i += 1
+
+class TestFrameRing(unittest.TestCase):
+
+    def test_slots_page_aligned(self):
+        ring = FrameRing((7,9), n_slots=4) # frames smaller than a page, of an odd size
+        for i in range(ring.n_slots):
+            self.assertEqual(ring.frames[i].ctypes.data % FrameRing.PAGE_SIZE, 0)
+        self.assertEqual(ring.slot_stride, FrameRing.PAGE_SIZE)
+
+    def test_claim_commit_release(self):
+        ring = FrameRing((4,5), n_slots=3)
+        self.assertIsNone(ring.oldest())
+        for i in range(3):
+            slot = ring.claim()
+            self.assertEqual(slot, i)
+            ring.frames[slot][...] = i
+            ring.commit([i, -i], True, (i, 1))
+        self.assertEqual(len(ring), 3)
+        self.assertIsNone(ring.claim()) # full
+        self.assertFalse(ring.put(np.zeros((4,5)), [9,9], True))
+        self.assertEqual(ring.n_overflow.value, 1)
+
+        slot = ring.oldest()
+        self.assertEqual(slot, 0)
+        self.assertTrue(np.all(ring.frames[slot] == 0))
+        self.assertEqual(list(ring.ts[slot]), [0, 0])
+        ring.release()
+        # the released slot is the next to be claimed, after wrapping
+        self.assertEqual(ring.claim(), 0)
+        self.assertTrue(ring.put(np.full((4,5), 3), [3, -3], False, (3, 0)))
+        order = []
+        while ring.oldest() is not None:
+            order.append(ring.oldest())
+            ring.release()
+        self.assertEqual(order, [1, 2, 0])
+        self.assertTrue(np.all(ring.frames[0] == 3))
+        self.assertEqual(len(ring), 0)
+
+    def test_ready_event(self):
+        ready = mp.Event()
+        ring = FrameRing((2,2), n_slots=2, ready=ready)
+        self.assertFalse(ready.is_set())
+        ring.put(np.ones((2,2)), [0,0], True)
+        self.assertTrue(ready.is_set())
+
+    def test_across_processes(self):
+        # every frame reaches the consumer intact and in order, though the ring is much smaller than the stream
+        n = 2000
+        ring = FrameRing((16,16), n_slots=8)
+        proc = mp.Process(target=_produce, args=(ring, n))
+        proc.start()
+        got = 0
+        while got < n:
+            slot = ring.oldest()
+            if slot is None:
+                self.assertTrue(proc.is_alive() or ring.oldest() is not None)
+                continue
+            self.assertTrue(np.all(ring.frames[slot] == got % 256))
+            self.assertEqual(list(ring.ts[slot]), [got, got+0.5])
+            self.assertEqual(list(ring.seq[slot]), [got, 0])
+            self.assertEqual(ring.saving[slot], got % 2)
+            ring.release()
+            got += 1
+        proc.join()
+        self.assertEqual(ring.n_overflow.value, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+"""
+Tests of the streaming movement detection of the analog reader (hardware.analog_reader.MovementDetector), against a brute-force count over the window
+
+Run from within the main project directory, ex.:
+    python -m unittest discover tests
+"""
+import os, sys, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+from hardware.analog_reader import MovementDetector
+
+class TestMovementDetector(unittest.TestCase):
+
+    def test_against_brute_force(self):
+        # windows longer and shorter than the blocks, down to a single sample, and blocks longer than the window
+        rng = np.random.RandomState(1)
+        thresh,magnitude = 3.,0.5
+        for window,block in [(500,10), (7,10), (2,10), (1,10), (50,3), (50,1)]:
+            md = MovementDetector(window, thresh, magnitude)
+            hist = np.zeros(0)
+            for k in range(300):
+                blk = np.where(rng.rand(block) < .1, 5., 0.)*(rng.rand() < .5) + .02*rng.randn(block)
+                hist = np.concatenate([hist, blk])
+                moving = md.update(blk)
+                count = np.sum(np.abs(np.diff(hist[-window:])) >= magnitude)
+                self.assertEqual(md.count, count, (window, block, k))
+                self.assertEqual(moving, count > thresh)
+
+    def test_edges(self):
+        # differences of exactly magnitude count, in either direction, including across blocks
+        md = MovementDetector(5, 1, 1.)
+        self.assertFalse(md.update([0., 1.]))
+        self.assertEqual(md.count, 1)
+        self.assertTrue(md.update([0.]))
+        self.assertEqual(md.count, 2)
+        md.update([0., 0., 0.]) # the events leave the window
+        self.assertEqual(md.count, 1)
+        md.update([0.])
+        self.assertEqual(md.count, 0)
+
+if __name__ == '__main__':
+    unittest.main()
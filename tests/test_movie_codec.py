@@ -0,0 +1,64 @@
+"""
+Tests of the movie compression settings (hardware.cameras.movie_codec) and the direct chunk writes that use them (_write_chunks)
+
+Run from within the main project directory, ex.:
+    python -m unittest discover tests
+"""
+import os, sys, shutil, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import h5py
+from hardware.cameras import movie_codec, _write_chunks, MOVIE_CODECS, MOVIE_FILTERS, hdf5plugin
+
+def _frames(n, shape=(24,32)):
+    # smooth frames with noise, compressible like camera frames
+    y,x = np.mgrid[:shape[0],:shape[1]]
+    rng = np.random.RandomState(0)
+    return np.array([(x+y+i) % 200 + rng.randint(0,8,shape) for i in range(n)], dtype=np.uint8)
+
+class TestMovieCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.pool = ThreadPool(2)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def round_trip(self, codec, level=1, filter=None, chunk=8):
+        frames = _frames(3*chunk)
+        kwargs,encode = movie_codec(codec, level, filter)
+        with h5py.File(os.path.join(self.tmp, 'codec_test.h5'), 'w') as f:
+            ds = f.create_dataset('mov', (len(frames),)+frames.shape[1:], dtype='uint8', chunks=(chunk,)+frames.shape[1:], **kwargs)
+            n_bytes = _write_chunks(ds, 0, frames[:2*chunk], encode, self.pool)
+            n_bytes += _write_chunks(ds, 2*chunk, frames[2*chunk:], encode, self.pool)
+            self.assertTrue(np.array_equal(ds[:], frames), (codec, level, filter))
+            self.assertEqual(n_bytes, ds.id.get_storage_size())
+        return n_bytes
+
+    def test_round_trip(self):
+        codecs = MOVIE_CODECS if hdf5plugin is not None else ['gzip','lzf']
+        for codec in codecs:
+            for filter in MOVIE_FILTERS:
+                try:
+                    movie_codec(codec, 1, filter)
+                except Exception:
+                    continue # combination not supported, see test_invalid
+                self.round_trip(codec, 1, filter)
+
+    def test_gzip_level(self):
+        # the level takes effect in the direct-write encoder
+        self.assertLess(self.round_trip('gzip', level=9), self.round_trip('gzip', level=1))
+
+    def test_invalid(self):
+        for args in [('nocodec',1,None), ('lzf',1,'nofilter'), ('gzip',1,'bitshuffle'), ('lzf',1,'bitshuffle')]:
+            with self.assertRaises(Exception):
+                movie_codec(*args)
+        if hdf5plugin is None:
+            with self.assertRaises(Exception):
+                movie_codec('blosc-lz4')
+
+if __name__ == '__main__':
+    unittest.main()
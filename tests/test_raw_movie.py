@@ -0,0 +1,97 @@
+"""
+Tests of the raw capture format (hardware.raw_movie): segment and extent rollover, recovery of captures that were not closed, and conversion to HDF-5
+
+Run from within the main project directory, ex.:
+    python -m unittest discover tests
+"""
+import os, sys, glob, shutil, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import multiprocessing as mp
+import numpy as np
+import h5py
+from hardware.raw_movie import RawMovieWriter, RawMovieReader, segment_name, trials_name, convert, _layout
+
+SHAPE = (6,8)
+
+def _frame(i):
+    return np.full(SHAPE, i%250+1, dtype=np.uint8)
+
+def _write(base, n, segment_frames, extent_frames, close=True):
+    w = RawMovieWriter(base, 0, SHAPE, segment_frames=segment_frames, extent_frames=extent_frames)
+    for i in range(n):
+        w.write(_frame(i), [i+1., i+1.5], (i, i%3))
+    if close:
+        w.close()
+    return w
+
+def _crash(base, n):
+    # writes n frames in a child process that exits without closing the writer
+    _write(base, n, 50, 16, close=False)
+    os._exit(0)
+
+class TestRawMovie(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmp, 'raw_test_cams')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def check(self, n):
+        r = RawMovieReader(self.base, 0)
+        self.assertEqual(len(r), n)
+        self.assertEqual(list(r[:][:,0,0]), [_frame(i)[0,0] for i in range(n)])
+        self.assertTrue(np.all(r.ts == np.column_stack([np.arange(1,n+1), np.arange(1,n+1)+0.5])))
+        self.assertTrue(np.all(r.seq[:,0] == np.arange(n)))
+        if n:
+            self.assertTrue(np.all(r[n-1] == _frame(n-1)))
+            self.assertTrue(np.all(r[-1] == _frame(n-1)))
+        return r
+
+    def test_rollover(self):
+        # frame counts at, across and between extent and segment boundaries
+        for segment_frames,extent_frames,n in [(50,16,1), (50,16,16), (50,16,17), (50,16,50), (50,16,123), (50,64,77), (7,3,30)]:
+            for path in glob.glob(self.base+'*'):
+                os.remove(path)
+            _write(self.base, n, segment_frames, extent_frames)
+            self.check(n)
+            # closed segments are truncated to their frames, and no empty segment is left behind
+            paths = sorted(glob.glob(self.base+'.cam0.*.raw'))
+            self.assertEqual(len(paths), -(-n//segment_frames))
+            frames_offset = _layout(SHAPE, segment_frames)[1]
+            sizes = [frames_offset+min(segment_frames, n-k*segment_frames)*np.product(SHAPE) for k in range(len(paths))]
+            self.assertEqual([os.path.getsize(p) for p in paths], sizes)
+
+    def test_crash_recovery(self):
+        # a capture whose writer never closed keeps its preallocated extents, but is read up to its last frame
+        proc = mp.Process(target=_crash, args=(self.base, 70))
+        proc.start()
+        proc.join()
+        self.assertGreater(os.path.getsize(segment_name(self.base, 0, 1)), _layout(SHAPE, 50)[1]+20*np.product(SHAPE))
+        self.check(70)
+
+    def test_header_behind(self):
+        # the header count lags the frames actually written (ex. a crash between the two), and the timestamps are used instead
+        w = _write(self.base, 20, 50, 16, close=False)
+        w.header['n_frames'] = 3
+        for m in [w.header, w.info, w.extent]:
+            m.flush()
+        self.check(20)
+
+    def test_convert(self):
+        _write(self.base, 75, 50, 16)
+        with open(trials_name(self.base), 'w') as f:
+            f.write('0 10.0 20.2\n1 100.0 101.0\n')
+        dest = self.base+'.h5'
+        convert(self.base, dest, compression='lzf', chunk_frames=16, block_frames=32, remove=True)
+        self.assertEqual(glob.glob(self.base+'.cam*'), [])
+        with h5py.File(dest, 'r') as f:
+            self.assertEqual(f['mov0'].shape, (75,)+SHAPE)
+            self.assertTrue(np.all(f['mov0'][:] == np.array([_frame(i) for i in range(75)])))
+            self.assertTrue(np.all(f['ts0'][:,0] == np.arange(1,76)))
+            self.assertTrue(np.all(f['seq0'][:,1] == np.arange(75)%3))
+            self.assertEqual(f['trials0'][:].tolist(), [[0,9,19], [1,-1,-1]])
+
+if __name__ == '__main__':
+    unittest.main()
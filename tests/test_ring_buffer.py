@@ -0,0 +1,75 @@
+"""
+Tests of the eyelid history buffer (util.RingBuffer), against a plain list of the items appended
+
+Run from within the main project directory, ex.:
+    python -m unittest discover tests
+"""
+import os, sys, threading, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+from util import RingBuffer
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_fill(self):
+        rb = RingBuffer(4, fill=-1)
+        self.assertEqual(len(rb), 4)
+        self.assertEqual(list(rb.view()), [-1]*4)
+        rb.append(5)
+        self.assertEqual(list(rb.view()), [-1,-1,-1,5])
+        self.assertEqual(rb.count, 1)
+
+    def test_against_list(self):
+        # mixed appends and extends, including extends longer than the buffer
+        rng = np.random.RandomState(0)
+        rb = RingBuffer(7, shape=(2,))
+        ref = [np.zeros(2)]*7
+        k = 0
+        for step in range(300):
+            n = rng.randint(0, 12)
+            items = np.arange(k, k+n).repeat(2).reshape((n,2)) * [1,-1]
+            k += n
+            if step % 3 == 0:
+                for it in items:
+                    rb.append(it)
+            else:
+                rb.extend(items)
+            ref.extend(items)
+            self.assertEqual(rb.count, k)
+            for m in [None, 1, 3, 7, 10]:
+                expect = np.array(ref[-(m or 7):][-7:])
+                self.assertTrue(np.array_equal(rb.view(m), expect))
+                self.assertTrue(np.array_equal(rb.snapshot(m), expect))
+            self.assertTrue(np.allclose(rb.mean(3), np.mean(ref[-3:], axis=0)))
+
+    def test_view_is_contiguous(self):
+        rb = RingBuffer(5)
+        rb.extend(np.arange(8))
+        v = rb.view(4)
+        self.assertTrue(v.flags['C_CONTIGUOUS'])
+        self.assertTrue(np.may_share_memory(v, rb._data))
+        self.assertFalse(np.may_share_memory(rb.snapshot(4), rb._data))
+
+    def test_concurrent_snapshots(self):
+        # a snapshot taken while another thread writes is always a run of consecutive items
+        rb = RingBuffer(50, shape=(2,))
+        rb.extend([[i,i] for i in range(50)])
+        done = threading.Event()
+        def write():
+            i = 50
+            while not done.is_set():
+                rb.extend([[j,j] for j in range(i,i+7)])
+                i += 7
+        th = threading.Thread(target=write)
+        th.start()
+        try:
+            for _ in range(2000):
+                s = rb.snapshot(30)
+                self.assertTrue(np.all(s[:,0] == s[:,1]))
+                self.assertTrue(np.all(np.diff(s[:,0]) == 1))
+        finally:
+            done.set()
+            th.join()
+
+if __name__ == '__main__':
+    unittest.main()
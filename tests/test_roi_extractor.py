@@ -0,0 +1,67 @@
+"""
+Tests of the ROI means computed in proportion to the size of the regions (util.RoiExtractor), against the full-frame weighted mean
+
+Run from within the main project directory, ex.:
+    python -m unittest discover tests
+"""
+import os, sys, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+from util import RoiExtractor
+
+def _masks(shape=(40,60)):
+    dense = np.zeros(shape)
+    dense[5:20,10:40] = 1
+    dense[5,10] = 0.5 # weighted edge
+    box = np.zeros(shape)
+    box[30:35,2:8] = 1 # uniform, fills its bounding box
+    sparse = np.zeros(shape)
+    sparse[np.arange(0,40,3), np.arange(0,60,4)[:14]] = 1 # a diagonal, sparse in its bounding box
+    sparse_w = sparse.copy()
+    sparse_w[0,0] = 0.25
+    return [dense, box, sparse, sparse_w]
+
+def _brute(frames, m):
+    # weighted mean over the full frame
+    return np.tensordot(np.asarray(frames, dtype=np.float64), m, axes=2) / m.sum()
+
+class TestRoiExtractor(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def test_single(self):
+        frames = self.rng.randint(0, 256, (5,40,60)).astype(np.uint8)
+        for m in _masks():
+            ex = RoiExtractor(m)
+            self.assertTrue(np.allclose(ex(frames[0]), _brute(frames[0], m)))
+            self.assertTrue(np.allclose(ex(frames), _brute(frames, m)))
+        # the dense and sparse paths agree
+        for m in _masks():
+            self.assertTrue(np.allclose(RoiExtractor(m, dense_fill=0.)(frames), RoiExtractor(m, dense_fill=1.1)(frames)))
+
+    def test_several(self):
+        frames = self.rng.randint(0, 256, (2,3,40,60)).astype(np.uint8)
+        masks = _masks()
+        out = RoiExtractor(np.array(masks))(frames)
+        self.assertEqual(out.shape, (2,3,len(masks)))
+        for i,m in enumerate(masks):
+            self.assertTrue(np.allclose(out[...,i], _brute(frames, m)))
+
+    def test_channels(self):
+        frames = self.rng.randint(0, 256, (4,40,60,3)).astype(np.uint8)
+        masks = _masks()
+        for m in masks:
+            ex = RoiExtractor(m, channel_axis=-1)
+            self.assertEqual(ex(frames[0]).shape, (3,))
+            self.assertTrue(np.allclose(ex(frames), [[_brute(fr[...,k], m) for k in range(3)] for fr in frames]))
+        out = RoiExtractor(np.array(masks), channel_axis=-1)(frames)
+        self.assertEqual(out.shape, (4,len(masks),3))
+        with self.assertRaises(Exception):
+            RoiExtractor(masks[0], channel_axis=0)
+
+    def test_empty(self):
+        self.assertEqual(RoiExtractor(np.zeros((4,4)))(np.ones((4,4))), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+Tests of the shared-memory eyelid trace written by the acquisition process (hardware.cameras.RoiTrace)
+
+Run from within the main project directory, ex.:
+    python -m unittest discover tests
+"""
+import os, sys, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import multiprocessing as mp
+import numpy as np
+from hardware.cameras import RoiTrace
+
+def _write(rt, n):
+    # writer in a child process: frame i has ROI mean i, and timestamps [i,i]
+    for i in range(n):
+        rt.update(np.full(rt.shape, i%256, dtype=np.uint8), [i, i])
+
+class TestRoiTrace(unittest.TestCase):
+
+    def test_no_mask(self):
+        rt = RoiTrace((4,4), n_slots=8)
+        rt.update(np.ones((4,4), dtype=np.uint8), [0,0])
+        seq,samples = rt.read()
+        self.assertEqual((seq,len(samples)), (0,0))
+
+    def test_mask_and_colour(self):
+        rt = RoiTrace((4,6,3), n_slots=8)
+        mask = np.zeros((4,6))
+        mask[1:3,2:5] = 1
+        rt.set_mask(mask)
+        frame = np.arange(4*6*3, dtype=np.uint8).reshape((4,6,3))
+        rt.update(frame, [1.,2.])
+        seq,samples = rt.read()
+        self.assertEqual(seq, 1)
+        self.assertEqual(list(samples[0,:2]), [1.,2.])
+        self.assertAlmostEqual(samples[0,2], frame[1:3,2:5].mean())
+        # a new mask is picked up at the next frame
+        rt.set_mask(np.ones((4,6)))
+        rt.update(frame, [3.,4.])
+        self.assertAlmostEqual(rt.read(since=1)[1][0,2], frame.mean())
+
+    def test_read_since(self):
+        rt = RoiTrace((4,4), n_slots=8)
+        rt.set_mask(np.ones((4,4)))
+        for i in range(20):
+            rt.update(np.full((4,4), i, dtype=np.uint8), [i,i])
+            seq,samples = rt.read(0)
+            self.assertEqual(seq, i+1)
+            # at most n_slots-1 samples, the most recent, oldest first
+            self.assertEqual(list(samples[:,2]), list(range(max(0,i-6), i+1)))
+            seq2,samples2 = rt.read(max(seq-3,0))
+            self.assertEqual(list(samples2[:,2]), list(range(max(0,i-2), i+1)))
+
+    def test_concurrent_reads(self):
+        # reads racing a writer in another process never return a torn or out-of-order sample
+        n = 20000
+        rt = RoiTrace((8,8), n_slots=16)
+        rt.set_mask(np.ones((8,8)))
+        proc = mp.Process(target=_write, args=(rt, n))
+        proc.start()
+        seq,last = 0,-1
+        while seq < n:
+            seq,samples = rt.read(since=seq)
+            if len(samples):
+                ts = samples[:,0].astype(int)
+                self.assertTrue(np.all(samples[:,2] == ts % 256))
+                self.assertTrue(np.all(np.diff(ts) == 1))
+                self.assertGreater(ts[0], last)
+                self.assertEqual(ts[-1], seq-1)
+                last = ts[-1]
+            else:
+                self.assertTrue(proc.is_alive() or rt.write_seq.value > seq)
+        proc.join()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Tests of the analog reader's shared sample ring (hardware.analog_reader.SharedAccumulator)
+
+Run from within the main project directory, ex.:
+    python -m unittest discover tests
+"""
+import os, sys, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import multiprocessing as mp
+import numpy as np
+from hardware.analog_reader import SharedAccumulator
+
+def _write(acc, n_blocks, block):
+    # writer in a child process: sample j of channel c is j*(c+1), with timestamp j
+    j = 0
+    for _ in range(n_blocks):
+        ts = np.arange(j, j+block, dtype=float)
+        acc.write(np.array([ts*(c+1) for c in range(acc.n_channels)]), ts)
+        j += block
+
+class TestSharedAccumulator(unittest.TestCase):
+
+    def test_against_list(self):
+        # blocks shorter and longer than the ring, with per-sample and per-block timestamps
+        rng = np.random.RandomState(0)
+        acc = SharedAccumulator(2, 10)
+        ref,ref_ts = [[0.]*10, [0.]*10],[0.]*10
+        for k in range(200):
+            n = rng.randint(1, 25)
+            data = rng.randn(2, n)
+            ts = np.arange(n)+100.*k if k%2 else float(k)
+            acc.write(data, ts)
+            for c in range(2):
+                ref[c].extend(data[c])
+            ref_ts.extend(np.broadcast_to(ts, (n,)))
+            data,ts = acc.snapshot()
+            self.assertTrue(np.array_equal(data, np.array([r[-10:] for r in ref])))
+            self.assertTrue(np.array_equal(ts, ref_ts[-10:]))
+            self.assertEqual(acc.idx.value, len(ref_ts)-10)
+
+    def test_views(self):
+        acc = SharedAccumulator(1, 5)
+        acc.write(np.arange(7.)[None], np.arange(7.))
+        seq,(d0,d1),(t0,t1) = acc.views()
+        self.assertEqual(list(np.concatenate([d0,d1], axis=1)[0]), [2.,3.,4.,5.,6.])
+        self.assertEqual(list(np.concatenate([t0,t1])), [2.,3.,4.,5.,6.])
+        self.assertFalse(acc.changed(seq))
+        acc.write(np.ones((1,1)), 7.)
+        self.assertTrue(acc.changed(seq))
+
+    def test_concurrent_snapshots(self):
+        # snapshots taken while another process writes are consistent: consecutive samples, matching their timestamps
+        acc = SharedAccumulator(2, 64)
+        proc = mp.Process(target=_write, args=(acc, 20000, 7))
+        proc.start()
+        n = 0
+        while proc.is_alive() or n == 0:
+            data,ts = acc.snapshot()
+            if ts[-1] == 0:
+                continue
+            self.assertTrue(np.array_equal(data[0], ts))
+            self.assertTrue(np.array_equal(data[1], 2*ts))
+            self.assertTrue(np.all(np.diff(ts[ts > 0]) == 1))
+            n += 1
+        proc.join()
+
+if __name__ == '__main__':
+    unittest.main()
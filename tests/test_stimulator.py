@@ -0,0 +1,84 @@
+"""
+Tests of stimulus timelines (hardware.stimulator): their compilation from the session parameters, and their playback against the simulated NI845x
+
+Run from within the main project directory, ex.:
+    python -m unittest discover tests
+"""
+import os, sys, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import config
+from util import now, Waiter
+from settings.constants import CS, US, CSUS, LINE_CS, LINE_US
+from hardware.stimulator import Stimulator, compile_timeline
+from hardware.simulated import SimulatedNI845x
+
+class _Player(object):
+    # the playback of a Stimulator, run in this process against a simulated device
+    _play = Stimulator.__dict__['_play']
+    def __init__(self):
+        self.ni = SimulatedNI845x()
+        self.waiter = Waiter()
+
+class TestCompileTimeline(unittest.TestCase):
+
+    def test_kinds(self):
+        cs_dur,us_dur,gap = 0.5,0.03,0.25
+        self.assertEqual(compile_timeline(CS, cs_dur, us_dur, gap), [(0.,'CS_ON',LINE_CS,1), (cs_dur,'CS_OFF',LINE_CS,0)])
+        self.assertEqual(compile_timeline(US, cs_dur, us_dur, gap), [(cs_dur,'US_ON',LINE_US,1), (cs_dur+us_dur,'US_OFF',LINE_US,0)])
+        self.assertEqual(compile_timeline(CSUS, cs_dur, us_dur, gap), [(0.,'CS_ON',LINE_CS,1), (gap,'US_ON',LINE_US,1), (gap+us_dur,'US_OFF',LINE_US,0), (cs_dur,'CS_OFF',LINE_CS,0)])
+        with self.assertRaises(Exception):
+            compile_timeline(-1, cs_dur, us_dur, gap)
+
+    def test_sorted(self):
+        # a US that outlasts the CS, and simultaneous offsets, which keep their order
+        events = compile_timeline(CSUS, 0.25, 0.1, 0.2)
+        self.assertEqual([e[1] for e in events], ['CS_ON','US_ON','CS_OFF','US_OFF'])
+        events = compile_timeline(CSUS, 0.375, 0.125, 0.25)
+        self.assertEqual([e[0] for e in events], [0.,0.25,0.375,0.375])
+        self.assertEqual([e[1] for e in events], ['CS_ON','US_ON','US_OFF','CS_OFF'])
+
+class TestPortShadow(unittest.TestCase):
+
+    def test_open_and_write_lines(self):
+        # opening the device reads the port rather than driving it; writes of single lines keep the others
+        ni = SimulatedNI845x()
+        self.assertEqual(len(ni.writes), 0)
+        ni.write_dio(LINE_CS, 1)
+        ni.write_lines([(LINE_US,1), (LINE_CS,0)])
+        ni.write_dio(2, 1, port=1)
+        self.assertEqual([val for ts,ts2,kind,val in ni.writes], [(0,1<<LINE_CS), (0,1<<LINE_US), (1,1<<2)])
+
+class TestPlay(unittest.TestCase):
+
+    def test_play(self):
+        player = _Player()
+        events = compile_timeline(CSUS, 0.1, 0.02, 0.05) + [(0.1, 'X', None, None)]
+        events = sorted(events, key=lambda e: e[0])
+        player.ni.writes.clear()
+        t0 = now()+0.05
+        times = player._play(events, t0)
+        offsets = np.array([e[0] for e in events])
+        self.assertTrue(np.all(times[:,0] >= t0+offsets))
+        self.assertTrue(np.all(times[:,0] < t0+offsets+0.02))
+        # events at the same offset share one port write, after their I2C messages
+        writes = [(kind,val) for ts,ts2,kind,val in player.ni.writes]
+        cs,us = 1<<LINE_CS, 1<<LINE_US
+        self.assertEqual(writes, [('i2c','CS_ON'), ('dio',(0,cs)), ('i2c','US_ON'), ('dio',(0,cs|us)), ('i2c','US_OFF'), ('dio',(0,cs)), ('i2c','CS_OFF'), ('i2c','X'), ('dio',(0,0))])
+
+    @unittest.skipIf(config.simulate_hardware, 'the simulated device always opens')
+    def test_open_error(self):
+        # without the NI-845x driver (ex. on linux), the error in opening the device is raised by wait_ready rather than blocking
+        try:
+            import ctypes
+            ctypes.windll.LoadLibrary('Ni845x.dll')
+            self.skipTest('NI-845x driver present')
+        except (AttributeError, OSError):
+            pass
+        stim = Stimulator(i2c_on=False)
+        with self.assertRaises(Exception):
+            stim.wait_ready()
+        stim.end()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Tests of the per-trial frame index written to the movie file (PSEye.mark_trial, the trials{i} datasets)
+
+Run from within the main project directory, ex.:
+    python -m unittest discover tests
+"""
+import os, sys, time, shutil, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import h5py
+from util import now
+from hardware.cameras import PSEye, _PSEye
+
+class TestTrialsIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'trials_test_cams.h5')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_trial_frames(self):
+        n = 2
+        cam = PSEye(idx=(0,1), resolution_mode=(_PSEye.RES_SMALL,)*n, frame_rate=(60,)*n, color_mode=(_PSEye.GREYSCALE,)*n, cleye_params=({},)*n, query_rate=100, save_name=self.path, backend='synthetic')
+        try:
+            t = now()
+            while cam.get()[1] is None: # frames flowing before the first trial
+                self.assertLess(now()-t, 10.)
+                time.sleep(0.05)
+            cam.begin_saving()
+            cam.set_flush(True)
+            time.sleep(0.3)
+            cam.mark_trial(0, -10., -9.) # before any frame
+            marks = []
+            for i in range(1,3):
+                t0 = now()
+                cam.set_flush(False)
+                time.sleep(0.6)
+                t1 = now()
+                cam.set_flush(True)
+                cam.mark_trial(i, t0, t1)
+                marks.append((i,t0,t1))
+                time.sleep(0.3)
+            cam.mark_trial(3, now()-0.2, now()+60.) # still running at the end: indexed with the frames saved
+        finally:
+            cam.end()
+
+        with h5py.File(self.path, 'r') as f:
+            for c in range(n):
+                trials = f['trials{}'.format(c)][:]
+                ts = f['ts{}'.format(c)][:,0]
+                self.assertEqual(list(trials[:,0]), [0,1,2,3])
+                self.assertEqual(list(trials[0,1:]), [-1,-1])
+                for (tidx,first,last),(i,t0,t1) in zip(trials[1:3], marks):
+                    # first and last are the inclusive bounds of the frames within [t0,t1]
+                    self.assertGreaterEqual(ts[first], t0)
+                    self.assertLess(ts[first-1], t0)
+                    self.assertLessEqual(ts[last], t1)
+                    self.assertGreater(ts[last+1], t1)
+                    self.assertGreater(last-first, 20) # ~36 frames at 60 fps
+                self.assertEqual(trials[3,2], len(ts)-1)
+                self.assertLess(trials[3,1], trials[3,2])
+
+if __name__ == '__main__':
+    unittest.main()
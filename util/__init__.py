@@ -1,4 +1,7 @@
-from custom_time import now,now2
+from custom_time import now,now2,Waiter,ClockSync,sync_clocks
 from logs import setup_logging
 from tcpip import TCPIP
-from email import email_alert
\ No newline at end of file
+from email import email_alert
+from roi import RoiExtractor
+from ring_buffer import RingBuffer
+from shared_views import SharedViews
@@ -1,7 +1,136 @@
-import time
+import time, sys, atexit
+import multiprocessing as mp
+
+if sys.platform.startswith('win'):
+    _clock = time.clock #Platform-dependent, on windows has high precision. no correspondence to "real" time of day
+else:
+    _clock = time.time # elsewhere, time.clock measures processor time rather than elapsed time, so it cannot be used
 
 def now():
-    return time.clock() #Platform-dependent, on windows has high precision. no correspondence to "real" time of day
+    return _clock()
     #return time.time() # Platform-invariant, but low resolution on windows
 def now2():
     return time.time()
+
+_timer_period = None
+def set_timer_resolution(ms=1):
+    """On windows, raise the resolution of the system timer (and so of time.sleep) to ms milliseconds for the life of the process; elsewhere does nothing
+    """
+    global _timer_period
+    if not sys.platform.startswith('win') or _timer_period is not None:
+        return
+    import ctypes
+    winmm = ctypes.windll.winmm
+    if winmm.timeBeginPeriod(ms) == 0:
+        _timer_period = ms
+        atexit.register(winmm.timeEndPeriod, ms)
+
+class Waiter(object):
+    """Waits until deadlines precisely without occupying a core: sleeps until shortly before the deadline, then spins on now() for the remainder
+
+    The sleep margin adapts to how much time.sleep oversleeps on this machine: it grows at once to cover any oversleep, and decays slowly back towards min_margin.
+    Deadlines are absolute (in the now() clock), so a sequence of waits can be scheduled from one start time without accumulating drift.
+    The overshoot of each wait (time of return minus deadline) is recorded in .overshoots until retrieved with pop_overshoots().
+
+    Parameters
+    ----------
+    min_margin : float
+        minimum time (s) before the deadline at which sleeping stops and spinning begins
+    max_margin : float
+        maximum margin (s)
+    """
+    def __init__(self, min_margin=0.0003, max_margin=0.005):
+        set_timer_resolution()
+        self.min_margin = min_margin
+        self.max_margin = max_margin
+        self.margin = 0.002 if sys.platform.startswith('win') else min_margin
+        self.overshoots = []
+
+    def until(self, deadline):
+        """Wait until deadline (now() clock)
+
+        Returns
+        -------
+        time of return (now() clock)
+        """
+        t = now()
+        sleep = deadline - self.margin - t
+        if sleep > 0:
+            time.sleep(sleep)
+            t = now()
+            oversleep = t - (deadline - self.margin)
+            self.margin = min(self.max_margin, max(self.min_margin, 0.99*self.margin, 1.5*(oversleep+self.min_margin)))
+        while t < deadline:
+            t = now()
+        self.overshoots.append(t-deadline)
+        return t
+
+    def wait(self, dur, t0=None):
+        """Wait until dur seconds after t0 (now() clock; default: now)
+        """
+        if t0 is None:
+            t0 = now()
+        return self.until(t0+dur)
+
+    def pop_overshoots(self):
+        """Overshoots (s) of the waits since the last call
+        """
+        ov,self.overshoots = self.overshoots,[]
+        return ov
+
+class ClockSync(object):
+    """One process's side of the handshake that relates the now() clocks of a session's processes (whose clocks can have different zeros, ex. time.clock on windows)
+
+    The process calls wait() when it starts: it signals ready, spins until the shared flag is set, then records its clock in val and signals done. The parent uses sync_clocks() to set the flag only once every process is spinning, and to collect the values only once every process has recorded them.
+
+    Parameters
+    ----------
+    flag : multiprocessing Value
+        shared by all processes; if None, wait() returns at once
+    """
+    def __init__(self, flag):
+        self.flag = flag
+        self.val = mp.Value('d', 0)
+        self.ready = mp.Event()
+        self.done = mp.Event()
+
+    def wait(self):
+        if self.flag is None:
+            return
+        self.ready.set()
+        while not self.flag.value:
+            pass
+        self.val.value = now()
+        self.done.set()
+
+def _wait_process_event(event, proc, name, timeout, poll=0.1):
+    t0 = now()
+    while not event.wait(poll):
+        if not proc.is_alive():
+            raise Exception('Process {} ended before synchronizing its clock.'.format(name))
+        if now()-t0 > timeout:
+            raise Exception('Process {} did not synchronize its clock within {} s.'.format(name, timeout))
+
+def sync_clocks(flag, procs, timeout=30.):
+    """Parent side of the ClockSync handshake
+
+    Parameters
+    ----------
+    flag : multiprocessing Value
+        the flag of the processes' ClockSync objects
+    procs : dict
+        name : process, each having a clock_sync attribute
+    timeout : float
+        maximum time (s) to wait for each process to become ready (ex. importing modules), and to record its clock
+
+    Returns
+    -------
+    this process's now() when the flag was set, and a dict of name : the processes' now() just after they saw it
+    """
+    for name,p in procs.items():
+        _wait_process_event(p.clock_sync.ready, p, name, timeout)
+    flag.value = True
+    t = now()
+    for name,p in procs.items():
+        _wait_process_event(p.clock_sync.done, p, name, timeout)
+    return t, {name:p.clock_sync.val.value for name,p in procs.items()}
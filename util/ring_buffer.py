@@ -0,0 +1,73 @@
+import threading
+import numpy as np
+
+class RingBuffer(object):
+    """A fixed-capacity buffer of the most recent items of a stream, with O(1) appends
+
+    Every item is stored twice, at i and i+capacity, so that the most recent n items are always contiguous: view() returns them in order without copying.
+    Writers and snapshot()/mean() hold a lock, so a reader in another thread (ex. the GUI) never sees a partially written buffer.
+
+    Parameters
+    ----------
+    capacity : int
+        number of items held
+    shape : tuple of ints
+        shape of an item, ex. () for scalars or (2,) for [ts, value] pairs
+    dtype : numpy dtype
+        data type of items
+    fill : scalar
+        initial value of all items; the buffer always holds capacity items, the oldest being fill until it has been filled once
+    """
+    def __init__(self, capacity, shape=(), dtype=np.float64, fill=0):
+        self.capacity = capacity
+        self.shape = tuple(shape)
+        self._data = np.full((2*capacity,)+self.shape, fill, dtype=dtype)
+        self._i = 0 # position of the next write, in [0,capacity)
+        self.count = 0 # total items ever appended
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.capacity
+
+    def append(self, x):
+        with self.lock:
+            i = self._i
+            self._data[i] = x
+            self._data[i+self.capacity] = x
+            self._i = (i+1) % self.capacity
+            self.count += 1
+
+    def extend(self, xs):
+        """Append several items at once, oldest first
+        """
+        xs = np.asarray(xs)
+        n = len(xs)
+        xs = xs[-self.capacity:]
+        with self.lock:
+            i,c = self._i,self.capacity
+            k = min(len(xs), c-i) # items that fit before wrapping
+            self._data[i:i+k] = self._data[i+c:i+c+k] = xs[:k]
+            self._data[:len(xs)-k] = self._data[c:c+len(xs)-k] = xs[k:]
+            self._i = (i+len(xs)) % c
+            self.count += n
+
+    def view(self, n=None):
+        """The most recent n items (default: all), oldest first, without copying
+
+        The view is only valid until the next write; use snapshot() when writes may occur concurrently
+        """
+        n = self.capacity if n is None else min(n, self.capacity)
+        end = self._i + self.capacity
+        return self._data[end-n:end]
+
+    def snapshot(self, n=None):
+        """A copy of the most recent n items (default: all), oldest first, consistent with respect to concurrent writes
+        """
+        with self.lock:
+            return self.view(n).copy()
+
+    def mean(self, n=None):
+        """Mean of the most recent n items (default: all), over items
+        """
+        with self.lock:
+            return self.view(n).mean(axis=0)
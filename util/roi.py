@@ -0,0 +1,75 @@
+import numpy as np
+
+class RoiExtractor(object):
+    """Computes the (weighted) mean intensity of one or more regions of interest in frames, in time proportional to the size of the regions rather than of the frames
+
+    Each mask is reduced once to its bounding box, and, if it fills less than dense_fill of that box, to the flat indices and weights of its nonzero pixels.
+    Dense regions are then summed over their bounding box, sparse ones over their pixels only.
+
+    Parameters
+    ----------
+    masks : np.ndarray
+        (y,x) mask, or (n_rois,y,x) masks, nonzero inside the region of interest; values weight the mean (ex. the antialiased edges of cv2.fillConvexPoly)
+    dense_fill : float
+        fraction of its bounding box above which a region is summed over the box rather than gathered by index
+    channel_axis : int
+        None for frames without channels, or -1 for frames with channels along the last axis (y,x,c), as from colour cameras; the channels are then indexed in place, without rearranging the frame
+
+    Calling the object on a frame (y,x), or a batch of frames (...,y,x), returns the means with shape (...) for a single mask, or (...,n_rois) for several
+    With channel_axis=-1, frames are (...,y,x,c) and the means gain a trailing channel axis: (...,c) or (...,n_rois,c)
+    """
+    def __init__(self, masks, dense_fill=0.5, channel_axis=None):
+        if channel_axis not in (None,-1):
+            raise Exception('RoiExtractor supports channel_axis None or -1, not {}'.format(channel_axis))
+        self.channel_axis = channel_axis
+        masks = np.asarray(masks)
+        self.single = masks.ndim == 2
+        masks = masks.reshape((-1,)+masks.shape[-2:])
+        self.shape = masks.shape[1:]
+        self.n_rois = len(masks)
+
+        self.boxes = [] # (y0,y1,x0,x1) per roi
+        self.weights = [] # weights within the box (dense), or of the indexed pixels (sparse); None if all 1
+        self.idxs = [] # flat indices into the frame (sparse), or None (dense)
+        self.sums = [] # sum of weights
+        for m in masks:
+            ys,xs = np.nonzero(m)
+            if len(ys) == 0:
+                box = (0,0,0,0)
+            else:
+                box = (ys.min(), ys.max()+1, xs.min(), xs.max()+1)
+            y0,y1,x0,x1 = box
+            area = (y1-y0)*(x1-x0)
+            uniform = np.all(m[ys,xs] == 1)
+            if area and len(ys) >= dense_fill*area:
+                w = m[y0:y1,x0:x1].astype(np.float64)
+                self.idxs.append(None)
+                self.weights.append(None if uniform and len(ys)==area else w)
+            else:
+                self.idxs.append(np.ravel_multi_index((ys,xs), self.shape))
+                self.weights.append(None if uniform else m[ys,xs].astype(np.float64))
+            self.boxes.append(box)
+            self.sums.append(float(m[ys,xs].sum()) or 1.)
+
+    def __call__(self, frames):
+        frames = np.asarray(frames)
+        if self.channel_axis is None:
+            lead,chans = frames.shape[:-2],()
+        else:
+            lead,chans = frames.shape[:-3],frames.shape[-1:]
+        frames = frames.reshape((-1,)+self.shape+chans)
+        out = np.empty((len(frames), self.n_rois)+chans)
+        flat = None
+        for i,((y0,y1,x0,x1),w,idx,s) in enumerate(zip(self.boxes, self.weights, self.idxs, self.sums)):
+            if idx is None:
+                px = frames[:,y0:y1,x0:x1]
+                out[:,i] = px.sum(axis=(1,2)) if w is None else np.tensordot(px, w, axes=([1,2],[0,1]))
+            else:
+                if flat is None:
+                    flat = frames.reshape((len(frames),-1)+chans) # (n,pixels) or (n,pixels,c), a view of contiguous frames
+                px = flat[:,idx]
+                out[:,i] = px.sum(axis=1) if w is None else np.tensordot(px, w, axes=([1],[0]))
+            out[:,i] /= s
+        if self.single:
+            return out.reshape(lead+chans)
+        return out.reshape(lead+(self.n_rois,)+chans)
@@ -0,0 +1,18 @@
+class SharedViews(object):
+    """Base for objects that wrap multiprocessing shared arrays in numpy views
+
+    The views would be pickled as copies when the object is handed to a child process, so subclasses list them in _VIEWS and rebuild them in _make_views on the other side.
+    """
+    _VIEWS = []
+
+    def _make_views(self):
+        raise NotImplementedError()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for v in self._VIEWS:
+            state.pop(v, None)
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_views()